@@ -0,0 +1,12 @@
+import trough
+import trough.read_async
+from trough.settings import settings, init_worker
+
+trough.settings.configure_logging()
+
+init_worker()
+
+# asyncio alternative to serving scripts/reader.py under uwsgi, speaks the
+# same protocol on the same port
+if __name__ == '__main__':
+    trough.read_async.run()
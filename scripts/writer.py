@@ -1,3 +1,4 @@
+import os
 import trough
 from trough.settings import settings, init_worker
 
@@ -5,5 +6,11 @@ trough.settings.configure_logging()
 
 init_worker()
 
+if settings['METRICS_DIR']:
+    # aggregate metrics across uwsgi workers; this runs once, in the uwsgi
+    # master, before it forks the workers
+    trough.metrics.registry.enable_multiprocess(
+            os.path.join(settings['METRICS_DIR'], 'write'))
+
 # setup uwsgi endpoint
 application = trough.write.WriteServer()
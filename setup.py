@@ -31,12 +31,15 @@ setup(
         'doublethink>=0.2.0',
         'uhashring>=0.7,<1.0',
         'flask>=1.0.2',
-        'sqlitebck>=1.4',
         'hdfs3>=0.2.0',
         'aiodns>=1.2.0',
-        'aiohttp>=2.3.10,<=3.0.0b0', # >3.0.0b0 requires python 3.5.3+
-        'async-timeout<3.0.0',       # >=3.0.0 requires python 3.5.3+
+        'aiohttp>=3.3.0', # ClientTimeout, for the asyncio read server
     ],
+    extras_require={
+        'msgpack': ['msgpack>=0.6.1'],
+        'arrow': ['pyarrow>=0.13.0'],
+        'zstd': ['zstandard>=0.11.0'],
+    },
     tests_require=['pytest'],
     scripts=glob.glob('scripts/*.py'),
     entry_points={'console_scripts': ['trough-shell=trough.shell:trough_shell']}
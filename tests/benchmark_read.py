@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+'''
+tests/benchmark_read.py - read path micro-benchmarks
+
+Not collected by pytest, run it by hand:
+
+    python tests/benchmark_read.py [--rows N]
+
+json-streaming: compares the old row-at-a-time `sql_result_json_iter` with
+the current batched one, and checks that both produce identical bytes.
+
+validation: compares the old sqlparse-based SELECT check with executing the
+same short query on a pooled connection, where sqlite's authorizer and
+statement cache do the checking.
+
+open-modes: runs point lookups and a sorted scan against the same segment
+opened the old way (read-write, default pragmas), plain `mode=ro`, and
+`mode=ro&immutable=1` with the READ_* pragmas from settings.
+'''
+import os
+os.environ.setdefault('TROUGH_SETTINGS', os.path.join(os.path.dirname(__file__), "test.conf"))
+
+import argparse
+import sqlite3
+import sqlparse
+import tempfile
+import time
+import ujson
+import trough
+
+def make_segment(path, rows):
+    connection = sqlite3.connect(path)
+    connection.execute(
+            'CREATE TABLE crawled_url (id INTEGER PRIMARY KEY, url TEXT, '
+            'status_code INTEGER, size INTEGER, timestamp TEXT, '
+            'content_type TEXT, digest TEXT)')
+    connection.executemany(
+            'INSERT INTO crawled_url (url, status_code, size, timestamp, '
+            'content_type, digest) VALUES (?, ?, ?, ?, ?, ?)', (
+                ('http://example.com/path/%s/page.html' % i, 200, i * 37,
+                 '2019-01-01T00:00:%02d' % (i % 60), 'text/html',
+                 'sha1:%032x' % i) for i in range(rows)))
+    connection.commit()
+    connection.close()
+
+def legacy_sql_result_json_iter(cursor):
+    '''`ReadServer.sql_result_json_iter` as it was before batching.'''
+    first = True
+    yield b"["
+    while True:
+        row = cursor.fetchone()
+        if not row:
+            break
+        if not first:
+            yield b",\n"
+        output = dict((cursor.description[i][0], value) for i, value in enumerate(row))
+        yield ujson.dumps(output, escape_forward_slashes=False).encode('utf-8')
+        first = False
+    yield b"]\n"
+
+def read_server():
+    # avoid ReadServer.__init__(), which connects to rethinkdb
+    server = trough.read.ReadServer.__new__(trough.read.ReadServer)
+    server.pool = trough.read.ConnectionPool()
+    return server
+
+def timed(label, rows, fn, unit='rows'):
+    start = time.time()
+    chunks = 0
+    body = []
+    for chunk in fn():
+        chunks += 1
+        body.append(chunk)
+    elapsed = time.time() - start
+    print('%-40s %10.0f %s/sec  %8s chunks  %.3fs' % (
+        label, rows / elapsed, unit, chunks, elapsed))
+    return b''.join(body)
+
+def benchmark_json_streaming(path, rows):
+    print('== json streaming (%s rows) ==' % rows)
+    server = read_server()
+    query = 'SELECT * FROM crawled_url'
+    def legacy():
+        connection = sqlite3.connect(path)
+        return legacy_sql_result_json_iter(connection.execute(query))
+    def batched():
+        connection = server.pool.checkout(path)
+        return server.sql_result_json_iter(connection.execute(query))
+    before = timed('row-at-a-time (before)', rows, legacy)
+    after = timed('batched (after)', rows, batched)
+    assert before == after, 'output differs!'
+
+def benchmark_validation(path, n=2000):
+    print('== select validation (%s queries) ==' % n)
+    server = read_server()
+    query = b'SELECT url, status_code FROM crawled_url WHERE id = 1234'
+    def sqlparse_check():
+        for i in range(n):
+            assert len(sqlparse.split(query)) == 1
+            assert sqlparse.parse(query)[0].get_type() == 'SELECT'
+            yield b''
+    def authorizer_check():
+        connection = server.pool.checkout(path)
+        for i in range(n):
+            connection.execute(query.decode('utf-8')).fetchall()
+            yield b''
+        server.pool.checkin(connection)
+    timed('sqlparse (before)', n, sqlparse_check, 'queries')
+    timed('authorizer+execute (after)', n, authorizer_check, 'queries')
+
+def benchmark_open_modes(path, rows, n=20000):
+    print('== open modes (%s point lookups, sorted scan of %s rows) ==' % (n, rows))
+    server = read_server()
+    def connections():
+        yield 'read-write, default pragmas', sqlite3.connect(path, check_same_thread=False)
+        yield 'mode=ro + pragmas', server.pool.checkout(path, immutable=False)
+        yield 'immutable + pragmas', server.pool.checkout(path, immutable=True)
+    for label, connection in connections():
+        def lookups():
+            for i in range(n):
+                connection.execute(
+                        'SELECT url FROM crawled_url WHERE id = ?',
+                        (i % rows + 1,)).fetchall()
+                yield b''
+        def scan():
+            cursor = connection.execute(
+                    'SELECT url, digest FROM crawled_url ORDER BY digest DESC')
+            while True:
+                batch = cursor.fetchmany(1000)
+                if not batch:
+                    break
+                yield b''
+        timed('%s: lookups' % label, n, lookups, 'queries')
+        timed('%s: scan' % label, rows, scan)
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--rows', type=int, default=200000)
+    args = arg_parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'benchmark.sqlite')
+        make_segment(path, args.rows)
+        benchmark_json_streaming(path, args.rows)
+        benchmark_validation(path)
+        benchmark_open_modes(path, args.rows)
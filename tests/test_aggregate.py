@@ -0,0 +1,88 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+import sqlite3
+from trough import aggregate
+
+ROWS = [
+    ('a', 10, 0.5), ('b', None, 1.5), ('a', 30, None), (None, 7, 2.0),
+    ('c', 3, 0.25), ('b', 8, None), ('a', None, 4.0), ('c', 12, 1.0),
+    ('b', 20, 3.5), ('a', 1, 0.75),
+]
+
+def connection(rows):
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE u (host TEXT, size INTEGER, score REAL)')
+    connection.executemany('INSERT INTO u VALUES (?, ?, ?)', rows)
+    return connection
+
+class TestAggregate(unittest.TestCase):
+    def setUp(self):
+        # the last segment is empty
+        self.segments = [connection(ROWS[:4]), connection(ROWS[4:]), connection([])]
+        self.reference = connection(ROWS)
+
+    def run_query(self, sql):
+        query = aggregate.AggregateQuery(sql)
+        for segment in self.segments:
+            cursor = segment.execute(query.segment_sql)
+            columns = [c[0] for c in cursor.description]
+            query.add([dict(zip(columns, row)) for row in cursor])
+        cursor = self.reference.execute(sql)
+        columns = [c[0] for c in cursor.description]
+        expected = [dict(zip(columns, row)) for row in cursor]
+        return query, query.result(), expected
+
+    def test_rewrite(self):
+        query = aggregate.AggregateQuery(
+                'SELECT host, COUNT(*), AVG(size) FROM u GROUP BY host')
+        self.assertEqual(
+                query.segment_sql,
+                'SELECT host AS _trough_g0, COUNT(*) AS _trough_a0, '
+                'TOTAL(size) AS _trough_a1, COUNT(size) AS _trough_a2, '
+                'COUNT(*) AS _trough_rows FROM u GROUP BY _trough_g0')
+
+    def test_combine(self):
+        query, result, expected = self.run_query(
+                'SELECT host, COUNT(*), AVG(size) AS avg_size, SUM(size), '
+                'TOTAL(score), MIN(score), MAX(size) FROM u GROUP BY host '
+                'ORDER BY host')
+        self.assertEqual(result, expected)
+        stats = query.stats()
+        self.assertEqual(stats['segments'], 3)
+        self.assertEqual(stats['rows_aggregated'], len(ROWS))
+        self.assertEqual(stats['rows_received'], 6)
+        self.assertEqual(stats['groups_held'], 4)
+
+    def test_order_limit(self):
+        _, result, expected = self.run_query(
+                'SELECT host AS h, count(size) FROM u WHERE size > 5 '
+                'GROUP BY h ORDER BY 2 DESC, h LIMIT 2 OFFSET 1')
+        self.assertEqual(result, expected)
+
+    def test_no_group_by(self):
+        _, result, expected = self.run_query(
+                'SELECT COUNT(*), AVG(score), MAX(host) FROM u')
+        self.assertEqual(result, expected)
+        # an empty result is still one row
+        _, result, expected = self.run_query(
+                "SELECT COUNT(*), SUM(size), AVG(size) FROM u WHERE host = 'x'")
+        self.assertEqual(result, [{'COUNT(*)': 0, 'SUM(size)': None, 'AVG(size)': None}])
+        self.assertEqual(result, expected)
+
+    def test_unsupported(self):
+        for sql in (
+                'SELECT host, COUNT(DISTINCT size) FROM u GROUP BY host',
+                'SELECT DISTINCT COUNT(*) FROM u',
+                'SELECT host, COUNT(*) FROM u GROUP BY host HAVING COUNT(*) > 1',
+                'SELECT COUNT(*) + 1 FROM u',
+                'SELECT size, COUNT(*) FROM u GROUP BY host',
+                'SELECT host FROM u GROUP BY host',
+                'SELECT COUNT(*) FROM u UNION SELECT COUNT(*) FROM u',
+                'SELECT COUNT(*) FROM u LIMIT ?'):
+            with self.assertRaises(aggregate.Unsupported, msg=sql):
+                aggregate.AggregateQuery(sql)
+
+if __name__ == '__main__':
+    unittest.main()
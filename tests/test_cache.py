@@ -0,0 +1,69 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+import tempfile
+from trough import cache
+
+class TestNormalizeSql(unittest.TestCase):
+    def test_whitespace_and_comments(self):
+        self.assertEqual(
+                cache.normalize_sql('  SELECT *\n\tFROM  test -- comment\n WHERE id = 1; '),
+                'SELECT * FROM test WHERE id = 1')
+        self.assertEqual(
+                cache.normalize_sql('SELECT /* a */ 1 -- x\n, 2'),
+                'SELECT 1 , 2')
+    def test_quoted_text_untouched(self):
+        self.assertEqual(
+                cache.normalize_sql("SELECT 'a  -- b'  ,  \"c  d\" FROM t"),
+                "SELECT 'a  -- b' , \"c  d\" FROM t")
+        self.assertEqual(
+                cache.normalize_sql("SELECT 'it''s  here'"),
+                "SELECT 'it''s  here'")
+        self.assertNotEqual(
+                cache.normalize_sql("SELECT 'a b'"),
+                cache.normalize_sql("SELECT 'a  b'"))
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = cache.ResultCache(
+                path=os.path.join(self.tmpdir.name, 'cache.sqlite'),
+                max_bytes=100, max_entry_bytes=40)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('seg', (1, 2, 3), 'SELECT 1'))
+        self.assertTrue(self.cache.put('seg', (1, 2, 3), 'SELECT 1', b'[{"1":1}]\n'))
+        self.assertEqual(
+                self.cache.get('seg', (1, 2, 3), 'select 1'.upper() + ';'),
+                b'[{"1":1}]\n')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+    def test_new_file_identity_misses(self):
+        self.cache.put('seg', (1, 2, 3), 'SELECT 1', b'old')
+        self.assertIsNone(self.cache.get('seg', (1, 2, 4), 'SELECT 1'))
+        self.cache.put('seg', (1, 2, 4), 'SELECT 1', b'new')
+        # storing a result for the new file drops results for the old one
+        self.assertIsNone(self.cache.get('seg', (1, 2, 3), 'SELECT 1'))
+    def test_entry_size_cap(self):
+        self.assertFalse(self.cache.put('seg', (1,), 'SELECT 1', b'x' * 41))
+        self.assertIsNone(self.cache.get('seg', (1,), 'SELECT 1'))
+    def test_lru_eviction(self):
+        for i in range(3):
+            self.cache.put('seg%s' % i, (1,), 'SELECT 1', b'x' * 40)
+        self.assertIsNone(self.cache.get('seg0', (1,), 'SELECT 1'))
+        self.assertEqual(self.cache.get('seg2', (1,), 'SELECT 1'), b'x' * 40)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+    def test_invalidate(self):
+        self.cache.put('seg', (1,), 'SELECT 1', b'x')
+        self.cache.invalidate('seg')
+        self.assertIsNone(self.cache.get('seg', (1,), 'SELECT 1'))
+    def test_cacheable(self):
+        self.assertTrue(self.cache.cacheable('SELECT * FROM test'))
+        self.assertFalse(self.cache.cacheable('SELECT random()'))
+        self.assertFalse(self.cache.cacheable("SELECT datetime('now')"))
+        self.assertFalse(self.cache.cacheable('SELECT CURRENT_TIMESTAMP'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+from unittest import mock
+import ujson
+import requests
+from trough import fanout
+from trough import formats
+
+class FakeSession:
+    '''Answers segment queries from `results`, `{segment: rows or error}`,
+    where rows are a list of dicts, or `(columns, [[value, ...], ...])`, in
+    the compact format, two rows per batch.'''
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+        self.columns = next(
+                (list(rows[0]) for rows in results.values()
+                 if isinstance(rows, list) and rows), [])
+    def body(self, result):
+        if isinstance(result, list):
+            columns = list(result[0]) if result else self.columns
+            rows = [list(row.values()) for row in result]
+        else:
+            columns, rows = result
+        compact = formats.CompactFormat()
+        body = compact.header(columns)
+        for i in range(0, len(rows), 2):
+            body += compact.batch(columns, rows[i:i+2], i == 0)
+        return body + compact.footer(columns, not rows)
+    def post(self, url, data=None, headers=None, stream=False, timeout=None):
+        segment = url.split('segment=')[1].split('&')[0]
+        self.queries.append((segment, data))
+        result = self.results[segment]
+        if isinstance(result, Exception):
+            raise result
+        response = mock.MagicMock()
+        response.__enter__.return_value = response
+        response.status_code = 200
+        if isinstance(result, tuple) and isinstance(result[0], int):
+            response.status_code, response.text = result
+        else:
+            response.iter_lines = lambda chunk_size: iter(
+                    self.body(result).splitlines())
+        return response
+
+def urls(segments):
+    return {s: ['http://localhost:6444/?segment=%s' % s] for s in segments}
+
+class TestParseQuery(unittest.TestCase):
+    def test_limit_pushdown(self):
+        sql, terms, limit, offset = fanout.parse_query(
+                'SELECT a FROM t ORDER BY a DESC LIMIT 10 OFFSET 5;')
+        self.assertEqual(sql, 'SELECT a FROM t ORDER BY a DESC LIMIT 15')
+        self.assertEqual((limit, offset), (10, 5))
+        self.assertEqual([(t.name, t.descending) for t in terms], [('a', True)])
+        self.assertEqual(fanout.parse_query('SELECT a FROM t LIMIT 5, 10')[2:], (10, 5))
+    def test_nested_clauses_ignored(self):
+        sql, terms, limit, offset = fanout.parse_query(
+                "SELECT a, (SELECT b FROM u ORDER BY b LIMIT 1) AS c FROM t "
+                "WHERE d = 'order by x limit 3'")
+        self.assertEqual((terms, limit, offset), ([], None, 0))
+    def test_unsupported(self):
+        for sql in ('SELECT a FROM t ORDER BY a + 1',
+                    'SELECT a FROM t LIMIT ?',
+                    'SELECT a FROM t ORDER BY a COLLATE foo'):
+            with self.assertRaises(fanout.FanoutError):
+                fanout.parse_query(sql)
+
+class TestFanout(unittest.TestCase):
+    def run_fanout(self, sql, results, **kwargs):
+        session = FakeSession(results)
+        f = fanout.Fanout(sql, urls(results), session=session, **kwargs)
+        return fanout.decode(b''.join(f.stream())), session
+    def test_ordered_merge(self):
+        results = {
+            's1': [{'a': None, 'b': 1}, {'a': 1, 'b': 2}, {'a': 'x', 'b': 3}],
+            's2': [{'a': 0.5, 'b': 4}, {'a': 2, 'b': 5}],
+            's3': [],
+        }
+        result, _ = self.run_fanout('SELECT a, b FROM t ORDER BY a', results)
+        self.assertEqual([row['b'] for row in result['rows']], [1, 4, 2, 5, 3])
+        self.assertEqual(result['columns'], ['a', 'b'])
+        for rows in results.values():
+            rows.reverse()
+        result, _ = self.run_fanout('SELECT a, b FROM t ORDER BY a DESC', results)
+        self.assertEqual([row['b'] for row in result['rows']], [3, 5, 2, 4, 1])
+    def test_limit(self):
+        results = {'s%s' % i: [{'a': i * 10 + j} for j in range(10)] for i in range(5)}
+        result, session = self.run_fanout(
+                'SELECT a FROM t ORDER BY a DESC LIMIT 3 OFFSET 1',
+                {s: list(reversed(rows)) for s, rows in results.items()})
+        self.assertEqual([row['a'] for row in result['rows']], [48, 47, 46])
+        self.assertEqual(session.queries[0][1], b'SELECT a FROM t ORDER BY a DESC LIMIT 4')
+        # with a queue of one row, the worker can't get ahead of the merge
+        # and finish all the segments before the limit is reached
+        with mock.patch.dict(fanout.settings, {'FANOUT_QUEUE_SIZE': 1}):
+            result, session = self.run_fanout(
+                    'SELECT a FROM t LIMIT 5', results, concurrency=1)
+        self.assertEqual(len(result['rows']), 5)
+        self.assertGreaterEqual(result['segments']['cancelled'], 1)
+    def test_duplicate_columns(self):
+        results = {
+            's1': (['id', 'id'], [[1, 10], [3, 30]]),
+            's2': (['id', 'id'], [[2, 20]]),
+        }
+        for sql in ('SELECT a.id, b.id FROM a JOIN b', 'SELECT a.id, b.id FROM a JOIN b ORDER BY 1'):
+            session = FakeSession(results)
+            f = fanout.Fanout(sql, urls(results), session=session)
+            result = ujson.loads(b''.join(f.stream()))
+            self.assertEqual(result['columns'], ['id', 'id'])
+            self.assertEqual(sorted(result['rows']), [[1, 10], [2, 20], [3, 30]])
+        self.assertEqual(result['rows'], [[1, 10], [2, 20], [3, 30]])
+    def test_ordered_bounded_queues(self):
+        results = {'s%s' % i: [{'a': j * 5 + i} for j in range(10)] for i in range(5)}
+        # the merge needs the first row of every segment, while one worker
+        # at a time fetches them: rows past the first two spill
+        with mock.patch.dict(fanout.settings, {'FANOUT_QUEUE_SIZE': 2}):
+            result, _ = self.run_fanout(
+                    'SELECT a FROM t ORDER BY a', results, concurrency=1)
+        self.assertEqual([row['a'] for row in result['rows']], list(range(50)))
+        self.assertEqual(result['segments']['succeeded'], 5)
+    def test_spilling_queue(self):
+        q = fanout._SpillingQueue(2)
+        for i in range(5):
+            q.put([i])
+        self.assertEqual(len(q.rows), 2)
+        self.assertEqual([q.get() for _ in range(3)], [[0], [1], [2]])
+        for i in range(5, 8):
+            q.put([i])
+        q.finish()
+        self.assertLessEqual(len(q.rows), 2)
+        rows = []
+        for row in iter(q.get, fanout._DONE):
+            rows.append(row)
+            self.assertLessEqual(len(q.rows), 2)
+        self.assertEqual(rows, [[i] for i in range(3, 8)])
+        self.assertEqual(q.spilled, 0)
+        q.close()
+    def test_errors(self):
+        results = {
+            's1': [{'a': 1}],
+            's2': requests.ConnectionError('connection refused'),
+            's3': (500, '500 Server Error: no such table: t'),
+        }
+        result, _ = self.run_fanout('SELECT a FROM t', results)
+        self.assertEqual(result['rows'], [{'a': 1}])
+        self.assertEqual(sorted(result['errors']), ['s2', 's3'])
+        self.assertEqual(result['segments']['failed'], 2)
+        self.assertIn('no such table', result['errors']['s3'])
+        result, _ = self.run_fanout('SELECT a FROM t', {'s1': [{'a': 1}]})
+        self.assertEqual(result['errors'], {})
+
+if __name__ == '__main__':
+    unittest.main()
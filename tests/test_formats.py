@@ -0,0 +1,90 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+from unittest import mock
+from trough import formats
+
+COLUMNS = ['id', 'url', 'size']
+ROWS = [(1, 'http://example.com/', 100), (2, 'http://example.org/a/b', None),
+        (3, 'héllo, "world"', 3)]
+
+def encode(name, rows, batch_size=2):
+    result_format = formats.get_format(name)
+    out = [result_format.header(COLUMNS)]
+    first = True
+    for i in range(0, len(rows), batch_size):
+        out.append(result_format.batch(COLUMNS, rows[i:i+batch_size], first))
+        first = False
+    out.append(result_format.footer(COLUMNS, first))
+    return b''.join(out)
+
+class TestFormats(unittest.TestCase):
+    def test_round_trip(self):
+        expected = [dict(zip(COLUMNS, row)) for row in ROWS]
+        for name in formats.FORMATS:
+            if not formats.available(name):
+                continue
+            result = formats.decode(name, encode(name, ROWS))
+            if name == 'csv':
+                self.assertEqual(result, [
+                    {k: '' if v is None else str(v) for k, v in row.items()}
+                    for row in expected])
+            else:
+                self.assertEqual(result, expected, name)
+    def test_empty(self):
+        for name in formats.FORMATS:
+            if formats.available(name):
+                self.assertEqual(formats.decode(name, encode(name, [])), [], name)
+        self.assertEqual(encode('json', []), b'[]\n')
+        self.assertEqual(encode('compact', []), b'{"columns":["id","url","size"],"rows":[]}\n')
+    def test_json_unchanged(self):
+        self.assertEqual(
+                encode('json', ROWS[:2]),
+                b'[{"id":1,"url":"http://example.com/","size":100},\n'
+                b'{"id":2,"url":"http://example.org/a/b","size":null}]\n')
+    @unittest.skipUnless(formats.available('arrow'), 'needs pyarrow')
+    def test_arrow_types_across_batches(self):
+        import pyarrow
+        rows = [(1, 'a', 1), (2, 'b', 2), (3, 4, 2.5), (4, None, 2 ** 40)]
+        # the types of columns are those of all the rows held back
+        with mock.patch.dict(formats.settings, {'READ_ARROW_SCHEMA_ROWS': 4}):
+            body = encode('arrow', rows)
+        table = pyarrow.ipc.open_stream(body).read_all()
+        self.assertEqual(
+                [str(f.type) for f in table.schema], ['int64', 'string', 'double'])
+        self.assertEqual(formats.decode('arrow', body), [
+            {'id': 1, 'url': 'a', 'size': 1.0},
+            {'id': 2, 'url': 'b', 'size': 2.0},
+            {'id': 3, 'url': '4', 'size': 2.5},
+            {'id': 4, 'url': None, 'size': 2.0 ** 40}])
+        # values of later rows are converted to the type of their column,
+        # or sent as nulls if that would lose them, never truncated
+        rows = [(1, 'a', 1), (2, 'b', 2), (3.0, 4, 3.5), (4.5, b'x', 'big')]
+        with mock.patch.dict(formats.settings, {'READ_ARROW_SCHEMA_ROWS': 2}), \
+                mock.patch('trough.formats.logging.warning') as warning:
+            body = encode('arrow', rows)
+        table = pyarrow.ipc.open_stream(body).read_all()
+        self.assertEqual(
+                [str(f.type) for f in table.schema], ['int64', 'string', 'int64'])
+        self.assertEqual(formats.decode('arrow', body), [
+            {'id': 1, 'url': 'a', 'size': 1},
+            {'id': 2, 'url': 'b', 'size': 2},
+            {'id': 3, 'url': '4', 'size': None},
+            {'id': None, 'url': 'x', 'size': None}])
+        self.assertEqual(warning.call_args[0][1], {'id': 1, 'size': 2})
+    def test_negotiate(self):
+        self.assertEqual(formats.negotiate(), 'json')
+        self.assertEqual(formats.negotiate('NDJSON'), 'ndjson')
+        self.assertEqual(formats.negotiate(None, 'text/csv'), 'csv')
+        self.assertEqual(formats.negotiate(None, 'text/html, */*'), 'json')
+        self.assertEqual(formats.negotiate(
+            None, 'application/x-ndjson;q=0.5, application/vnd.trough.compact+json'),
+            'compact')
+        # query parameter wins over the Accept header
+        self.assertEqual(formats.negotiate('csv', 'application/x-ndjson'), 'csv')
+        with self.assertRaises(formats.UnsupportedFormat):
+            formats.negotiate('xml')
+
+if __name__ == '__main__':
+    unittest.main()
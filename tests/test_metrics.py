@@ -0,0 +1,79 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+from unittest import mock
+import json
+import tempfile
+from trough import metrics
+from trough.settings import settings
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_render(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter('test_requests_total', 'requests')
+        registry.gauge('test_up', 'up', fn=lambda: 1)
+        registry.inc('test_requests_total', outcome='ok')
+        registry.inc('test_requests_total', 2, outcome='ok')
+        registry.inc('test_requests_total', outcome='error')
+        self.assertEqual(registry.render(), (
+            '# HELP test_requests_total requests\n'
+            '# TYPE test_requests_total counter\n'
+            'test_requests_total{outcome="error"} 1\n'
+            'test_requests_total{outcome="ok"} 3\n'
+            '# HELP test_up up\n'
+            '# TYPE test_up gauge\n'
+            'test_up 1\n'))
+    def test_histogram(self):
+        registry = metrics.MetricsRegistry()
+        registry.histogram('test_seconds', 'latency', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            registry.observe('test_seconds', value, outcome='ok')
+        self.assertEqual(registry.render(), (
+            '# HELP test_seconds latency\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{outcome="ok",le="0.1"} 2\n'
+            'test_seconds_bucket{outcome="ok",le="1.0"} 3\n'
+            'test_seconds_bucket{outcome="ok",le="+Inf"} 4\n'
+            'test_seconds_sum{outcome="ok"} 3.65\n'
+            'test_seconds_count{outcome="ok"} 4\n'))
+    def test_multiprocess(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            registry = metrics.MetricsRegistry()
+            registry.counter('test_requests_total', 'requests')
+            registry.gauge('test_in_flight', 'in flight')
+            registry.gauge('test_staleness', 'staleness', merge='max')
+            registry.histogram('test_seconds', 'latency', buckets=(1,))
+            registry.enable_multiprocess(tmpdir)
+            registry.inc('test_requests_total', 2, outcome='ok')
+            registry.set('test_in_flight', 1)
+            registry.set('test_staleness', 5)
+            registry.observe('test_seconds', 0.5)
+            # another worker, and one that has exited
+            for pid, in_flight in ((1, 3), (2 ** 22 + 1, 7)):
+                with open('%s/%s.json' % (tmpdir, pid), 'w') as f:
+                    json.dump({'pid': pid, 'metrics': [
+                        ['test_requests_total', 'counter', 'requests', 'sum', [[[['outcome', 'ok']], 3]]],
+                        ['test_in_flight', 'gauge', 'in flight', 'sum', [[[], in_flight]]],
+                        ['test_staleness', 'gauge', 'staleness', 'max', [[[], 9]]],
+                        ['test_seconds', 'histogram', 'latency', 'sum', [[[], [[1], [0, 1], 2.0, 1]]]],
+                    ]}, f)
+            with mock.patch.object(metrics, '_pid_alive', lambda pid: pid < 2 ** 22):
+                samples = {name: values for name, _, _, values in registry.merged_samples()}
+            self.assertEqual(samples['test_requests_total'], {(('outcome', 'ok'),): 8})
+            # gauges of exited workers don't count
+            self.assertEqual(samples['test_in_flight'], {(): 4})
+            self.assertEqual(samples['test_staleness'], {(): 9})
+            self.assertEqual(samples['test_seconds'][()].counts, [1, 2])
+            self.assertEqual(samples['test_seconds'][()].count, 3)
+    def test_segment_class(self):
+        with mock.patch.object(metrics, '_segment_classes', set()), \
+                mock.patch.dict(settings, {'METRICS_MAX_SEGMENT_CLASSES': 2}):
+            self.assertEqual(metrics.segment_class('warcprox-20190301'), 'warcprox')
+            self.assertEqual(metrics.segment_class('cdx_2019'), 'cdx')
+            self.assertEqual(metrics.segment_class('1234'), 'other')
+            self.assertEqual(metrics.segment_class('test'), 'other')
+            self.assertEqual(metrics.segment_class('cdx_2020'), 'cdx')
+
+if __name__ == '__main__':
+    unittest.main()
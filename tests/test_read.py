@@ -4,8 +4,10 @@ os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.co
 import unittest
 from unittest import mock
 import trough
+import io
 import json
 import sqlite3
+import tempfile
 from tempfile import NamedTemporaryFile
 from trough import sync
 from trough.settings import settings
@@ -54,6 +56,299 @@ class TestReadServer(unittest.TestCase):
         connection.close()
         database_file.close()
         self.assertEqual(output, [{'id': 1, 'test': 'test'}])
+    def test_read_batches(self):
+        database_file = NamedTemporaryFile()
+        connection = sqlite3.connect(database_file.name)
+        connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+        connection.executemany('INSERT INTO test (test) VALUES (?);', [('t%s' % i,) for i in range(5)])
+        connection.commit()
+        segment = mock.Mock()
+        segment.local_path = lambda: database_file.name
+        parts = list(self.server.sql_result_json_iter(
+                self.server.execute_query(segment, b'SELECT * FROM "test";'),
+                batch_size=2))
+        connection.close()
+        database_file.close()
+        # 3 batches plus the closing bracket
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(b''.join(parts), (
+            b'[{"id":1,"test":"t0"},\n{"id":2,"test":"t1"},\n'
+            b'{"id":3,"test":"t2"},\n{"id":4,"test":"t3"},\n'
+            b'{"id":5,"test":"t4"}]\n'))
+    def test_read_formats(self):
+        database_file = NamedTemporaryFile()
+        connection = sqlite3.connect(database_file.name)
+        connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+        connection.executemany('INSERT INTO test (test) VALUES (?);', [('t%s' % i,) for i in range(3)])
+        connection.commit()
+        segment = mock.Mock()
+        segment.local_path = lambda: database_file.name
+        output = b''.join(self.server.sql_result_iter(
+                self.server.execute_query(segment, b'SELECT * FROM "test";'),
+                trough.formats.get_format('compact'), batch_size=2))
+        self.assertEqual(output, (
+            b'{"columns":["id","test"],"rows":[[1,"t0"],\n[2,"t1"],\n[3,"t2"]]}\n'))
+        output = b''.join(self.server.sql_result_iter(
+                self.server.execute_query(segment, b'SELECT * FROM "test";'),
+                trough.formats.get_format('ndjson'), batch_size=2))
+        connection.close()
+        database_file.close()
+        self.assertEqual(output, (
+            b'{"id":1,"test":"t0"}\n{"id":2,"test":"t1"}\n{"id":3,"test":"t2"}\n'))
+    def test_select_only(self):
+        database_file = NamedTemporaryFile()
+        connection = sqlite3.connect(database_file.name)
+        connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+        connection.execute('INSERT INTO test (test) VALUES ("test");')
+        connection.commit()
+        segment = mock.Mock()
+        segment.local_path = lambda: database_file.name
+        for query in (
+                b'INSERT INTO test (test) VALUES ("test");',
+                b'SELECT * FROM test; DELETE FROM test;',
+                b'SELECT 1; SELECT 2;',
+                b'PRAGMA journal_mode=DELETE;',
+                b"ATTACH DATABASE '/tmp/x.sqlite' AS x;",
+                b'-- just a comment',
+                b''):
+            with self.assertRaisesRegex(Exception, 'Exactly one SELECT query per request'):
+                self.server.execute_query(segment, query)
+        for query, expected in (
+                (b'SELECT test FROM test; -- trailing comment', [{'test': 'test'}]),
+                (b'WITH t AS (SELECT 2 AS n) SELECT n FROM t', [{'n': 2}]),
+                (b"SELECT name FROM pragma_table_info('test') WHERE pk", [{'name': 'id'}])):
+            output = b''.join(self.server.sql_result_json_iter(
+                self.server.execute_query(segment, query)))
+            self.assertEqual(json.loads(output.decode('utf-8')), expected)
+        self.assertEqual(
+                connection.execute('SELECT COUNT(*) FROM test').fetchone()[0], 1)
+        connection.close()
+        database_file.close()
+    def test_read_bound(self):
+        database_file = NamedTemporaryFile()
+        connection = sqlite3.connect(database_file.name)
+        connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+        connection.executemany('INSERT INTO test (test) VALUES (?);', [("it's",), ('b',)])
+        connection.commit()
+        segment = mock.Mock()
+        segment.local_path = lambda: database_file.name
+        output = b''.join(self.server.sql_result_json_iter(
+            self.server.execute_query(
+                segment, b'SELECT id FROM test WHERE test = ?', params=("it's",))))
+        self.assertEqual(json.loads(output.decode('utf-8')), [{'id': 1}])
+        output = b''.join(self.server.sql_result_json_iter(
+            self.server.execute_query(
+                segment, b'SELECT test FROM test WHERE id = :id', params={'id': 2})))
+        self.assertEqual(json.loads(output.decode('utf-8')), [{'test': 'b'}])
+        connection.close()
+        database_file.close()
+    def test_read_batch(self):
+        database_file = NamedTemporaryFile()
+        connection = sqlite3.connect(database_file.name)
+        connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+        connection.executemany('INSERT INTO test (test) VALUES (?);', [('t%s' % i,) for i in range(3)])
+        connection.commit()
+        segment = mock.Mock()
+        segment.local_path = lambda: database_file.name
+        queries = [
+            ('count', 'SELECT COUNT(*) AS n FROM test', None),
+            ('one', 'SELECT test FROM test WHERE id = ?', (2,)),
+            (2, 'DELETE FROM test', None),
+            (3, 'SELECT nope FROM test', None),
+            ('last', 'SELECT id FROM test WHERE id > :id', {'id': 2}),
+        ]
+        pooled = self.server.checkout(segment)
+        output = b''.join(self.server.batch_result_iter(
+            pooled, queries, trough.formats.get_format('json')))
+        self.assertEqual(json.loads(output.decode('utf-8')), [
+            {'label': 'count', 'result': [{'n': 3}]},
+            {'label': 'one', 'result': [{'test': 't1'}]},
+            {'label': 2, 'error': 'Exactly one SELECT query per request, please.'},
+            {'label': 3, 'error': 'no such column: nope'},
+            {'label': 'last', 'result': [{'id': 3}]},
+        ])
+        # the snapshot is over, and the connection back in the pool
+        self.assertFalse(pooled.in_transaction)
+        self.assertIs(self.server.checkout(segment), pooled)
+        self.assertEqual(
+                connection.execute('SELECT COUNT(*) FROM test').fetchone()[0], 3)
+        connection.close()
+        database_file.close()
+    def test_query_budget(self):
+        database_file = NamedTemporaryFile()
+        sqlite3.connect(database_file.name).execute('CREATE TABLE test (id INTEGER);')
+        segment = mock.Mock()
+        segment.local_path = lambda: database_file.name
+        forever = b'WITH RECURSIVE c(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM c) '
+        for budget, reason in (
+                (trough.read.QueryBudget(max_steps=100000), 'steps'),
+                (trough.read.QueryBudget(timeout=0.05), 'time'),
+                (trough.read.QueryBudget(disconnected=lambda: True), 'disconnect')):
+            budget.DISCONNECT_CHECK_INTERVAL = 0
+            budget._next_disconnect_check = 0
+            with self.assertRaises(trough.read.QueryBudgetExceeded) as cm:
+                self.server.execute_query(
+                        segment, forever + b'SELECT COUNT(*) FROM c', budget=budget)
+            self.assertEqual(cm.exception.reason, reason)
+        # out of steps while streaming: the response is cut short
+        budget = trough.read.QueryBudget(max_steps=100000)
+        cursor = self.server.execute_query(
+                segment, forever + b'SELECT n FROM c', budget=budget)
+        output = b''.join(self.server.sql_result_json_iter(cursor, batch_size=100))
+        self.assertTrue(output.startswith(b'[{"n":1},'))
+        self.assertFalse(output.endswith(b']\n'))
+        self.assertEqual(budget.exceeded, 'steps')
+        # the budget does not outlive the query on a pooled connection
+        cursor = self.server.execute_query(
+                segment, b'SELECT 1', budget=trough.read.QueryBudget(max_steps=100000))
+        connection = cursor.connection
+        b''.join(self.server.sql_result_json_iter(cursor))
+        cursor = self.server.execute_query(
+            segment, forever + b'SELECT COUNT(*) AS n FROM (SELECT n FROM c LIMIT 100000)')
+        self.assertIs(cursor.connection, connection)
+        output = b''.join(self.server.sql_result_json_iter(cursor))
+        self.assertEqual(json.loads(output.decode('utf-8')), [{'n': 100000}])
+        samples = {name: values for name, _, _, values in trough.metrics.registry.samples()}
+        self.assertGreaterEqual(
+                samples['trough_read_interrupted_total'][(('reason', 'steps'),)], 1)
+        database_file.close()
+    def test_read_pages(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, 'test.sqlite')
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+        connection.executemany('INSERT INTO test (test) VALUES (?);', [('t%s' % i,) for i in range(10)])
+        connection.commit()
+        connection.close()
+        segment = mock.Mock()
+        segment.id = 'test'
+        segment.local_path = lambda: path
+        result_format = trough.formats.get_format('json')
+        query = b'SELECT test, id FROM test WHERE id > ? -- comment'
+        pages = []
+        token = None
+        while True:
+            body, token = self.server.read_page(
+                    segment, query, result_format, ['id'], 4, token,
+                    immutable=True, params=(2,))
+            pages.append(json.loads(body.decode('utf-8')))
+            if not token:
+                break
+        # rows 3-10; the last page is full, but known to be the last
+        self.assertEqual([len(page) for page in pages], [4, 4])
+        self.assertEqual(pages[1][0], {'test': 't6', 'id': 7})
+        # tokens are only good for the query they came from
+        body, token = self.server.read_page(
+                segment, query, result_format, ['id'], 4, None,
+                immutable=True, params=(2,))
+        with self.assertRaisesRegex(ValueError, 'different query'):
+            self.server.read_page(
+                    segment, query, result_format, ['id'], 4, token,
+                    immutable=True, params=(3,))
+        with self.assertRaisesRegex(ValueError, 'must all be in the result'):
+            self.server.read_page(
+                    segment, query, result_format, ['nope'], 4, None,
+                    immutable=True, params=(2,))
+        # and for the segment file they were read from
+        connection = sqlite3.connect(path)
+        connection.execute('INSERT INTO test (test) VALUES ("new");')
+        connection.commit()
+        connection.close()
+        with self.assertRaises(trough.read.PageConflict):
+            self.server.read_page(
+                    segment, query, result_format, ['id'], 4, token,
+                    immutable=True, params=(2,))
+        tmpdir.cleanup()
+    def test_compression(self):
+        database_file = NamedTemporaryFile()
+        connection = sqlite3.connect(database_file.name)
+        connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+        connection.executemany('INSERT INTO test (test) VALUES (?);', [('t%s' % i,) for i in range(1000)])
+        connection.commit()
+        connection.close()
+        segment = mock.Mock()
+        segment.local_path = lambda: database_file.name
+        request = trough.read.ReadRequest()
+        request.segment = segment
+        request.result_format = trough.formats.get_format('json')
+        def serve(query, encoding):
+            request.query = query
+            request.encoding = encoding
+            started = []
+            output = b''.join(self.server.serve_local(
+                    request, None, lambda *args: started.append(args)))
+            return dict(started[0][1]).get('Content-Encoding'), output
+        with mock.patch.dict(settings, {'READ_FETCH_BATCH_SIZE': 100}):
+            plain = serve(b'SELECT * FROM test', None)
+            self.assertEqual(plain[0], None)
+            self.assertEqual(len(json.loads(plain[1].decode('utf-8'))), 1000)
+            for encoding in ('gzip', 'zstd'):
+                if not trough.compression.available(encoding):
+                    continue
+                content_encoding, output = serve(b'SELECT * FROM test', encoding)
+                self.assertEqual(content_encoding, encoding)
+                self.assertLess(len(output), len(plain[1]) / 4)
+                self.assertEqual(trough.compression.decompress(output, encoding), plain[1])
+            # too small to bother
+            self.assertEqual(
+                    serve(b'SELECT * FROM test WHERE id = 1', 'gzip'),
+                    (None, b'[{"id":1,"test":"t0"}]\n'))
+        database_file.close()
+        with mock.patch.dict(settings, {'READ_COMPRESSION_ENCODINGS': 'zstd,gzip'}):
+            self.assertEqual(trough.compression.negotiate(None), None)
+            self.assertEqual(trough.compression.negotiate('gzip, deflate'), 'gzip')
+            self.assertEqual(trough.compression.negotiate('gzip;q=0, br'), None)
+            self.assertEqual(trough.compression.negotiate('identity'), None)
+            self.assertEqual(
+                    trough.compression.negotiate('*'),
+                    'zstd' if trough.compression.available('zstd') else 'gzip')
+        with mock.patch.dict(settings, {'READ_COMPRESSION_ENCODINGS': ''}):
+            self.assertEqual(trough.compression.negotiate('gzip'), None)
+    def test_request_metrics(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            connection = sqlite3.connect(os.path.join(tmpdir, 'metrics7.sqlite'))
+            connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+            connection.executemany('INSERT INTO test (test) VALUES (?);', [('t%s' % i,) for i in range(3)])
+            connection.commit()
+            connection.close()
+            self.server.write_locks.get = lambda segment_id: None
+            def count(name, **labels):
+                samples = {name: values for name, _, _, values in trough.metrics.registry.samples()}
+                values = samples[name].get(tuple(sorted(labels.items())))
+                return getattr(values, 'count', values) or 0
+            before = (
+                count('trough_read_request_seconds', segment_class='metrics', route='local', outcome='ok'),
+                count('trough_read_request_seconds', segment_class='metrics', route='local', outcome='error'),
+                count('trough_read_rows_total'))
+            with mock.patch.dict(settings, {'LOCAL_DATA': tmpdir}):
+                for query in (b'SELECT * FROM test', b'DELETE FROM test'):
+                    env = {
+                        'QUERY_STRING': 'segment=metrics7',
+                        'CONTENT_LENGTH': str(len(query)),
+                        'wsgi.input': io.BytesIO(query)}
+                    b''.join(self.server(env, lambda *args: None))
+            self.assertEqual((
+                count('trough_read_request_seconds', segment_class='metrics', route='local', outcome='ok'),
+                count('trough_read_request_seconds', segment_class='metrics', route='local', outcome='error'),
+                count('trough_read_rows_total')),
+                (before[0] + 1, before[1] + 1, before[2] + 3))
+    def test_query_budget_from_request(self):
+        with mock.patch.dict(settings, {
+                'READ_QUERY_TIMEOUT': 300, 'READ_QUERY_MAX_TIMEOUT': 600,
+                'READ_QUERY_MAX_STEPS': 10**9}):
+            budget = trough.read.QueryBudget.from_request({}, {})
+            self.assertEqual((budget.timeout, budget.max_steps), (300, 10**9))
+            budget = trough.read.QueryBudget.from_request(
+                    {'HTTP_X_TROUGH_TIMEOUT': '5', 'HTTP_X_TROUGH_MAX_STEPS': '1000'}, {})
+            self.assertEqual((budget.timeout, budget.max_steps), (5, 1000))
+            # query parameters win, and requests are capped by the settings
+            budget = trough.read.QueryBudget.from_request(
+                    {'HTTP_X_TROUGH_TIMEOUT': '5'},
+                    {'timeout': ['3600'], 'max_steps': ['1000000000000']})
+            self.assertEqual((budget.timeout, budget.max_steps), (600, 10**9))
+            for query_dict in ({'timeout': ['-1']}, {'max_steps': ['lots']}):
+                with self.assertRaises(ValueError):
+                    trough.read.QueryBudget.from_request({}, query_dict)
     def test_write_failure(self):
         database_file = NamedTemporaryFile()
         connection = sqlite3.connect(database_file.name)
@@ -72,24 +367,130 @@ class TestReadServer(unittest.TestCase):
         database_file.close()
         cursor.close()
         connection.close()
-    @mock.patch("trough.read.requests")
-    def test_proxy_for_write_segment(self, requests):
+    def test_proxy_for_write_segment(self):
+        sent_headers = []
         def post(*args, **kwargs):
+            sent_headers.append(kwargs['headers'])
             response = mock.Mock()
-            response.headers = {"Content-Type": "application/json"}
-            response.iter_content = lambda: (b"test", b"output")
+            response.headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+            # compressed bytes are relayed as they are
+            response.raw.stream = lambda chunk_size, decode_content: (
+                    (b"test", b"output") if decode_content is False else ())
             response.status_code = 200
             response.__enter__ = lambda *args, **kwargs: response
             response.__exit__ = lambda *args, **kwargs: None
             return response
-        requests.post = post
+        self.server.proxy_session.post = post
         consul = mock.Mock()
         registry = mock.Mock()
         rethinker = doublethink.Rethinker(db="trough_configuration", servers=settings['RETHINKDB_HOSTS'])
         services = doublethink.ServiceRegistry(rethinker)
         segment = trough.sync.Segment(segment_id="TEST", rethinker=rethinker, services=services, registry=registry, size=0)
-        output = self.server.proxy_for_write_host('localhost', segment, "SELECT * FROM mock;", start_response=lambda *args, **kwargs: None)
+        started = []
+        output = self.server.proxy_for_write_host('localhost', segment, "SELECT * FROM mock;", start_response=lambda *args: started.append(args), encoding='gzip')
         self.assertEqual(list(output), [b"test", b"output"])
+        self.assertEqual(sent_headers[0]['Accept-Encoding'], 'gzip')
+        self.assertIn(('Content-Encoding', 'gzip'), started[0][1])
+        samples = {name: values for name, _, _, values in trough.metrics.registry.samples()}
+        self.assertGreaterEqual(
+                samples['trough_proxy_response_bytes_total'][(('node', 'localhost'),)], 10)
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'test.sqlite')
+        self.make_segment(self.path, 'test')
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def make_segment(self, path, value):
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE test (test varchar(4));')
+        connection.execute('INSERT INTO test (test) VALUES (?);', (value,))
+        connection.commit()
+        connection.close()
+    def test_reuse(self):
+        pool = trough.read.ConnectionPool(max_size=10, max_per_segment=2)
+        connection = pool.checkout(self.path)
+        pool.checkin(connection)
+        self.assertIs(pool.checkout(self.path), connection)
+        self.assertEqual(pool.stats()['hits'], 1)
+        self.assertEqual(pool.stats()['misses'], 1)
+    def test_read_only(self):
+        pool = trough.read.ConnectionPool(max_size=10, max_per_segment=2)
+        connection = pool.checkout(self.path)
+        with self.assertRaises(sqlite3.DatabaseError):
+            connection.execute('INSERT INTO test (test) VALUES ("nope");')
+        # read-only even without the authorizer
+        connection.set_authorizer(None)
+        with self.assertRaises(sqlite3.OperationalError):
+            connection.execute('INSERT INTO test (test) VALUES ("nope");')
+    def test_invalidated_when_file_replaced(self):
+        pool = trough.read.ConnectionPool(max_size=10, max_per_segment=2)
+        connection = pool.checkout(self.path)
+        pool.checkin(connection)
+        # simulate LocalSyncController.copy_segment_from_hdfs
+        new_path = os.path.join(self.tmpdir.name, 'new.sqlite')
+        self.make_segment(new_path, 'new')
+        os.rename(new_path, self.path)
+        connection = pool.checkout(self.path)
+        self.assertEqual(
+                connection.execute('SELECT test FROM test;').fetchall(),
+                [('new',)])
+        self.assertEqual(pool.stats()['invalidations'], 1)
+        self.assertEqual(pool.stats()['hits'], 0)
+    def test_immutable(self):
+        pool = trough.read.ConnectionPool(max_size=10, max_per_segment=2)
+        connection = pool.checkout(self.path, immutable=True)
+        self.assertTrue(connection.immutable)
+        self.assertEqual(
+                connection.execute('SELECT test FROM test;').fetchall(),
+                [('test',)])
+        connection.set_authorizer(None)
+        self.assertEqual(
+                connection.execute('PRAGMA temp_store').fetchone()[0], 2)
+        self.assertEqual(
+                connection.execute('PRAGMA cache_size').fetchone()[0],
+                settings['READ_CACHE_SIZE'])
+        connection.set_authorizer(trough.read.read_only_authorizer)
+        pool.checkin(connection)
+        # immutable and plain connections are pooled separately
+        self.assertIsNot(pool.checkout(self.path), connection)
+        self.assertIs(pool.checkout(self.path, immutable=True), connection)
+        pool.checkin(connection)
+        new_path = os.path.join(self.tmpdir.name, 'new.sqlite')
+        self.make_segment(new_path, 'new')
+        os.rename(new_path, self.path)
+        connection = pool.checkout(self.path, immutable=True)
+        self.assertEqual(
+                connection.execute('SELECT test FROM test;').fetchall(),
+                [('new',)])
+    def test_immutable_fallback(self):
+        pool = trough.read.ConnectionPool(max_size=10, max_per_segment=2)
+        writer = sqlite3.connect(self.path)
+        writer.execute('PRAGMA journal_mode=WAL')
+        writer.execute('INSERT INTO test (test) VALUES ("more");')
+        writer.commit()
+        # a writer has the file open in wal mode, so changes are in the wal,
+        # which an immutable connection would not see
+        connection = pool.checkout(self.path, immutable=True)
+        self.assertEqual(
+                connection.execute('SELECT COUNT(*) FROM test;').fetchone()[0], 2)
+        writer.close()
+    def test_lru_eviction(self):
+        pool = trough.read.ConnectionPool(max_size=2, max_per_segment=2)
+        paths = []
+        for i in range(3):
+            path = os.path.join(self.tmpdir.name, '%s.sqlite' % i)
+            self.make_segment(path, str(i))
+            paths.append(path)
+        for path in paths:
+            pool.checkin(pool.checkout(path))
+        self.assertEqual(pool.stats()['evictions'], 1)
+        self.assertEqual(pool.stats()['idle_connections'], 2)
+        pool.checkin(pool.checkout(paths[0]))
+        self.assertEqual(pool.stats()['hits'], 0)
+        pool.checkin(pool.checkout(paths[2]))
+        self.assertEqual(pool.stats()['hits'], 1)
 
 if __name__ == '__main__':
     unittest.main()
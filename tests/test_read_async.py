@@ -0,0 +1,89 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+from unittest import mock
+import asyncio
+import json
+import sqlite3
+import tempfile
+import trough
+import trough.read_async
+from trough.settings import settings
+from aiohttp.test_utils import TestServer, TestClient
+
+class TestAsyncReadServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings = mock.patch.dict(settings, {'LOCAL_DATA': self.tmpdir.name})
+        self.settings.start()
+        connection = sqlite3.connect(os.path.join(self.tmpdir.name, 'test.sqlite'))
+        connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+        connection.executemany('INSERT INTO test (test) VALUES (?);', [('t%s' % i,) for i in range(5)])
+        connection.commit()
+        connection.close()
+        self.server = trough.read_async.AsyncReadServer(threads=2, segment_concurrency=1)
+        self.server.server.write_locks.get = lambda segment_id: None
+    def tearDown(self):
+        self.settings.stop()
+        self.tmpdir.cleanup()
+    def run_client(self, fn):
+        async def run():
+            async with TestClient(TestServer(self.server.app())) as client:
+                return await fn(client)
+        return asyncio.run(run())
+    def test_read(self):
+        async def read(client):
+            response = await client.post('/?segment=test', data=b'SELECT * FROM test WHERE id < 3')
+            return response.status, response.headers['Content-Type'], await response.read()
+        status, content_type, body = self.run_client(read)
+        self.assertEqual(status, 200)
+        self.assertEqual(content_type, 'application/json')
+        self.assertEqual(body, b'[{"id":1,"test":"t0"},\n{"id":2,"test":"t1"}]\n')
+    def test_same_protocol(self):
+        async def read(client):
+            results = []
+            for path, data, headers in (
+                    ('/?segment=test&format=ndjson', b'SELECT id FROM test WHERE id < 3', {}),
+                    ('/?segment=test', b'DELETE FROM test', {}),
+                    ('/?segment=test&format=xml', b'SELECT 1', {}),
+                    ('/?segment=test&page_size=2&key=id', b'SELECT id FROM test', {}),
+                    ('/?segment=test', b'WITH RECURSIVE c(n) AS (SELECT 1 UNION ALL '
+                     b'SELECT n + 1 FROM c) SELECT COUNT(*) FROM c',
+                     {'X-Trough-Max-Steps': '10000'})):
+                response = await client.post(path, data=data, headers=headers)
+                results.append((
+                    response.status, await response.read(),
+                    response.headers.get('X-Trough-Continuation')))
+            return results
+        results = self.run_client(read)
+        self.assertEqual(results[0][:2], (200, b'{"id":1}\n{"id":2}\n'))
+        self.assertEqual(results[1][0], 500)
+        self.assertIn(b'Exactly one SELECT query per request', results[1][1])
+        self.assertEqual(results[2][0], 406)
+        self.assertEqual(results[3][:2], (200, b'[{"id":1},\n{"id":2}]\n'))
+        self.assertIsNotNone(results[3][2])
+        self.assertEqual(results[4][0], 504)
+    def test_segment_concurrency(self):
+        running = []
+        peak = []
+        serve_local = self.server.server.serve_local
+        def slow_serve_local(*args):
+            running.append(1)
+            peak.append(len(running))
+            try:
+                return list(serve_local(*args))
+            finally:
+                running.pop()
+        self.server.server.serve_local = slow_serve_local
+        async def read(client):
+            responses = await asyncio.gather(*[
+                client.post('/?segment=test', data=b'SELECT COUNT(*) AS n FROM test')
+                for _ in range(8)])
+            return [(r.status, await r.read()) for r in responses]
+        results = self.run_client(read)
+        self.assertEqual(results, [(200, b'[{"n":5}]\n')] * 8)
+        self.assertEqual(max(peak), 1)
+
+if __name__ == '__main__':
+    unittest.main()
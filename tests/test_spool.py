@@ -0,0 +1,130 @@
+import os
+os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.conf")
+
+import unittest
+from unittest import mock
+import fcntl
+import io
+import sqlite3
+import tempfile
+import threading
+import trough
+from trough import spool, write
+from trough.settings import settings
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.applied = []
+        self.gate = threading.Event()
+        self.gate.set()
+        def apply(segment_id, record):
+            self.gate.wait()
+            if record.body == b'bad':
+                raise Exception('bad write')
+            self.applied.append((segment_id, record.header['n'], record.body))
+        self.spooler = spool.Spooler(self.tmpdir.name, apply)
+    def tearDown(self):
+        self.gate.set()
+        self.tmpdir.cleanup()
+    def test_records(self):
+        path = os.path.join(self.tmpdir.name, 'test.spool')
+        with open(path, 'wb') as f:
+            f.write(spool.SpoolRecord({'n': 1}, b'a').encode())
+            f.write(spool.SpoolRecord({'n': 2}, b'b' * 100).encode())
+            # torn by a crash
+            f.write(spool.SpoolRecord({'n': 3}, b'c' * 100).encode()[:-1])
+        self.assertEqual(
+                [(r.header, r.body) for r in spool.read_records(path)],
+                [({'n': 1}, b'a'), ({'n': 2}, b'b' * 100)])
+    def test_append_and_flush(self):
+        self.gate.clear()
+        for n in range(3):
+            self.spooler.append('seg', {'n': n}, b'x%d' % n)
+        self.spooler.append('seg', {'n': 3}, b'bad')
+        # not applied yet, so the flush times out
+        self.assertFalse(self.spooler.flush('seg', 0.1))
+        self.gate.set()
+        self.assertTrue(self.spooler.flush('seg', 5))
+        self.assertEqual(self.applied, [('seg', 0, b'x0'), ('seg', 1, b'x1'), ('seg', 2, b'x2')])
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir.name, 'seg')), [])
+        rejected = os.path.join(self.tmpdir.name, 'seg.rejected')
+        self.assertEqual([r.body for r in spool.read_records(rejected)], [b'bad'])
+    def test_spool_full(self):
+        self.gate.clear()
+        with mock.patch.dict(settings, {'WRITE_SPOOL_MAX_BYTES': 1000}):
+            self.spooler.append('seg', {'n': 0}, b'x' * 500)
+            with self.assertRaises(spool.SpoolFull):
+                self.spooler.append('seg', {'n': 1}, b'x' * 500)
+            # other segments have spools of their own
+            self.spooler.append('other', {'n': 0}, b'x' * 500)
+        self.gate.set()
+        self.assertTrue(self.spooler.flush('seg', 5))
+        self.assertTrue(self.spooler.flush('other', 5))
+    def test_recover(self):
+        # left by a process that died, which held no lock any more
+        directory = os.path.join(self.tmpdir.name, 'seg')
+        os.makedirs(directory)
+        with open(os.path.join(directory, '1-1.spool'), 'wb') as f:
+            f.write(spool.SpoolRecord({'n': 0}, b'old').encode())
+        # written by a process that is alive
+        live = os.path.join(directory, '2-1.spool')
+        with open(live, 'wb') as f:
+            f.write(spool.SpoolRecord({'n': 1}, b'live').encode())
+        live_fd = os.open(live, os.O_RDONLY)
+        try:
+            fcntl.flock(live_fd, fcntl.LOCK_EX)
+            self.spooler.recover()
+            self.assertEqual(self.applied, [('seg', 0, b'old')])
+            self.assertEqual(os.listdir(directory), ['2-1.spool'])
+        finally:
+            os.close(live_fd)
+
+class TestAsyncWrite(unittest.TestCase):
+    def test_async_write(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.sqlite')
+            connection = sqlite3.connect(path)
+            connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, test varchar(4));')
+            connection.close()
+            with mock.patch.dict(settings, {'WRITE_SPOOL_DIR': os.path.join(tmpdir, 'spool')}), \
+                    mock.patch('trough.sync.Segment.local_path', return_value=path):
+                server = write.WriteServer()
+                segment = mock.Mock()
+                segment.id = 'test'
+                def env(body, **kwargs):
+                    env = {'wsgi.input': io.BytesIO(body), 'CONTENT_LENGTH': str(len(body))}
+                    env.update(kwargs)
+                    return env
+                # not asked for
+                self.assertFalse(server.spool(segment, {'kind': 'sql'}, env(b'SELECT 1;')))
+                self.assertTrue(server.spool(
+                        segment, {'kind': 'sql'},
+                        env(b"INSERT INTO test VALUES (1, 'a');", HTTP_X_TROUGH_ASYNC='1')))
+                with mock.patch.dict(settings, {'WRITE_ASYNC': True}):
+                    self.assertTrue(server.spool(
+                            segment, {'kind': 'bound'},
+                            env(trough.sync.encode_bound_query('INSERT INTO test VALUES (?, ?);', [2, 'b']))))
+                    self.assertTrue(server.spool(
+                            segment, {'kind': 'bulk', 'table': 'test', 'format': 'ndjson', 'columns': None},
+                            env(b'{"id": 3, "test": "c"}\n')))
+                    with self.assertRaises(trough.formats.UnsupportedFormat):
+                        server.spool(
+                                segment, {'kind': 'bulk', 'table': 'test', 'format': 'json', 'columns': None},
+                                env(b'[]'))
+                    # the retry of a write that was applied is not applied twice
+                    for i in range(2):
+                        self.assertTrue(server.spool(
+                                segment, {'kind': 'sql'},
+                                env(b"INSERT INTO test VALUES (4, 'd');", HTTP_X_TROUGH_BATCH_ID='d')))
+                self.assertTrue(server.spooler.flush('test', 5))
+                server.writers.close_all()
+            connection = sqlite3.connect(path)
+            self.assertEqual(
+                    connection.execute('SELECT * FROM test ORDER BY id').fetchall(),
+                    [(1, 'a'), (2, 'b'), (3, 'c'), (4, 'd')])
+            connection.close()
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'spool', 'test.rejected')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,11 +12,167 @@ import random
 import string
 import tempfile
 import logging
+import sqlite3
 from hdfs3 import HDFileSystem
 import pytest
 
 random_db = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
 
+class TestWriteLockView(unittest.TestCase):
+    def feed(self, *changes):
+        rethinker = mock.Mock()
+        rethinker.table.return_value.changes.return_value.run.return_value = iter(changes)
+        return rethinker
+    def test_follow_changefeed(self):
+        rethinker = self.feed(
+                {'state': 'initializing'},
+                {'new_val': {'id': 'write:lock:a', 'segment': 'a', 'node': 'n1'}},
+                {'state': 'ready'},
+                {'old_val': None, 'new_val': {'id': 'write:lock:b', 'segment': 'b', 'node': 'n2'}},
+                {'old_val': {'id': 'write:lock:a', 'segment': 'a', 'node': 'n1'}, 'new_val': None})
+        view = sync.WriteLockView(rethinker, ttl=60)
+        view.start = lambda: None
+        view._follow()
+        self.assertTrue(view.ready)
+        self.assertEqual(view.staleness(), 0.0)
+        with mock.patch.object(sync.Lock, 'load') as load:
+            self.assertIsNone(view.get('a'))
+            self.assertEqual(view.get('b')['node'], 'n2')
+            self.assertFalse(load.called)
+    def test_fallback_while_feed_down(self):
+        view = sync.WriteLockView(mock.Mock(), ttl=60)
+        view.start = lambda: None
+        with mock.patch.object(sync.Lock, 'load', return_value={'node': 'n1'}) as load:
+            self.assertEqual(view.get('a'), {'node': 'n1'})
+            self.assertEqual(view.get('a'), {'node': 'n1'})
+            self.assertEqual(load.call_count, 1)
+        self.assertEqual(view.fallback_lookups, 1)
+        self.assertGreater(view.staleness(), 0.0)
+
+class TestBoundQuery(unittest.TestCase):
+    def test_round_trip(self):
+        body = sync.encode_bound_query(
+                'SELECT * FROM foo WHERE a = ? AND b = ?', [1, b'\x00\xff'])
+        self.assertEqual(
+                sync.parse_bound_query(body),
+                ('SELECT * FROM foo WHERE a = ? AND b = ?', (1, b'\x00\xff'), None))
+        body = sync.encode_bound_query(
+                'INSERT INTO foo VALUES (:a, :b)',
+                batch=[{'a': 1, 'b': None}, {'a': 'x', 'b': 2.5}])
+        self.assertEqual(
+                sync.parse_bound_query(body),
+                ('INSERT INTO foo VALUES (:a, :b)', None,
+                 [{'a': 1, 'b': None}, {'a': 'x', 'b': 2.5}]))
+    def test_malformed(self):
+        for body in (b'[]', b'{"params": []}', b'{"sql": "x", "params": 1}',
+                     b'{"sql": "x", "params": [[1]]}',
+                     b'{"sql": "x", "params": [], "batch": []}'):
+            with self.assertRaises(ValueError):
+                sync.parse_bound_query(body)
+    def test_read_batch(self):
+        body = sync.encode_read_batch([
+            ('a', 'SELECT 1', None), (1, 'SELECT * FROM foo WHERE b = ?', [b'\x00'])])
+        self.assertEqual(sync.parse_bound_read(body), (None, None, [
+            ('a', 'SELECT 1', None), (1, 'SELECT * FROM foo WHERE b = ?', (b'\x00',))]))
+        self.assertEqual(
+                sync.parse_bound_read(sync.encode_bound_query('SELECT ?', [1])),
+                ('SELECT ?', (1,), None))
+        for body in (b'{"queries": []}', b'{"queries": ["SELECT 1"]}',
+                     b'{"sql": "x", "batch": [[1]]}'):
+            with self.assertRaises(ValueError):
+                sync.parse_bound_read(body)
+
+class TestBackupSegment(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmpdir.name, 'source.sqlite')
+        self.dest = os.path.join(self.tmpdir.name, 'dest.sqlite')
+        connection = sqlite3.connect(self.source, isolation_level=None)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, test TEXT)')
+        connection.executemany(
+                'INSERT INTO test (test) VALUES (?)', [('x' * 500,)] * 2000)
+        # a writer that stays open, as the write server's does
+        self.writer = connection
+    def tearDown(self):
+        self.writer.close()
+        self.tmpdir.cleanup()
+    def backup(self, writes):
+        def progress(stats):
+            self.progress.append(dict(stats))
+            if stats['pages_remaining'] and len(self.progress) <= writes:
+                self.writer.execute("INSERT INTO test (test) VALUES ('y')")
+                self.written += 1
+        self.progress = []
+        self.written = 0
+        with mock.patch.dict(settings, {
+                'PROMOTION_BACKUP_PAGES': 50, 'PROMOTION_BACKUP_SLEEP': 0,
+                'PROMOTION_BACKUP_MAX_RESTARTS': 3}):
+            stats = sync.backup_segment(self.source, self.dest, progress)
+        connection = sqlite3.connect(self.dest)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM test').fetchone(), (2000 + self.written,))
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone(), ('delete',))
+        self.assertEqual(connection.execute('PRAGMA integrity_check').fetchone(), ('ok',))
+        connection.close()
+        return stats
+    def test_backup(self):
+        stats = self.backup(writes=0)
+        self.assertEqual(stats['restarts'], 0)
+        self.assertEqual(stats['pages_remaining'], 0)
+        self.assertEqual(stats['steps'], -(-stats['pages_total'] // 50))
+        self.assertEqual(len(self.progress), stats['steps'])
+    def test_restarts(self):
+        # the writes between steps make the backup start over
+        stats = self.backup(writes=2)
+        self.assertEqual(stats['restarts'], 2)
+        self.assertEqual(stats['pages_remaining'], 0)
+    def test_too_many_restarts(self):
+        # the rest is copied in one step after the third restart
+        stats = self.backup(writes=1000)
+        self.assertEqual(self.written, 4)
+        self.assertEqual(stats['restarts'], 3)
+        self.assertEqual(self.progress[-1]['pages_remaining'], 0)
+        self.assertEqual(stats['steps'], 5)
+
+class TestPromotionOptions(unittest.TestCase):
+    def test_promotion_options(self):
+        self.assertEqual(
+                sync.promotion_options(),
+                {'compact': False, 'analyze': False, 'page_size': None})
+        with mock.patch.dict(settings, {'PROMOTION_COMPACT': True}):
+            # the schema's, then the request's
+            self.assertEqual(
+                    sync.promotion_options(
+                        {'page_size': 8192, 'analyze': True}, {'analyze': False}),
+                    {'compact': True, 'analyze': False, 'page_size': 8192})
+        for bad in ({'vacuum': True}, {'compact': 1}, {'page_size': 1000},
+                    {'page_size': 256}, {'page_size': True}, [('compact', True)]):
+            with self.assertRaises(sync.ClientError):
+                sync.promotion_options(bad)
+    def test_compact(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'source.sqlite')
+            connection = sqlite3.connect(source, isolation_level=None)
+            connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, test TEXT)')
+            connection.execute('CREATE INDEX test_test ON test (test)')
+            connection.executemany(
+                    'INSERT INTO test (test) VALUES (?)',
+                    [('%s' % i * 100,) for i in range(2000)])
+            connection.execute('DELETE FROM test WHERE id % 4 != 0')
+            connection.close()
+            sync.analyze_segment(source)
+            dest = os.path.join(tmpdir, 'dest.sqlite')
+            sync.compact_segment(source, dest, page_size=8192)
+            self.assertLess(os.path.getsize(dest), os.path.getsize(source) / 2)
+            connection = sqlite3.connect(dest)
+            self.assertEqual(connection.execute('PRAGMA page_size').fetchone(), (8192,))
+            self.assertEqual(connection.execute('PRAGMA freelist_count').fetchone(), (0,))
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM test').fetchone(), (500,))
+            self.assertEqual(
+                    connection.execute('SELECT tbl, idx FROM sqlite_stat1').fetchall(),
+                    [('test', 'test_test')])
+            connection.close()
+
 class TestSegment(unittest.TestCase):
     def setUp(self):
         self.rethinker = doublethink.Rethinker(db=random_db, servers=settings['RETHINKDB_HOSTS'])
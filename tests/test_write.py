@@ -3,14 +3,20 @@ os.environ['TROUGH_SETTINGS'] = os.path.join(os.path.dirname(__file__), "test.co
 
 import unittest
 from unittest import mock
+import trough
 from trough import write
 import json
 import sqlite3
+import tempfile
+import threading
+import time
 from tempfile import NamedTemporaryFile
 
 class TestWriteServer(unittest.TestCase):
     def setUp(self):
         self.server = write.WriteServer()
+    def tearDown(self):
+        self.server.writers.close_all()
     def test_empty_write(self):
         database_file = NamedTemporaryFile()
         segment = mock.Mock()
@@ -47,6 +53,302 @@ class TestWriteServer(unittest.TestCase):
             output = dict((cursor.description[i][0], value) for i, value in enumerate(row))
         database_file.close()
         self.assertEqual(output, {'id': 1, 'test': 'test'})
+    def test_write_bound(self):
+        database_file = NamedTemporaryFile()
+        segment = mock.Mock()
+        segment.local_path = lambda: database_file.name
+        self.server.write(segment, b'CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4), data blob);')
+        output = self.server.write_bound(
+                segment, 'INSERT INTO test (test, data) VALUES (?, ?);',
+                ["it's", b'\x00\x01'])
+        self.assertEqual(output, b'OK\n')
+        self.server.write_bound(
+                segment, 'INSERT INTO test (test) VALUES (:test);',
+                batch=[{'test': 'a'}, {'test': 'b'}])
+        with self.assertRaises(sqlite3.IntegrityError):
+            # the batch is one transaction, none of it is written
+            self.server.write_bound(
+                    segment, 'INSERT INTO test (id, test) VALUES (?, ?);',
+                    batch=[(10, 'c'), (1, 'd')])
+        connection = sqlite3.connect(database_file.name)
+        self.assertEqual(
+                connection.execute('SELECT id, test, data FROM test;').fetchall(),
+                [(1, "it's", b'\x00\x01'), (2, 'a', None), (3, 'b', None)])
+        connection.close()
+        database_file.close()
+    def test_writer_connection(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.sqlite')
+            segment = mock.Mock()
+            segment.local_path = lambda: path
+            self.server.write(segment, b'CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+            with self.server.writers.connection(path) as connection:
+                first = connection
+                self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone(), ('wal',))
+            self.server.write_bound(segment, 'INSERT INTO test (test) VALUES (?);', ['a'])
+            with self.server.writers.connection(path) as connection:
+                self.assertIs(connection, first)
+            # readers see committed writes while the writer is open
+            reader = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+            self.assertEqual(reader.execute('SELECT test FROM test').fetchall(), [('a',)])
+            reader.close()
+            # the sync loop swaps in a new copy of the segment, see
+            # `LocalSyncController.copy_segment_from_hdfs()`
+            replacement = os.path.join(tmpdir, 'new.sqlite')
+            connection = sqlite3.connect(replacement)
+            connection.execute('CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+            connection.commit()
+            connection.close()
+            trough.sync.remove_wal_files(path)
+            os.rename(replacement, path)
+            self.server.write_bound(segment, 'INSERT INTO test (test) VALUES (?);', ['b'])
+            self.server.writers.close(path)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['test.sqlite'])
+            connection = sqlite3.connect(path)
+            self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone(), ('delete',))
+            self.assertEqual(connection.execute('SELECT test FROM test').fetchall(), [('b',)])
+            connection.close()
+    def test_split_statements(self):
+        self.assertEqual(
+                write.split_statements("INSERT INTO t VALUES ('a;b'); -- c;\nDELETE FROM t"),
+                ["INSERT INTO t VALUES ('a;b');", " -- c;\nDELETE FROM t"])
+        self.assertEqual(write.split_statements('  '), [])
+        script = (b"INSERT INTO t VALUES ('a;b''c'); /* d; */ SELECT [e;f];\n"
+                  b"CREATE TRIGGER g AFTER INSERT ON t BEGIN DELETE FROM t; END; -- h;")
+        # whatever the chunks the script arrives in
+        for size in (1, 2, 3, 7, len(script)):
+            self.assertEqual(
+                    list(write.iter_statements(
+                        script[i:i+size] for i in range(0, len(script), size))),
+                    ["INSERT INTO t VALUES ('a;b''c');",
+                     ' /* d; */ SELECT [e;f];',
+                     '\nCREATE TRIGGER g AFTER INSERT ON t BEGIN DELETE FROM t; END;',
+                     ' -- h;'])
+    def test_streamed_write(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.sqlite')
+            segment = mock.Mock()
+            segment.local_path = lambda: path
+            self.server.write(segment, b'CREATE TABLE test (id INTEGER PRIMARY KEY, test varchar(4));;')
+            script = lambda ids: b''.join(
+                    b"INSERT INTO test VALUES (%d, 'x;y');\n" % i for i in ids)
+            chunks = lambda script: (script[i:i+50] for i in range(0, len(script), 50))
+            with mock.patch.dict(trough.settings.settings, {'WRITE_STREAM_BUFFER_BYTES': 200}):
+                self.assertEqual(self.server.write(segment, chunks(script(range(100)))), b'OK\n')
+                # one transaction: none of it is written
+                with self.assertRaises(sqlite3.IntegrityError):
+                    self.server.write(segment, chunks(script([100, 101, 0, 102])))
+                with mock.patch.dict(trough.settings.settings, {'WRITE_STREAM_COMMIT_CHUNKS': True}):
+                    # committed in chunks of 200 bytes, 6 statements
+                    with self.assertRaisesRegex(Exception, 'stopped after 12 statements'):
+                        self.server.write(segment, chunks(script(
+                            list(range(200, 212)) + [0, 212])))
+            connection = sqlite3.connect(path)
+            self.assertEqual(
+                    connection.execute('SELECT count(*), max(id) FROM test').fetchone(),
+                    (112, 211))
+            connection.close()
+    def test_streamed_write_read_before_group_commit(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.sqlite')
+            segment = mock.Mock()
+            segment.local_path = lambda: path
+            self.server.write(segment, b'CREATE TABLE test (id INTEGER PRIMARY KEY, test varchar(4));;')
+            read = []
+            def body():
+                for i in range(100):
+                    read.append(i)
+                    yield b"INSERT INTO test VALUES (%d, '\xc3\xa9;');\n" % i
+            run = self.server.writers.run
+            def check_run(path, job, size, statements):
+                # the body is read in the request's thread, not in the group
+                # commit's
+                self.assertEqual(len(read), 100)
+                self.assertEqual(statements, 100)
+                return run(path, job, size, statements)
+            with mock.patch.dict(trough.settings.settings, {'WRITE_STREAM_BUFFER_BYTES': 200}), \
+                    mock.patch.object(self.server.writers, 'run', side_effect=check_run):
+                self.assertEqual(self.server.write(segment, body()), b'OK\n')
+            connection = sqlite3.connect(path)
+            self.assertEqual(
+                    connection.execute('SELECT count(*), max(id), min(test) FROM test').fetchone(),
+                    (100, 99, '\xe9;'))
+            connection.close()
+    def test_group_commit(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.sqlite')
+            segment = mock.Mock()
+            segment.local_path = lambda: path
+            self.server.write(segment, b'CREATE TABLE test (id INTEGER PRIMARY KEY, test varchar(4));')
+            metrics = trough.metrics.registry
+            writer = self.server.writers.writer(path)
+            errors = {}
+            def run(i):
+                try:
+                    if i == 3:
+                        # fails after its first insert, which is rolled back
+                        self.server.write(segment, b"INSERT INTO test VALUES (103, 'x'); INSERT INTO test VALUES (1, 'dup');")
+                    elif i == 4:
+                        self.server.write(segment, b'COMMIT;')
+                    else:
+                        self.server.write_bound(segment, 'INSERT INTO test VALUES (?, ?);', [i, str(i)])
+                except Exception as e:
+                    errors[i] = e
+            # pose as a commit in progress, so that the writes queue up and
+            # then commit together
+            with writer.cond:
+                writer.leading = True
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            while len(writer.queue) < 8:
+                time.sleep(0.01)
+            with writer.cond:
+                writer.leading = False
+                writer.cond.notify_all()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(sorted(errors), [3, 4])
+            self.assertIsInstance(errors[3], sqlite3.IntegrityError)
+            self.assertIsInstance(errors[4], sqlite3.DatabaseError)
+            connection = sqlite3.connect(path)
+            self.assertEqual(
+                    [row[0] for row in connection.execute('SELECT id FROM test ORDER BY id')],
+                    [0, 1, 2, 5, 6, 7])
+            connection.close()
+            samples = {name: values for name, _, _, values in metrics.samples()}
+            self.assertEqual(samples['trough_write_group_commit_size'][()].counts[3], 1)
+    def test_group_commit_concurrent_writer(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.sqlite')
+            segment = mock.Mock()
+            segment.local_path = lambda: path
+            self.server.write(segment, b'CREATE TABLE test (id INTEGER PRIMARY KEY, test varchar(4));')
+            # another process writing to the segment
+            other = sqlite3.connect(path, isolation_level=None)
+            other.execute('BEGIN IMMEDIATE')
+            other.execute("INSERT INTO test VALUES (1, 'a')")
+            errors = []
+            def run():
+                try:
+                    # reads before it writes, so in a deferred transaction
+                    # it would read the snapshot that the commit below makes
+                    # stale, and fail at once instead of waiting its turn
+                    self.server.write(segment, b"SELECT COUNT(*) FROM test; INSERT INTO test VALUES (2, 'b');")
+                except Exception as e:
+                    errors.append(e)
+            thread = threading.Thread(target=run)
+            thread.start()
+            time.sleep(0.2)
+            other.execute('COMMIT')
+            other.close()
+            thread.join()
+            self.assertEqual(errors, [])
+            connection = sqlite3.connect(path)
+            self.assertEqual(
+                    [row[0] for row in connection.execute('SELECT id FROM test ORDER BY id')],
+                    [1, 2])
+            connection.close()
+    def test_bulk_insert(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.sqlite')
+            segment = mock.Mock()
+            segment.local_path = lambda: path
+            self.server.write(segment, b'CREATE TABLE test (id INTEGER PRIMARY KEY, test varchar(4), data blob);')
+            body = b'{"id": 1, "test": "a", "data": {"blob": "AAE="}}\n{"id": 2}\n'
+            # chunks split mid row
+            self.assertEqual(self.server.bulk_insert(
+                segment, 'test', 'ndjson', [body[:10], body[10:]]), 2)
+            self.assertEqual(self.server.bulk_insert(
+                segment, 'test', 'csv', [b'test,id\nb,3\n"c,\n', b'd",4\n']), 2)
+            with mock.patch.dict(trough.settings.settings, {'WRITE_BULK_CHUNK_ROWS': 2}):
+                with self.assertRaisesRegex(Exception, 'stopped after 2 rows'):
+                    self.server.bulk_insert(
+                        segment, 'test', 'ndjson',
+                        [b'{"id": 5}\n{"id": 6}\n{"id": 7}\n{"id": 1}\n'])
+            with self.assertRaisesRegex(Exception, 'not in'):
+                self.server.bulk_insert(
+                        segment, 'test', 'ndjson', [b'{"id": 8}\n{"nope": 9}\n'])
+            connection = sqlite3.connect(path)
+            self.assertEqual(
+                    connection.execute('SELECT id, test, data FROM test ORDER BY id').fetchall(),
+                    [(1, 'a', b'\x00\x01'), (2, None, None), (3, 'b', None),
+                     (4, 'c,\nd', None), (5, None, None), (6, None, None)])
+            connection.close()
+    def test_write_batch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.sqlite')
+            segment = mock.Mock()
+            segment.local_path = lambda: path
+            self.server.write(segment, b'CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+            # the retry of a write that was applied is skipped
+            for i in range(2):
+                write_batch = write.WriteBatch('a')
+                self.server.write(segment, b"INSERT INTO test (test) VALUES ('a');", write_batch)
+                self.assertEqual(write_batch.duplicates, i)
+            write_batch = write.WriteBatch('b')
+            self.server.write_bound(segment, 'INSERT INTO test (test) VALUES (?);', ['b'], write_batch=write_batch)
+            self.assertEqual(write_batch.duplicates, 0)
+            # the retry of a bulk insert that failed part way resumes where
+            # it stopped
+            body = lambda last: [b''.join(b'{"test": "c%d"}\n' % i for i in range(4)) + last]
+            with mock.patch.dict(trough.settings.settings, {'WRITE_BULK_CHUNK_ROWS': 2}):
+                with self.assertRaisesRegex(Exception, 'stopped after 4 rows'):
+                    self.server.bulk_insert(
+                            segment, 'test', 'ndjson', body(b'{"nope": 1}\n'),
+                            write_batch=write.WriteBatch('c'))
+                write_batch = write.WriteBatch('c')
+                self.assertEqual(self.server.bulk_insert(
+                        segment, 'test', 'ndjson', body(b'{"test": "c4"}\n'),
+                        write_batch=write_batch), 5)
+                self.assertEqual(write_batch.duplicates, 2)
+            connection = sqlite3.connect(path)
+            self.assertEqual(
+                    [row[0] for row in connection.execute('SELECT test FROM test ORDER BY id')],
+                    ['a', 'b', 'c0', 'c1', 'c2', 'c3', 'c4'])
+            self.assertEqual(
+                    sorted(row[0] for row in connection.execute('SELECT id FROM _trough_batches')),
+                    ['a', 'b', 'c#0', 'c#2', 'c#4'])
+            connection.close()
+    def test_write_batch_concurrent_workers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.sqlite')
+            segment = mock.Mock()
+            segment.local_path = lambda: path
+            self.server.write(segment, b'CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, test varchar(4));')
+            # a second worker process, with a writer connection of its own
+            other_server = write.WriteServer()
+            # and a third one, in the middle of a write
+            other = sqlite3.connect(path, isolation_level=None)
+            other.execute('BEGIN IMMEDIATE')
+            other.execute("INSERT INTO test (test) VALUES ('x')")
+            batches, errors = [], []
+            def run(server):
+                # a write and its retry, sent to different workers
+                write_batch = write.WriteBatch('a')
+                try:
+                    server.write(segment, b"INSERT INTO test (test) VALUES ('a');", write_batch)
+                    batches.append(write_batch)
+                except Exception as e:
+                    errors.append(e)
+            threads = [
+                threading.Thread(target=run, args=(server,))
+                for server in (self.server, other_server)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.2)
+            other.execute('COMMIT')
+            other.close()
+            for thread in threads:
+                thread.join()
+            other_server.writers.close_all()
+            self.assertEqual(errors, [])
+            self.assertEqual(sorted(b.duplicates for b in batches), [0, 1])
+            connection = sqlite3.connect(path)
+            self.assertEqual(
+                    [row[0] for row in connection.execute('SELECT test FROM test ORDER BY id')],
+                    ['x', 'a'])
+            connection.close()
     def test_write_failure_to_read_only_segment(self):
         database_file = NamedTemporaryFile()
         segment = mock.Mock()
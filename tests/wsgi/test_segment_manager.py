@@ -210,6 +210,26 @@ def test_schemas(segment_manager_server):
     result_bytes = b''.join(result.response)
     assert result_bytes == b'create table schema2_table (foo varchar(100));'
 
+    # schema with promotion options
+    result = segment_manager_server.put(
+            '/schema/schema3', content_type='applicaton/sql',
+            data=ujson.dumps({
+                'id': 'schema3', 'sql': 'create table schema3_table (foo varchar(100));',
+                'promotion': {'compact': True, 'page_size': 8192}}))
+    assert result.status_code == 201
+    result = segment_manager_server.get('/schema/schema3')
+    result_dict = ujson.loads(b''.join(result.response))
+    assert result_dict['promotion'] == {'compact': True, 'page_size': 8192}
+    result = segment_manager_server.put(
+            '/schema/schema3', content_type='applicaton/sql',
+            data=ujson.dumps({
+                'id': 'schema3', 'sql': 'create table schema3_table (foo varchar(100));',
+                'promotion': {'page_size': 1000}}))
+    assert result.status_code == 400
+    assert b''.join(result.response) == (
+            b'promotion option page_size must be a power of two from 512 '
+            b'to 65536, not 1000')
+
     # updated list of schemas
     result = segment_manager_server.get('/schema')
     assert result.status_code == 200
@@ -297,7 +317,8 @@ def test_promotion(segment_manager_server):
     assert result.mimetype == 'application/json'
     result_bytes = b''.join(result.response)
     result_dict = ujson.loads(result_bytes)
-    assert result_dict == {'remote_path': expected_remote_path}
+    assert result_dict['remote_path'] == expected_remote_path
+    assert result_dict['backup']['pages_remaining'] == 0
 
     # make sure it doesn't think the segment is under promotion
     rethinker = doublethink.Rethinker(
@@ -305,6 +326,13 @@ def test_promotion(segment_manager_server):
     query = rethinker.table('lock').get('write:lock:test_promotion')
     result = query.run()
     assert not result.get('under_promotion')
+    result = segment_manager_server.get('/promote/test_promotion')
+    assert result.status_code == 200
+    status = ujson.loads(b''.join(result.response))
+    assert status['under_promotion'] is False
+    assert status['promotion']['stage'] == 'done'
+    assert status['promotion']['pages_remaining'] == 0
+    assert segment_manager_server.get('/promote/no_such_segment').status_code == 404
 
     # let's see if it's hdfs
     listing_after_promotion = hdfs.ls(expected_remote_path, detail=True)
@@ -312,7 +340,7 @@ def test_promotion(segment_manager_server):
     assert listing_after_promotion[0]['last_mod'] > before
 
     # grab the file from hdfs and check the content
-    # n.b. copy created by sqlitebck may have different size, sha1 etc from orig
+    # n.b. copy created by the online backup may have different size, sha1 etc from orig
     size = None
     with tempfile.TemporaryDirectory() as tmpdir:
         local_copy = os.path.join(tmpdir, 'test_promotion.sqlite')
@@ -343,7 +371,8 @@ def test_promotion(segment_manager_server):
     assert result.mimetype == 'application/json'
     result_bytes = b''.join(result.response)
     result_dict = ujson.loads(result_bytes)
-    assert result_dict == {'remote_path': expected_remote_path}
+    assert result_dict['remote_path'] == expected_remote_path
+    assert result_dict['backup']['pages_remaining'] == 0
 
     # make sure it doesn't think the segment is under promotion
     rethinker = doublethink.Rethinker(
@@ -357,6 +386,28 @@ def test_promotion(segment_manager_server):
     assert len(listing_after_promotion) == 1
     assert listing_after_promotion[0]['last_mod'] > before
 
+    # promote a compacted, analyzed copy
+    result = segment_manager_server.post(
+            '/promote', content_type='application/json',
+            data=ujson.dumps({
+                'segment': 'test_promotion', 'compact': True, 'analyze': True}))
+    assert result.status_code == 200
+    result_dict = ujson.loads(b''.join(result.response))
+    assert result_dict['options'] == {'compact': True, 'analyze': True, 'page_size': None}
+    assert result_dict['bytes_saved'] == result_dict['size'] - result_dict['promoted_size']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        local_copy = os.path.join(tmpdir, 'test_promotion.sqlite')
+        hdfs.get(expected_remote_path, local_copy)
+        conn = sqlite3.connect(local_copy)
+        assert conn.execute('pragma freelist_count').fetchone() == (0,)
+        conn.close()
+
+    # bad promotion option
+    result = segment_manager_server.post(
+            '/promote', content_type='application/json',
+            data=ujson.dumps({'segment': 'test_promotion', 'compact': 'yes'}))
+    assert result.status_code == 400
+
     # pretend the segment is under promotion
     rethinker.table('lock')\
             .get('write:lock:test_promotion')\
@@ -419,7 +470,8 @@ def test_delete_segment(segment_manager_server):
     assert result.mimetype == 'application/json'
     result_bytes = b''.join(result.response)
     result_dict = ujson.loads(result_bytes)
-    assert result_dict == {'remote_path': expected_remote_path}
+    assert result_dict['remote_path'] == expected_remote_path
+    assert result_dict['backup']['pages_remaining'] == 0
 
     # let's see if it's hdfs
     hdfs_ls = hdfs.ls(expected_remote_path, detail=True)
@@ -476,3 +528,28 @@ def test_delete_segment(segment_manager_server):
     with pytest.raises(FileNotFoundError):
         hdfs_ls = hdfs.ls(expected_remote_path, detail=True)
 
+
+def test_fanout_query_bad_requests(segment_manager_server):
+    result = segment_manager_server.post(
+            '/query', content_type='application/json',
+            data=ujson.dumps({'segments': ['x']}))
+    assert result.status_code == 400
+
+    result = segment_manager_server.post(
+            '/query', content_type='application/json',
+            data=ujson.dumps({'sql': 'select 1', 'segments': ['x'], 'regex': '.*'}))
+    assert result.status_code == 400
+
+    result = segment_manager_server.post(
+            '/query', content_type='application/json',
+            data=ujson.dumps({'sql': 'select x from y order by x + 1', 'segments': []}))
+    assert result.status_code == 400
+    assert b'ORDER BY' in b''.join(result.response)
+
+    result = segment_manager_server.post(
+            '/query', content_type='application/json',
+            data=ujson.dumps({'sql': 'select 1', 'segments': []}))
+    assert result.status_code == 200
+    assert ujson.loads(b''.join(result.response)) == {
+        'columns': [], 'rows': [], 'errors': {},
+        'segments': {'queried': 0, 'succeeded': 0, 'failed': 0, 'cancelled': 0}}
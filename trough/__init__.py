@@ -1,4 +1,4 @@
-from . import settings, read, write, sync
+from . import settings, metrics, cache, formats, compression, read, spool, write, sync, fanout, aggregate
 
 # monkey-patch log level TRACE
 import logging
@@ -0,0 +1,320 @@
+'''
+trough/aggregate.py - partial aggregate pushdown for multi-segment queries
+
+An aggregate query run over many segments, like
+
+    SELECT host, COUNT(*), AVG(size) FROM crawled_url GROUP BY host
+
+is rewritten so that each segment computes partial aggregates,
+
+    SELECT host AS _trough_g0, COUNT(*) AS _trough_a0, TOTAL(size) AS _trough_a1,
+           COUNT(size) AS _trough_a2, COUNT(*) AS _trough_rows
+    FROM crawled_url GROUP BY _trough_g0
+
+and the partials are combined as they come in: counts and sums are added,
+MIN/MAX are compared in sqlite's sort order, and AVG is SUM / COUNT. Only
+the combined groups are held in memory, never all the segments' rows.
+
+Supported: a plain SELECT (no DISTINCT, compound selects or HAVING) whose
+result columns are COUNT/SUM/TOTAL/MIN/MAX/AVG calls (without DISTINCT) and
+GROUP BY terms. A top-level ORDER BY on result columns and LIMIT/OFFSET are
+applied after combining. Anything else raises `Unsupported`.
+'''
+import re
+from trough.fanout import (
+        top_level_words, split_terms, OrderTerm, Descending, FanoutError)
+import ujson
+
+class Unsupported(Exception):
+    pass
+
+AGGREGATES = ('COUNT', 'SUM', 'TOTAL', 'MIN', 'MAX', 'AVG')
+
+_CALL_RE = re.compile(r'^(?P<fn>\w+)\s*\((?P<arg>.*)\)$', re.DOTALL)
+_ALIAS_RE = re.compile(
+        r'^(?P<expr>.*?\S)\s+(?:AS\s+)?(?P<alias>[A-Za-z_]\w*|"[^"]+"|`[^`]+`|\[[^\]]+\])$',
+        re.IGNORECASE | re.DOTALL)
+
+def _normalize(expr):
+    return re.sub(r'\s+', ' ', expr.strip()).lower()
+
+def _balanced(text):
+    depth = 0
+    for c in text:
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+def _aggregate_call(expr):
+    '''Returns `(FUNCTION, argument)` if `expr` is a call to a supported
+    aggregate function, else None.'''
+    m = _CALL_RE.match(expr.strip())
+    if not m or m.group('fn').upper() not in AGGREGATES:
+        return None
+    fn, arg = m.group('fn').upper(), m.group('arg').strip()
+    if not _balanced(arg):
+        # like COUNT(a) + SUM(b)
+        return None
+    if re.match(r'^DISTINCT\b', arg, re.IGNORECASE):
+        raise Unsupported('%s(DISTINCT ...) can not be combined across segments' % fn)
+    if len(split_terms(arg)) != 1:
+        # MIN(a, b) and MAX(a, b) are scalar functions
+        return None
+    if arg == '*' and fn != 'COUNT':
+        return None
+    return fn, arg
+
+def _sqlite_key(value):
+    '''Sort key for a value in sqlite's order: NULL, numbers, text.'''
+    if value is None:
+        return (0,)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, value)
+
+class _Aggregate:
+    def __init__(self, fn, arg, partials):
+        self.fn = fn
+        self.arg = arg
+        # indexes of this aggregate's partial columns in the segment rows
+        self.partials = partials
+
+    def initial(self):
+        if self.fn == 'COUNT':
+            return 0
+        elif self.fn == 'TOTAL':
+            return 0.0
+        elif self.fn == 'AVG':
+            return [0.0, 0]
+        return None
+
+    def combine(self, state, row):
+        value = row[self.partials[0]]
+        if self.fn == 'COUNT':
+            return state + value
+        elif self.fn == 'TOTAL':
+            return state + value
+        elif self.fn == 'SUM':
+            if value is None:
+                return state
+            return value if state is None else state + value
+        elif self.fn == 'MIN':
+            if value is None or (state is not None and _sqlite_key(state) <= _sqlite_key(value)):
+                return state
+            return value
+        elif self.fn == 'MAX':
+            if value is None or (state is not None and _sqlite_key(state) >= _sqlite_key(value)):
+                return state
+            return value
+        elif self.fn == 'AVG':
+            state[0] += value
+            state[1] += row[self.partials[1]]
+            return state
+
+    def final(self, state):
+        if self.fn == 'AVG':
+            return state[0] / state[1] if state[1] else None
+        return state
+
+class AggregateQuery:
+    '''
+    A supported aggregate query (raises `Unsupported` otherwise).
+    `segment_sql` is the partial aggregate query to run on each segment; feed
+    each segment's result rows (dicts or sequences, in `segment_sql` column
+    order) to `add()`, then call `result()`.
+    '''
+    def __init__(self, sql):
+        self.sql = sql
+        self._parse(sql.strip().rstrip(';').rstrip())
+        self.groups = {}
+        self.segments = 0
+        self.rows_aggregated = 0
+        self.rows_received = 0
+        self.bytes_received = 0
+        self.bytes_json_equivalent = 0
+
+    def _parse(self, sql):
+        words = list(top_level_words(sql))
+        if not words or words[0][2] != 'SELECT':
+            raise Unsupported('not a plain SELECT')
+        positions = {}
+        for i, (start, end, word) in enumerate(words):
+            if word in ('DISTINCT', 'HAVING', 'UNION', 'INTERSECT', 'EXCEPT', 'WINDOW', 'VALUES'):
+                raise Unsupported('%s can not be combined across segments' % word)
+            if word in ('FROM', 'LIMIT') and word not in positions:
+                positions[word] = i
+            elif word in ('GROUP', 'ORDER') and i + 1 < len(words) \
+                    and words[i+1][2] == 'BY' and word not in positions:
+                positions[word] = i
+        if 'FROM' not in positions:
+            raise Unsupported('no FROM clause')
+        clause_ends = sorted(
+                words[i][0] for w, i in positions.items() if w != 'FROM')
+        def clause(word, skip=0):
+            i = positions[word]
+            start = words[i + skip][1]
+            ends = [e for e in clause_ends if e > start]
+            return sql[start:ends[0] if ends else len(sql)].strip()
+        select_list = sql[words[0][1]:words[positions['FROM']][0]]
+        from_clause = 'FROM ' + clause('FROM', skip=0)
+        group_terms = split_terms(clause('GROUP', 1)) if 'GROUP' in positions else []
+        order_clause = clause('ORDER', 1) if 'ORDER' in positions else None
+        limit_clause = clause('LIMIT') if 'LIMIT' in positions else None
+
+        items = []
+        for item in split_terms(select_list):
+            if not item:
+                raise Unsupported('empty result column')
+            items.append(self._parse_item(item))
+        aliases = {_normalize(alias): i for i, (expr, alias, call) in enumerate(items) if alias}
+
+        # resolve group by terms to expressions
+        group_exprs = []
+        for term in group_terms:
+            if term.isdigit():
+                index = int(term) - 1
+                if not 0 <= index < len(items) or items[index][2]:
+                    raise Unsupported('GROUP BY %s' % term)
+                group_exprs.append(items[index][0])
+            elif _normalize(term) in aliases and not items[aliases[_normalize(term)]][2]:
+                group_exprs.append(items[aliases[_normalize(term)]][0])
+            else:
+                group_exprs.append(term)
+        normalized_groups = [_normalize(expr) for expr in group_exprs]
+
+        partial_columns = [
+                '%s AS _trough_g%d' % (expr, i) for i, expr in enumerate(group_exprs)]
+        self.columns = []
+        # for each result column: ('group', index) or ('aggregate', _Aggregate)
+        self._outputs = []
+        has_aggregate = False
+        for expr, alias, call in items:
+            self.columns.append(alias.strip('"`[]') if alias else expr)
+            if call:
+                has_aggregate = True
+                fn, arg = call
+                partials = []
+                parts = [('TOTAL', arg), ('COUNT', arg)] if fn == 'AVG' else [(fn, arg)]
+                for part_fn, part_arg in parts:
+                    partials.append(len(partial_columns))
+                    partial_columns.append('%s(%s) AS _trough_a%d' % (
+                        part_fn, part_arg, len(partial_columns) - len(group_exprs)))
+                self._outputs.append(('aggregate', _Aggregate(fn, arg, partials)))
+            elif _normalize(expr) in normalized_groups:
+                self._outputs.append(('group', normalized_groups.index(_normalize(expr))))
+            else:
+                raise Unsupported(
+                        'result column %r is neither an aggregate nor a '
+                        'GROUP BY term' % expr)
+        if not has_aggregate:
+            raise Unsupported('no aggregates to push down')
+        self._rows_column = len(partial_columns)
+        partial_columns.append('COUNT(*) AS _trough_rows')
+        self._n_groups = len(group_exprs)
+
+        self._partial_names = [c.rsplit(' AS ', 1)[1] for c in partial_columns]
+        self.segment_sql = 'SELECT %s %s' % (', '.join(partial_columns), from_clause)
+        if group_exprs:
+            self.segment_sql += ' GROUP BY %s' % ', '.join(
+                    '_trough_g%d' % i for i in range(len(group_exprs)))
+
+        try:
+            self.order_terms = [OrderTerm(t) for t in split_terms(order_clause)] if order_clause else []
+            self.order_indexes = [t.index(self.columns) for t in self.order_terms]
+        except FanoutError as e:
+            raise Unsupported(str(e))
+        self.limit = None
+        self.offset = 0
+        if limit_clause:
+            m = re.match(
+                    r'^(\d+)(?:\s*(,|OFFSET)\s*(\d+))?$', limit_clause,
+                    re.IGNORECASE)
+            if not m:
+                raise Unsupported('LIMIT and OFFSET must be integer literals')
+            if m.group(2) == ',':
+                self.offset, self.limit = int(m.group(1)), int(m.group(3))
+            else:
+                self.limit, self.offset = int(m.group(1)), int(m.group(3) or 0)
+
+    def _parse_item(self, item):
+        '''Returns `(expr, alias, aggregate call or None)`.'''
+        call = _aggregate_call(item)
+        if call or not _ALIAS_RE.match(item):
+            return item, None, call
+        m = _ALIAS_RE.match(item)
+        expr = m.group('expr')
+        if re.search(r'\bAS$', expr, re.IGNORECASE) or not _balanced(expr):
+            return item, None, None
+        return expr, m.group('alias'), _aggregate_call(expr)
+
+    def add(self, rows, size=None):
+        '''Combines one segment's partial aggregate rows. `size` is the size
+        in bytes of the response they came in, for `stats()`.'''
+        self.segments += 1
+        if size is not None:
+            self.bytes_received += size
+        for row in rows:
+            if isinstance(row, dict):
+                row = tuple(row.values())
+            self.rows_received += 1
+            self.rows_aggregated += row[self._rows_column]
+            if not row[self._rows_column]:
+                # COUNT(*) with no GROUP BY on an empty segment
+                continue
+            # the same rows as json objects, the default result format
+            self.bytes_json_equivalent += len(ujson.dumps(
+                dict(zip(self._partial_names, row)),
+                escape_forward_slashes=False)) + 2
+            key = row[:self._n_groups]
+            states = self.groups.get(key)
+            if states is None:
+                states = self.groups[key] = [
+                        output.initial() if kind == 'aggregate' else None
+                        for kind, output in self._outputs]
+            for i, (kind, output) in enumerate(self._outputs):
+                if kind == 'aggregate':
+                    states[i] = output.combine(states[i], row)
+
+    def result(self):
+        '''Returns the combined result, a list of dicts.'''
+        groups = self.groups
+        if not groups and not self._n_groups:
+            # an aggregate without GROUP BY always returns one row
+            groups = {(): [
+                output.initial() if kind == 'aggregate' else None
+                for kind, output in self._outputs]}
+        rows = []
+        for key, states in groups.items():
+            rows.append([
+                output.final(states[i]) if kind == 'aggregate' else key[output]
+                for i, (kind, output) in enumerate(self._outputs)])
+        if self.order_terms:
+            rows.sort(key=lambda row: tuple(
+                Descending(term.key(row[i])) if term.descending else term.key(row[i])
+                for term, i in zip(self.order_terms, self.order_indexes)))
+        if self.limit is not None:
+            rows = rows[self.offset:self.offset + self.limit]
+        elif self.offset:
+            rows = rows[self.offset:]
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def stats(self):
+        '''
+        What pushdown saved on this query: `rows_aggregated` rows were
+        aggregated on the segments, and only `rows_received` partial
+        aggregate rows (`bytes_received` bytes, or `bytes_json_equivalent` in
+        the default json format) came back. The coordinator held at most
+        `groups_held` combined groups, instead of every segment's rows.
+        '''
+        return {
+            'segments': self.segments,
+            'rows_aggregated': self.rows_aggregated,
+            'rows_received': self.rows_received,
+            'bytes_received': self.bytes_received,
+            'bytes_json_equivalent': self.bytes_json_equivalent,
+            'groups_held': len(self.groups),
+        }
@@ -0,0 +1,239 @@
+'''
+trough/cache.py - query result cache for read nodes
+
+Serialized query results are kept in a small sqlite database on local disk,
+so that all uWSGI worker processes on a read node share one copy of each
+result. Entries are keyed on the segment id, the identity (inode and mtime) of
+the segment file the result was computed from, and the normalized sql, so a
+segment file that gets replaced by the sync loop can never serve stale
+results.
+'''
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from trough.settings import settings
+
+# queries calling these are not cached, they can return something different
+# every time they are run against the same file
+NONDETERMINISTIC_RE = re.compile(
+        r"\b(random|randomblob|changes|total_changes|last_insert_rowid)\s*\("
+        r"|\bcurrent_(date|time|timestamp)\b|'now'", re.IGNORECASE)
+
+SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS result (
+    key TEXT PRIMARY KEY,
+    segment TEXT NOT NULL,
+    identity TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    body BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS result_segment ON result (segment);
+CREATE INDEX IF NOT EXISTS result_last_access ON result (last_access);
+CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY, bytes INTEGER NOT NULL);
+INSERT OR IGNORE INTO total (id, bytes) VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS result_insert AFTER INSERT ON result BEGIN
+    UPDATE total SET bytes = bytes + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS result_delete AFTER DELETE ON result BEGIN
+    UPDATE total SET bytes = bytes - OLD.size WHERE id = 0;
+END;
+'''
+
+def normalize_sql(sql):
+    '''
+    Normalizes `sql` for use in a cache key: comments are dropped, runs of
+    whitespace outside of quoted strings and identifiers are collapsed to a
+    single space, and leading/trailing whitespace and semicolons are
+    stripped. Quoted text is left untouched.
+    '''
+    out = []
+    i = 0
+    n = len(sql)
+    pending_space = False
+    closing = {"'": "'", '"': '"', '`': '`', '[': ']'}
+    while i < n:
+        c = sql[i]
+        if c in closing:
+            end = sql.find(closing[c], i + 1)
+            # a doubled quote is an escaped quote, keep going
+            while end != -1 and closing[c] != ']' and sql[end+1:end+2] == closing[c]:
+                end = sql.find(closing[c], end + 2)
+            end = n if end == -1 else end + 1
+            token = sql[i:end]
+            i = end
+        elif sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = n if end == -1 else end + 1
+            pending_space = True
+            continue
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+            pending_space = True
+            continue
+        elif c.isspace():
+            pending_space = True
+            i += 1
+            continue
+        else:
+            token = c
+            i += 1
+        if pending_space and out:
+            out.append(' ')
+        pending_space = False
+        out.append(token)
+    return ''.join(out).strip().rstrip(';').rstrip()
+
+class ResultCache:
+    '''
+    LRU cache of serialized query results with a total size budget
+    (`max_bytes`) and a per-entry size cap (`max_entry_bytes`), stored in the
+    sqlite database at `path`.
+
+    The cache is strictly best effort: if the cache database is busy or
+    broken, lookups miss and stores are skipped rather than failing the
+    query.
+    '''
+    # don't rewrite last_access on every hit, it would turn every read into
+    # a write
+    TOUCH_INTERVAL = 10.0
+
+    def __init__(self, path=None, max_bytes=None, max_entry_bytes=None):
+        self.path = path or settings['READ_RESULT_CACHE_PATH']
+        self.max_bytes = int(max_bytes or settings['READ_RESULT_CACHE_BYTES'])
+        self.max_entry_bytes = int(
+                max_entry_bytes or settings['READ_RESULT_CACHE_MAX_ENTRY_BYTES'])
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                    self.path, timeout=0.1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA_SQL)
+            self._local.connection = connection
+        return connection
+
+    def _discard_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except:
+                pass
+
+    def _count(self, attr, n=1):
+        with self._stats_lock:
+            setattr(self, attr, getattr(self, attr) + n)
+
+    def cacheable(self, sql):
+        return not NONDETERMINISTIC_RE.search(sql)
+
+    def key(self, segment_id, identity, sql, variant='', params=None):
+        h = hashlib.sha1()
+        for part in (segment_id, repr(identity), variant, normalize_sql(sql),
+                     repr(params)):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def get(self, segment_id, identity, sql, variant='', params=None):
+        '''Returns the cached result body (bytes), or None. `variant`
+        distinguishes different encodings of the same result, `params` are
+        the bound query parameters, if any.'''
+        key = self.key(segment_id, identity, sql, variant, params)
+        try:
+            connection = self._connection()
+            row = connection.execute(
+                    'SELECT body, last_access FROM result WHERE key = ?',
+                    (key,)).fetchone()
+            if row and time.time() - row[1] > self.TOUCH_INTERVAL:
+                connection.execute(
+                        'UPDATE result SET last_access = ? WHERE key = ?',
+                        (time.time(), key))
+        except sqlite3.Error as e:
+            logging.warning('result cache lookup failed: %s', e)
+            self._discard_connection()
+            row = None
+        if row:
+            self._count('hits')
+            return bytes(row[0])
+        self._count('misses')
+        return None
+
+    def put(self, segment_id, identity, sql, body, variant='', params=None):
+        '''
+        Stores `body`, unless it is over the per-entry size cap. Entries for
+        other versions of the segment file are dropped, and least recently
+        used entries are evicted until the cache fits its budget.
+        '''
+        if len(body) > self.max_entry_bytes or len(body) > self.max_bytes:
+            return False
+        key = self.key(segment_id, identity, sql, variant, params)
+        try:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute(
+                        'DELETE FROM result WHERE segment = ? AND identity != ?',
+                        (segment_id, repr(identity)))
+                # plain INSERT after DELETE, rather than INSERT OR REPLACE,
+                # which would not fire the delete trigger
+                connection.execute('DELETE FROM result WHERE key = ?', (key,))
+                connection.execute(
+                        'INSERT INTO result '
+                        '(key, segment, identity, size, last_access, body) '
+                        'VALUES (?, ?, ?, ?, ?, ?)', (
+                            key, segment_id, repr(identity), len(body),
+                            time.time(), body))
+                evicted = 0
+                while connection.execute(
+                        'SELECT bytes FROM total WHERE id = 0').fetchone()[0] \
+                                > self.max_bytes:
+                    deleted = connection.execute(
+                            'DELETE FROM result WHERE key = (SELECT key FROM '
+                            'result WHERE key != ? ORDER BY last_access '
+                            'LIMIT 1)', (key,)).rowcount
+                    if not deleted:
+                        break
+                    evicted += deleted
+                connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            logging.warning('result cache store failed: %s', e)
+            self._discard_connection()
+            return False
+        self._count('stores')
+        self._count('evictions', evicted)
+        return True
+
+    def invalidate(self, segment_id):
+        '''Drops all cached results for `segment_id`.'''
+        try:
+            self._connection().execute(
+                    'DELETE FROM result WHERE segment = ?', (segment_id,))
+        except sqlite3.Error as e:
+            logging.warning('result cache invalidation failed: %s', e)
+            self._discard_connection()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evictions': self.evictions,
+            }
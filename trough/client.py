@@ -31,7 +31,19 @@ import datetime
 import threading
 import time
 import collections
+import asyncio
+import urllib.parse
+import itertools
+import uuid
+import io
+import csv
+import ujson
 from aiohttp import ClientSession
+import trough.formats
+import trough.compression
+import trough.sync
+import trough.fanout
+import trough.aggregate
 
 class TroughException(Exception):
     def __init__(self, message, payload=None, returned_message=None):
@@ -130,6 +142,47 @@ class TroughClient(object):
                     "don't know how to make an sql value from %r (%r)" % (
                         x, type(x)))
 
+    @staticmethod
+    def param_value(x):
+        '''Converts `x` for binding as a query parameter, the bound
+        equivalent of `sql_value()`.'''
+        if isinstance(x, datetime.datetime):
+            # same text as sqlite's datetime(), which `sql_value()` uses
+            if x.utcoffset() is not None:
+                x = x.astimezone(datetime.timezone.utc)
+            return x.strftime('%Y-%m-%d %H:%M:%S')
+        elif isinstance(x, bool):
+            return int(x)
+        elif x is None or isinstance(x, (str, bytes, int, float)):
+            return x
+        else:
+            raise TroughException(
+                    "don't know how to make an sql parameter from %r (%r)" % (
+                        x, type(x)))
+
+    def bind(self, params):
+        if isinstance(params, dict):
+            return {k: self.param_value(v) for k, v in params.items()}
+        return [self.param_value(v) for v in params]
+
+    def _payload(self, sql_tmpl, values, params=None, batch=None):
+        '''Returns `(payload, content_type)`: the sql text with `values`
+        interpolated client side (the legacy form), or if `params` or `batch`
+        is given, a bound query for the server to execute with sqlite3
+        parameter binding.'''
+        if params is None and batch is None:
+            sql = sql_tmpl % tuple(self.sql_value(v) for v in values)
+            return sql.encode('utf-8'), 'application/sql;charset=utf-8'
+        if values:
+            raise TroughException(
+                    'pass either values to interpolate or params to bind, '
+                    'not both')
+        payload = trough.sync.encode_bound_query(
+                sql_tmpl,
+                params=None if params is None else self.bind(params),
+                batch=None if batch is None else [self.bind(row) for row in batch])
+        return payload, trough.sync.BOUND_QUERY_CONTENT_TYPE
+
     def segment_manager_url(self):
         master_node = self.svcreg.unique_service('trough-sync-master')
         if not master_node:
@@ -234,69 +287,440 @@ class TroughClient(object):
                     self._read_url_cache[segment_id])
         return self._read_url_cache[segment_id]
 
-    def write(self, segment_id, sql_tmpl, values=(), schema_id='default'):
-        write_url = self.write_url(segment_id, schema_id)
-        sql = sql_tmpl % tuple(self.sql_value(v) for v in values)
-        sql_bytes = sql.encode('utf-8')
+    def write(
+            self, segment_id, sql_tmpl, values=(), schema_id='default',
+            params=None, batch_id=None, retries=3):
+        '''
+        Runs `sql_tmpl` against `segment_id`. Either `values` are
+        interpolated into `sql_tmpl` as sql literals (`%s` placeholders), or
+        `params`, a list or dict, are bound by sqlite3 on the server (`?` or
+        `:name` placeholders).
+
+        The write is sent with a batch id, `batch_id` or a random one, that
+        the server records with it, so that it can be retried safely when
+        the server can't be reached or the request times out: up to
+        `retries` times, backing off exponentially. Pass the same
+        `batch_id` to retry a write that failed in an earlier call.
+        '''
+        return self._write(
+                segment_id, sql_tmpl, values, schema_id, params=params,
+                batch_id=batch_id, retries=retries)
+
+    def write_many(
+            self, segment_id, sql, batch, schema_id='default', batch_id=None,
+            retries=3):
+        '''Runs `sql` once for each list or dict of parameters in `batch`,
+        in one request and one transaction. Retried like `write()`.'''
+        return self._write(
+                segment_id, sql, (), schema_id, batch=list(batch),
+                batch_id=batch_id, retries=retries)
+
+    def _write(
+            self, segment_id, sql_tmpl, values, schema_id, params=None,
+            batch=None, batch_id=None, retries=3):
+        sql_bytes, content_type = self._payload(sql_tmpl, values, params, batch)
+        self._post_write(
+                segment_id, schema_id, sql_bytes, content_type,
+                batch_id or uuid.uuid4().hex, retries)
+
+    # responses to a write that may not have reached the write server, or
+    # that it may have applied without answering, and 429, the write
+    # server's spool of writes to the segment is full
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    def _post_write(
+            self, segment_id, schema_id, payload, content_type, batch_id,
+            retries, query=None):
+        '''Posts a write with id `batch_id`, retrying it as explained in
+        `write()`. `query` are extra query string parameters. Returns the
+        response.'''
+        failures = 0
+        while True:
+            write_url = self.write_url(segment_id, schema_id)
+            if query:
+                write_url += '&' + urllib.parse.urlencode(query)
+            try:
+                response = requests.post(
+                        write_url, payload, timeout=600, headers={
+                            'content-type': content_type,
+                            'x-trough-batch-id': batch_id})
+                if response.status_code != 200:
+                    raise TroughException(
+                            'unexpected response %r %r: %r from POST %r with '
+                            'payload %r' % (
+                                response.status_code, response.reason,
+                                response.text, write_url, payload[:1024]),
+                            payload, response.text)
+                if segment_id not in self._dirty_segments:
+                    with self._dirty_segments_lock:
+                        self._dirty_segments.add(segment_id)
+                return response
+            except Exception as e:
+                self._write_url_cache.pop(segment_id, None)
+                failures += 1
+                retryable = isinstance(e, requests.RequestException) or (
+                        isinstance(e, TroughException)
+                        and response.status_code in self.RETRY_STATUSES)
+                if not retryable or failures > retries:
+                    raise
+                self.logger.warning(
+                        'retrying write %s to segment %s (%s/%s): %s',
+                        batch_id, segment_id, failures, retries, e)
+                time.sleep(min(2 ** failures, 30))
+
+    def bulk_insert(
+            self, segment_id, table, rows, columns=None, format='ndjson',
+            schema_id='default', rows_per_request=100000, batch_id=None,
+            retries=3):
+        '''
+        Inserts `rows` into `table` with the write server's bulk load
+        endpoint, which binds the values with sqlite3 instead of parsing
+        `INSERT` statements. `rows` is an iterable of dicts, or of sequences
+        of values in the order of `columns`. `columns` defaults to the keys
+        of the first row.
+
+        `format` is the wire format, 'ndjson', 'csv' (values are sent as
+        text, so no blobs) or 'msgpack'. Rows are consumed and sent in
+        requests of up to `rows_per_request` rows, so that the payload is
+        never all in memory; the server commits them in chunks of its own,
+        so rows sent before an error stay inserted. Returns the number of
+        rows inserted.
+
+        Requests are retried like `write()`; the server skips the chunks of
+        a retried request that it had committed. Each request's batch id is
+        `batch_id` (or a random one) followed by its number.
+        '''
+        if format not in trough.formats.STREAM_FORMATS:
+            raise ValueError('format must be one of %r' % (trough.formats.STREAM_FORMATS,))
+        if not trough.formats.available(format):
+            raise ValueError('format %r is not available here' % format)
+        rows = iter(rows)
+        batch_id = batch_id or uuid.uuid4().hex
+        inserted = 0
+        for i in itertools.count():
+            batch = list(itertools.islice(rows, rows_per_request))
+            if not batch:
+                return inserted
+            if columns is None:
+                if not isinstance(batch[0], dict):
+                    raise ValueError('columns are required when rows are not dicts')
+                columns = list(batch[0])
+            payload = self._bulk_payload(batch, columns, format)
+            response = self._post_write(
+                    segment_id, schema_id, payload,
+                    trough.formats.FORMATS[format].content_type,
+                    '%s-%s' % (batch_id, i), retries, query={
+                        'table': table, 'format': format,
+                        'columns': ','.join(columns)})
+            inserted += int(response.text.split()[1])
 
+    @staticmethod
+    def _bulk_payload(batch, columns, format):
+        '''Encodes the body of a bulk insert request.'''
+        rows = [
+            [row.get(column) for column in columns]
+            if isinstance(row, dict) else list(row) for row in batch]
+        if format == 'ndjson':
+            return ''.join(
+                ujson.dumps(
+                    dict(zip(columns, trough.sync.encode_params(row))),
+                    escape_forward_slashes=False) + '\n'
+                for row in rows).encode('utf-8')
+        elif format == 'csv':
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(columns)
+            writer.writerows(rows)
+            return buf.getvalue().encode('utf-8')
+        else:
+            packer = trough.formats.msgpack.Packer(use_bin_type=True)
+            return packer.pack(list(columns)) + b''.join(packer.pack(row) for row in rows)
+
+    def _read_headers(self, format, content_type):
+        headers = {
+            'content-type': content_type,
+            'accept-encoding': trough.compression.accept_encoding(),
+        }
+        if format != 'json':
+            headers['accept'] = trough.formats.FORMATS[format].content_type
+        return headers
+
+    def _post_read(self, url, payload, headers):
+        '''Posts a read request. Returns `(response, body)`, where `body` is
+        the response body, decompressed.'''
+        response = requests.post(
+                url, payload, timeout=600, headers=headers, stream=True)
+        with response:
+            # decoded here rather than by urllib3, which may not know zstd
+            body = response.raw.read(decode_content=False)
+        body = trough.compression.decompress(
+                body, response.headers.get('Content-Encoding'))
+        return response, body
+
+    async def _async_post_read(self, session, url, payload, headers):
+        '''Like `_post_read()`, with aiohttp. `session` must not decompress
+        responses itself (`auto_decompress=False`). Returns `(status,
+        reason, body)`.'''
+        async with session.post(url, data=payload, headers=headers) as res:
+            body = await res.read()
+            return res.status, res.reason, trough.compression.decompress(
+                    body, res.headers.get('Content-Encoding'))
+
+    def read(
+            self, segment_id, sql_tmpl, values=(), format='json',
+            params=None):
+        '''
+        Runs a query against `segment_id`. `format` is the wire format to
+        request from the read server, see `trough.formats`; whatever the
+        format, results are returned decoded, as a list of dicts. `values`
+        and `params` work as for `write()`.
+        '''
+        read_url = self.read_url(segment_id)
+        sql_bytes, content_type = self._payload(sql_tmpl, values, params)
         try:
-            response = requests.post(
-                    write_url, sql_bytes, timeout=600,
-                    headers={'content-type': 'application/sql;charset=utf-8'})
+            response, body = self._post_read(
+                    read_url, sql_bytes,
+                    self._read_headers(format, content_type))
             if response.status_code != 200:
+                text = body.decode('utf-8', 'replace')
                 raise TroughException(
-                        'unexpected response %r %r: %r from POST %r with '
-                        'payload %r' % (
-                            response.status_code, response.reason,
-                            response.text, write_url, sql_bytes), sql_bytes, response.text)
-            if segment_id not in self._dirty_segments:
-                with self._dirty_segments_lock:
-                    self._dirty_segments.add(segment_id)
+                        'unexpected response %r %r %r from %r to query %r' % (
+                            response.status_code, response.reason, text,
+                            read_url, sql_bytes), sql_bytes, text)
+            self.logger.trace(
+                    'got %r from posting query %r to %r', body,
+                    sql_bytes, read_url)
+            results = trough.formats.decode(format, body)
+            return results
         except Exception as e:
-            self._write_url_cache.pop(segment_id, None)
+            self._read_url_cache.pop(segment_id, None)
             raise e
 
-    def read(self, segment_id, sql_tmpl, values=()):
+    def _batch_payload(self, queries):
+        '''Returns `(payload, labels)` for `read_many()`.'''
+        if isinstance(queries, dict):
+            items = list(queries.items())
+        else:
+            items = list(enumerate(queries))
+        batch = []
+        for label, query in items:
+            sql, params = (query, None) if isinstance(query, str) else query
+            batch.append((
+                label, sql, None if params is None else self.bind(params)))
+        return trough.sync.encode_read_batch(batch), [label for label, _ in items]
+
+    def _batch_results(self, body, format, labels, keyed):
+        results = []
+        for item in json.loads(body.decode('utf-8')):
+            if 'error' in item:
+                raise TroughException(
+                        'query %r of batch failed: %s' % (
+                            labels[len(results)], item['error']),
+                        returned_message=item['error'])
+            result = item['result']
+            if format == 'compact':
+                result = [dict(zip(result['columns'], row)) for row in result['rows']]
+            results.append(result)
+        return dict(zip(labels, results)) if keyed else results
+
+    def read_many(self, segment_id, queries, format='json'):
+        '''
+        Runs a batch of independent queries against `segment_id` in one
+        request. The read server runs them one after the other on one
+        connection, so they all see the same snapshot of the segment.
+        `queries` is a list, or a dict keyed by label, of sql strings or
+        `(sql, params)` tuples (params are bound, as for `write()`). Returns
+        the results in the same shape: a list, or a dict with the same
+        keys, of lists of dicts. `format` is the wire format, 'json' or
+        'compact'. Raises `TroughException` if any of the queries failed.
+        '''
+        payload, labels = self._batch_payload(queries)
         read_url = self.read_url(segment_id)
-        sql = sql_tmpl % tuple(self.sql_value(v) for v in values)
-        sql_bytes = sql.encode('utf-8')
         try:
-            response = requests.post(
-                    read_url, sql_bytes, timeout=600,
-                    headers={'content-type': 'application/sql;charset=utf-8'})
+            response, body = self._post_read(
+                    read_url, payload, self._read_headers(
+                        format, trough.sync.BOUND_QUERY_CONTENT_TYPE))
             if response.status_code != 200:
+                text = body.decode('utf-8', 'replace')
                 raise TroughException(
-                        'unexpected response %r %r %r from %r to query %r' % (
-                            response.status_code, response.reason, response.text,
-                            read_url, sql_bytes), sql_bytes, response.text)
-            self.logger.trace(
-                    'got %r from posting query %r to %r', response.text, sql,
-                    read_url)
-            results = json.loads(response.text)
-            return results
+                        'unexpected response %r %r %r from %r to query '
+                        'batch %r' % (
+                            response.status_code, response.reason,
+                            text, read_url, payload),
+                        payload, text)
         except Exception as e:
             self._read_url_cache.pop(segment_id, None)
             raise e
+        return self._batch_results(
+                body, format, labels, isinstance(queries, dict))
 
-    async def async_read(self, segment_id, sql_tmpl, values=()):
+    async def async_read_many(self, segment_id, queries, format='json'):
+        '''Like `read_many()`, with aiohttp.'''
+        payload, labels = self._batch_payload(queries)
         read_url = self.read_url(segment_id)
-        sql = sql_tmpl % tuple(self.sql_value(v) for v in values)
-        sql_bytes = sql.encode('utf-8')
-
-        async with ClientSession() as session:
-            async with session.post(
-                    read_url, data=sql_bytes, headers={
-                        'content-type': 'application/sql;charset=utf-8'}) as res:
-                if res.status != 200:
-                    self._read_url_cache.pop(segment_id, None)
-                    text = await res.text('utf-8')
+        async with ClientSession(auto_decompress=False) as session:
+            status, reason, body = await self._async_post_read(
+                    session, read_url, payload, self._read_headers(
+                        format, trough.sync.BOUND_QUERY_CONTENT_TYPE))
+        if status != 200:
+            self._read_url_cache.pop(segment_id, None)
+            text = body.decode('utf-8', 'replace')
+            raise TroughException(
+                    'unexpected response %r %r %r from %r to query '
+                    'batch %r' % (
+                        status, reason, text, read_url, payload),
+                    payload, text)
+        return self._batch_results(body, format, labels, isinstance(queries, dict))
+
+    def read_pages(
+            self, segment_id, sql_tmpl, key, values=(), page_size=10000,
+            format='json', params=None, continuation=None, retries=3):
+        '''
+        Runs a query against `segment_id` a page at a time, with keyset
+        pagination: `key` is the result column, or list of columns, that
+        orders the pages, and must be unique and not null. Yields `(rows,
+        continuation)` for each page, where `rows` is a list of dicts and
+        `continuation` is the token of the next page (None after the last
+        one). Only one page is held in memory at a time.
+
+        A page that fails is retried, up to `retries` times in a row,
+        starting after the last page that was read. To pick up a read that
+        was abandoned, pass the last `continuation` it yielded. Raises
+        `TroughException` if the segment file was replaced since the read
+        started (status 409), since the rest of the pages could then be
+        inconsistent with the ones already read.
+        '''
+        if isinstance(key, str):
+            key = [key]
+        sql_bytes, content_type = self._payload(sql_tmpl, values, params)
+        failures = 0
+        while True:
+            read_url = self.read_url(segment_id)
+            page = {'page_size': page_size, 'key': ','.join(key)}
+            if continuation:
+                page['cursor'] = continuation
+            url = read_url + ('&' if '?' in read_url else '?') + urllib.parse.urlencode(page)
+            try:
+                response, body = self._post_read(
+                        url, sql_bytes,
+                        self._read_headers(format, content_type))
+                if response.status_code != 200:
+                    text = body.decode('utf-8', 'replace')
                     raise TroughException(
-                            'unexpected response %r %r %r from %r to '
-                            'query %r' % (
-                                res.status, res.reason, text, read_url,
-                                sql), sql_bytes, text)
-                results = list(await res.json())
-                return results
+                            'unexpected response %r %r %r from %r to query '
+                            '%r' % (
+                                response.status_code, response.reason,
+                                text, url, sql_bytes),
+                            sql_bytes, text)
+                rows = trough.formats.decode(format, body)
+            except Exception as e:
+                self._read_url_cache.pop(segment_id, None)
+                failures += 1
+                if failures > retries or (
+                        isinstance(e, TroughException)
+                        and response.status_code in (400, 406, 409)):
+                    raise
+                self.logger.warning(
+                        'retrying page of %r from segment %s (%s/%s): %s',
+                        sql_bytes, segment_id, failures, retries, e)
+                time.sleep(min(2 ** failures, 30))
+                continue
+            failures = 0
+            continuation = response.headers.get('X-Trough-Continuation')
+            yield rows, continuation
+            if not continuation:
+                return
+
+    def read_iter(self, segment_id, sql_tmpl, key, values=(), **kwargs):
+        '''Like `read_pages()`, but yields the rows one at a time.'''
+        for rows, _ in self.read_pages(segment_id, sql_tmpl, key, values, **kwargs):
+            yield from rows
+
+    async def async_read(
+            self, segment_id, sql_tmpl, values=(), format='json',
+            params=None):
+        body = await self.async_read_bytes(
+                segment_id, sql_tmpl, values, format, params)
+        return trough.formats.decode(format, body)
+
+    async def async_read_bytes(
+            self, segment_id, sql_tmpl, values=(), format='json',
+            params=None):
+        '''Like `async_read()`, but returns the undecoded response body.'''
+        read_url = self.read_url(segment_id)
+        sql_bytes, content_type = self._payload(sql_tmpl, values, params)
+
+        async with ClientSession(auto_decompress=False) as session:
+            status, reason, body = await self._async_post_read(
+                    session, read_url, sql_bytes,
+                    self._read_headers(format, content_type))
+        if status != 200:
+            self._read_url_cache.pop(segment_id, None)
+            text = body.decode('utf-8', 'replace')
+            raise TroughException(
+                    'unexpected response %r %r %r from %r to '
+                    'query %r' % (
+                        status, reason, text, read_url, sql_bytes),
+                    sql_bytes, text)
+        return body
+
+    async def async_aggregate(self, segment_ids, sql, params=None):
+        '''
+        Runs the aggregate query `sql` over all of `segment_ids`, pushing
+        partial aggregates down to the segments and combining them here (see
+        `trough.aggregate`). Raises `trough.aggregate.Unsupported` if `sql`
+        can not be rewritten that way. Returns `(results, stats)`, where
+        `results` is a list of dicts and `stats` reports the rows and bytes
+        that pushdown kept off the network.
+        '''
+        query = trough.aggregate.AggregateQuery(sql)
+        tasks = [
+            asyncio.ensure_future(self.async_read_bytes(
+                segment_id, query.segment_sql, format='compact',
+                params=params))
+            for segment_id in segment_ids]
+        try:
+            for task in asyncio.as_completed(tasks):
+                body = await task
+                query.add(
+                        trough.formats.decode('compact', body),
+                        size=len(body))
+        finally:
+            for task in tasks:
+                task.cancel()
+        return query.result(), query.stats()
+
+    def fanout(
+            self, sql, segments=None, regex=None, params=None,
+            concurrency=None):
+        '''
+        Runs `sql` against every segment in `segments`, or every segment
+        whose id matches `regex`, through the segment manager's fan-out
+        endpoint, which merges the results (honoring a top-level ORDER BY and
+        LIMIT) on the server side. Returns a dict with `columns`, `rows` (a
+        list of dicts), `segments` (counts of segments queried, succeeded,
+        failed and cancelled) and `errors` (`{segment_id: message}`).
+        '''
+        url = os.path.join(self.segment_manager_url(), 'query')
+        payload_dict = {'sql': sql}
+        if segments is not None:
+            payload_dict['segments'] = list(segments)
+        if regex is not None:
+            payload_dict['regex'] = regex
+        if params is not None:
+            payload_dict['params'] = trough.sync.encode_params(self.bind(params))
+        if concurrency is not None:
+            payload_dict['concurrency'] = concurrency
+        self.logger.debug('posting %s to %s', json.dumps(payload_dict), url)
+        response = requests.post(url, json=payload_dict, timeout=600)
+        if response.status_code != 200:
+            raise TroughException(
+                    'unexpected response %r %r: %r from POST %r with '
+                    'payload %r' % (
+                        response.status_code, response.reason, response.text,
+                        url, json.dumps(payload_dict)),
+                    sql.encode('utf-8'), response.text)
+        return trough.fanout.decode(response.content)
 
     def schema_exists(self, schema_id):
         url = os.path.join(self.segment_manager_url(), 'schema', schema_id)
@@ -0,0 +1,113 @@
+'''
+trough/compression.py - content encodings of read responses
+
+Query results compress well (json results typically 10-20x), which matters
+when they cross racks. The read server compresses a response when the
+request's `Accept-Encoding` header allows it:
+
+- gzip  - always available
+- zstd  - much cheaper to compress at a similar ratio (requires the
+          `zstandard` module)
+
+Responses are compressed as they stream: each chunk is flushed on its own,
+so the client can decode the rows it has received so far without waiting
+for the end of the response.
+'''
+import zlib
+from trough.settings import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class UnsupportedEncoding(Exception):
+    pass
+
+class GzipEncoder:
+    name = 'gzip'
+
+    def __init__(self):
+        # wbits 16 + 15 writes the gzip header and trailer
+        self.compressor = zlib.compressobj(
+                int(settings['READ_COMPRESSION_GZIP_LEVEL']), zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+class ZstdEncoder:
+    name = 'zstd'
+
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(
+                level=int(settings['READ_COMPRESSION_ZSTD_LEVEL'])).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+ENCODERS = {e.name: e for e in (ZstdEncoder, GzipEncoder)}
+
+def available(name):
+    if name == 'zstd':
+        return zstandard is not None
+    return name in ENCODERS
+
+def accept_encoding():
+    '''The `Accept-Encoding` header for clients to send, listing the
+    encodings `decompress()` can decode here.'''
+    return ', '.join(name for name in ENCODERS if available(name))
+
+def negotiate(accept_encoding):
+    '''
+    Picks the encoding to compress a response with, given the request's
+    `Accept-Encoding` header: the first encoding in the
+    READ_COMPRESSION_ENCODINGS setting (the server's order of preference)
+    that the client accepts and is available here. Returns None for an
+    uncompressed response.
+    '''
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        parts = item.split(';')
+        name = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            accepted[name] = q
+    for name in settings['READ_COMPRESSION_ENCODINGS'].split(','):
+        name = name.strip().lower()
+        if not name or not available(name):
+            continue
+        if accepted.get(name, accepted.get('*', 0)) > 0:
+            return name
+    return None
+
+def get_encoder(name):
+    '''Returns a new streaming encoder for encoding `name`.'''
+    return ENCODERS[name]()
+
+def decompress(body, encoding):
+    '''Decodes a complete response body sent with `Content-Encoding:
+    encoding` (None or 'identity' for an uncompressed body).'''
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return body
+    elif encoding == 'gzip':
+        return zlib.decompress(body, 47)
+    elif encoding == 'zstd' and zstandard is not None:
+        # streamed frames don't record their size, which
+        # ZstdDecompressor.decompress() insists on
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    raise UnsupportedEncoding('can not decode content encoding %r' % encoding)
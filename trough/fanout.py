@@ -0,0 +1,549 @@
+'''
+trough/fanout.py - scatter/gather queries across many segments
+
+Runs one SELECT against many segments, on their read replicas, with bounded
+concurrency, and streams back a single merged result:
+
+- if the query has a top-level ORDER BY, the per-segment results (each
+  already sorted by its read server) are k-way merged
+- a top-level LIMIT/OFFSET is pushed down to the segments as
+  `LIMIT limit + offset` and applied again to the merged rows; once enough
+  rows are out, segment queries still queued or streaming are cancelled
+- a segment that fails does not fail the whole query, its error is reported
+  next to the rows
+
+The response body is a json object, streamed:
+
+    {"columns": ["url", "size"],
+     "rows": [
+    ["http://example.com/", 1234],
+    ...
+    ],
+     "segments": {"queried": 3, "succeeded": 2, "failed": 1, "cancelled": 0},
+     "errors": {"segment-x": "..."}}
+'''
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import queue
+import re
+import tempfile
+import threading
+import requests
+import rethinkdb as r
+import ujson
+import trough
+from trough.settings import settings
+
+class FanoutError(Exception):
+    '''The query can't be fanned out (reported to the client as a 400).'''
+    pass
+
+def healthy_read_urls(rethinker, segments=None, regex=None):
+    '''
+    Returns `{segment_id: [read url, ...]}` for the segments in `segments`, or
+    the segments matching `regex`, with each segment's healthy read services
+    ordered least loaded first.
+    '''
+    reql = rethinker.table('services', read_mode='outdated')
+    if segments is not None:
+        if not segments:
+            return {}
+        reql = reql.get_all(*segments, index='segment')
+    reql = reql.filter({'role': 'trough-read'})\
+            .filter(r.row.has_fields('segment'))
+    if regex is not None:
+        reql = reql.filter(
+                lambda svc: svc['segment'].coerce_to('string').match(regex))
+    reql = reql.filter(
+            lambda svc: r.now().sub(svc['last_heartbeat']).lt(svc['ttl']))
+    services = sorted(reql.run(), key=lambda svc: svc.get('load') or 0)
+    urls = {segment: [] for segment in segments or ()}
+    for svc in services:
+        urls.setdefault(svc['segment'], []).append(svc['url'])
+    return urls
+
+def top_level_words(sql):
+    '''
+    Yields `(start, end, word)` for each bare word in `sql` that is not
+    inside parentheses, quotes or comments. `word` is upper-cased.
+    '''
+    i = 0
+    n = len(sql)
+    depth = 0
+    closing = {"'": "'", '"': '"', '`': '`', '[': ']'}
+    while i < n:
+        c = sql[i]
+        if c in closing:
+            end = sql.find(closing[c], i + 1)
+            while end != -1 and closing[c] != ']' and sql[end+1:end+2] == closing[c]:
+                end = sql.find(closing[c], end + 2)
+            i = n if end == -1 else end + 1
+        elif sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = n if end == -1 else end + 1
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+        elif c == '(':
+            depth += 1
+            i += 1
+        elif c == ')':
+            depth -= 1
+            i += 1
+        elif c.isalnum() or c == '_':
+            start = i
+            while i < n and (sql[i].isalnum() or sql[i] in '_$'):
+                i += 1
+            if depth == 0:
+                yield start, i, sql[start:i].upper()
+        else:
+            i += 1
+
+def split_terms(clause):
+    '''Splits `clause` on commas that are not inside parentheses or quotes.'''
+    terms = []
+    start = 0
+    depth = 0
+    quote = None
+    for i, c in enumerate(clause):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '\'"`':
+            quote = c
+        elif c == '[':
+            quote = ']'
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            terms.append(clause[start:i].strip())
+            start = i + 1
+    terms.append(clause[start:].strip())
+    return terms
+
+_ORDER_TERM_RE = re.compile(
+        r'^(?P<expr>.+?)(?:\s+COLLATE\s+(?P<collation>\w+))?'
+        r'(?:\s+(?P<direction>ASC|DESC))?'
+        r'(?:\s+NULLS\s+(?P<nulls>FIRST|LAST))?$', re.IGNORECASE | re.DOTALL)
+_IDENTIFIER_RE = re.compile(
+        r'^(?:(?:\w+|"[^"]+"|`[^`]+`|\[[^\]]+\])\.)?'
+        r'(?P<name>\w+|"[^"]+"|`[^`]+`|\[[^\]]+\])$')
+
+class OrderTerm:
+    def __init__(self, term):
+        m = _ORDER_TERM_RE.match(term)
+        if not m:
+            raise FanoutError('could not parse ORDER BY term %r' % term)
+        expr = m.group('expr').strip()
+        self.descending = (m.group('direction') or '').upper() == 'DESC'
+        self.collation = (m.group('collation') or 'BINARY').upper()
+        if self.collation not in ('BINARY', 'NOCASE', 'RTRIM'):
+            raise FanoutError(
+                    'ORDER BY ... COLLATE %s is not supported for fan-out '
+                    'queries' % self.collation)
+        nulls = (m.group('nulls') or '').upper()
+        # sqlite sorts nulls first, so they come last when descending
+        self.nulls_first = nulls == 'FIRST' or (
+                not nulls and not self.descending)
+        if expr.isdigit():
+            self.position = int(expr) - 1
+            self.name = None
+        else:
+            m = _IDENTIFIER_RE.match(expr)
+            if not m:
+                raise FanoutError(
+                        'ORDER BY term %r must be a result column name or '
+                        'number for fan-out queries' % term)
+            self.position = None
+            self.name = m.group('name').strip('"`[]')
+
+    def index(self, columns):
+        if self.position is not None:
+            if not 0 <= self.position < len(columns):
+                raise FanoutError(
+                        'ORDER BY term %s is out of range' % (self.position + 1))
+            return self.position
+        for i, column in enumerate(columns):
+            if column.lower() == self.name.lower():
+                return i
+        raise FanoutError(
+                'ORDER BY %r must also be a result column for fan-out '
+                'queries' % self.name)
+
+    def key(self, value):
+        '''Sort key for `value`, in sqlite's order for its type class.'''
+        if value is None:
+            # descending keys get reversed, see `Descending`
+            return (0 if self.nulls_first != self.descending else 3,)
+        if isinstance(value, (int, float)):
+            return (1, value)
+        if self.collation == 'NOCASE':
+            value = value.lower()
+        elif self.collation == 'RTRIM':
+            value = value.rstrip(' ')
+        return (2, value)
+
+class Descending:
+    __slots__ = ('key',)
+    def __init__(self, key):
+        self.key = key
+    def __lt__(self, other):
+        return other.key < self.key
+    def __eq__(self, other):
+        return self.key == other.key
+
+def parse_query(sql):
+    '''
+    Returns `(segment_sql, order_terms, limit, offset)`: the query to send
+    to each segment, with any LIMIT/OFFSET rewritten for pushdown, the
+    top-level ORDER BY terms as `OrderTerm`s, and the global limit (None for
+    no limit) and offset.
+    '''
+    sql = sql.strip().rstrip(';').rstrip()
+    words = list(top_level_words(sql))
+    order_at = limit_at = None
+    for i, (start, end, word) in enumerate(words):
+        if word == 'ORDER' and i + 1 < len(words) and words[i+1][2] == 'BY':
+            order_at = i
+        elif word == 'LIMIT':
+            limit_at = i
+    if order_at is not None and limit_at is not None and limit_at < order_at:
+        raise FanoutError('could not parse LIMIT clause')
+    order_terms = []
+    if order_at is not None:
+        end = words[limit_at][0] if limit_at is not None else len(sql)
+        clause = sql[words[order_at + 1][1]:end]
+        order_terms = [OrderTerm(term) for term in split_terms(clause)]
+    limit = None
+    offset = 0
+    segment_sql = sql
+    if limit_at is not None:
+        clause = sql[words[limit_at][1]:].strip()
+        m = re.match(
+                r'^(\d+)(?:\s*(?:,|\s+OFFSET\s+)\s*(\d+))?$', clause,
+                re.IGNORECASE)
+        if not m:
+            raise FanoutError(
+                    'LIMIT and OFFSET must be integer literals for fan-out '
+                    'queries')
+        if ',' in clause:
+            # LIMIT offset, count
+            offset, limit = int(m.group(1)), int(m.group(2))
+        else:
+            limit, offset = int(m.group(1)), int(m.group(2) or 0)
+        segment_sql = '%s LIMIT %d' % (
+                sql[:words[limit_at][0]].rstrip(), limit + offset)
+    return segment_sql, order_terms, limit, offset
+
+_DONE = object()
+
+def _compact_rows(lines):
+    '''
+    Yields the list of column names, then each row, as a list, of a result in
+    the compact format arriving as `lines`. Relies on the framing of
+    `trough.formats.CompactFormat`: the header and the first row share the
+    first line, each further row is on a line of its own, and the footer
+    follows the last row.
+    '''
+    first = True
+    for line in lines:
+        if not line:
+            continue
+        if first:
+            first = False
+            if line.endswith(b','):
+                line = line[:-1]
+            if not line.endswith(b']}'):
+                line += b']}'
+            result = ujson.loads(line)
+            yield result['columns']
+            yield from result['rows']
+        elif line != b']}':
+            if line.endswith(b','):
+                line = line[:-1]
+            elif line.endswith(b']}'):
+                line = line[:-2]
+            yield ujson.loads(line)
+
+class _SpillingQueue:
+    '''
+    The rows of one segment, on their way to the ordered merge. Up to
+    `maxsize` rows are held in memory, and the rest spill to a temporary
+    file, so that `put()` never blocks: the merge needs the first row of
+    every segment, so a worker waiting for it to take rows would hold its
+    slot from the segments not started yet.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.rows = collections.deque()
+        self.spill = None
+        self.spilled = 0 # rows in the spill not read yet
+        self.read_at = 0
+        self.done = False
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, row):
+        with self.cond:
+            if self.closed:
+                return
+            if not self.spilled and len(self.rows) < self.maxsize:
+                self.rows.append(row)
+            else:
+                if self.spill is None:
+                    self.spill = tempfile.TemporaryFile()
+                self.spill.seek(0, 2)
+                self.spill.write(ujson.dumps(
+                    row, escape_forward_slashes=False).encode('utf-8') + b'\n')
+                self.spilled += 1
+            self.cond.notify()
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify()
+
+    def get(self):
+        '''Returns the next row, or `_DONE` after the last one.'''
+        with self.cond:
+            while not (self.rows or self.spilled or self.done):
+                self.cond.wait()
+            if not self.rows and self.spilled:
+                self.spill.seek(self.read_at)
+                for _ in range(min(self.spilled, self.maxsize)):
+                    self.rows.append(ujson.loads(self.spill.readline()))
+                    self.spilled -= 1
+                self.read_at = self.spill.tell()
+                if not self.spilled:
+                    self.spill.seek(0)
+                    self.spill.truncate()
+                    self.read_at = 0
+            if self.rows:
+                return self.rows.popleft()
+            return _DONE
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.rows.clear()
+            if self.spill is not None:
+                self.spill.close()
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+class Fanout:
+    '''
+    One scatter/gather query. `urls` is `{segment_id: [read url, ...]}` as
+    returned by `healthy_read_urls()`; replicas are tried in order until one
+    accepts the request. `stream()` yields the response body.
+    '''
+    def __init__(
+            self, sql, urls, params=None, concurrency=None, session=None,
+            timeout=None):
+        self.segment_sql, self.order_terms, self.limit, self.offset = parse_query(sql)
+        self.urls = urls
+        self.params = params
+        self.concurrency = max(1, min(
+                int(concurrency or settings['FANOUT_CONCURRENCY']),
+                int(settings['FANOUT_MAX_CONCURRENCY'])))
+        self.session = session or requests.Session()
+        self.timeout = timeout or settings['FANOUT_TIMEOUT']
+        self.columns = None
+        self.errors = {}
+        self.succeeded = set()
+        self.started = set()
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        if params is None:
+            self._payload = self.segment_sql.encode('utf-8')
+            self._content_type = 'application/sql;charset=utf-8'
+        else:
+            self._payload = trough.sync.encode_bound_query(self.segment_sql, params)
+            self._content_type = trough.sync.BOUND_QUERY_CONTENT_TYPE
+
+    def _error(self, segment, message):
+        logging.info('fan-out query failed on segment %r: %s', segment, message)
+        with self._lock:
+            self.errors[segment] = message
+
+    def _fetch(self, segment, put):
+        '''Runs the query on one replica of `segment`, passing each row (a
+        list, so that duplicate column names are kept) to `put()`. Runs in a
+        worker thread.'''
+        if self._cancel.is_set():
+            return
+        with self._lock:
+            self.started.add(segment)
+        if not self.urls.get(segment):
+            self._error(segment, 'no healthy read service for segment')
+            return
+        response = None
+        for url in self.urls[segment]:
+            try:
+                response = self.session.post(
+                        url + '&format=compact', data=self._payload,
+                        headers={'Content-Type': self._content_type},
+                        stream=True, timeout=self.timeout)
+                break
+            except requests.RequestException as e:
+                self._error(segment, '%s: %s' % (url, e))
+        if response is None:
+            return
+        with response:
+            if response.status_code != 200:
+                self._error(segment, '%s: %s %s' % (
+                    url, response.status_code, response.text.strip()))
+                return
+            try:
+                rows = _compact_rows(response.iter_lines(
+                        chunk_size=int(settings['READ_PROXY_CHUNK_SIZE'])))
+                columns = next(rows, None)
+                if columns is None:
+                    self._error(segment, '%s: empty response' % url)
+                    return
+                if not self._columns_match(segment, columns):
+                    return
+                for row in rows:
+                    if self._cancel.is_set():
+                        return
+                    put(row)
+            except Exception as e:
+                self._error(segment, '%s: %s' % (url, e))
+                return
+        with self._lock:
+            self.errors.pop(segment, None)
+            self.succeeded.add(segment)
+
+    def _columns_match(self, segment, columns):
+        '''Returns whether `columns`, the result columns of `segment`, are
+        those of the other segments' results.'''
+        columns = tuple(columns)
+        with self._lock:
+            if self.columns is None:
+                self.columns = columns
+        if columns != self.columns:
+            self._error(segment, 'result columns %r differ from %r' % (
+                columns, self.columns))
+            return False
+        return True
+
+    def _unordered_rows(self, executor):
+        results = queue.Queue(maxsize=int(settings['FANOUT_QUEUE_SIZE']))
+        def worker(segment):
+            def put(row):
+                while not self._cancel.is_set():
+                    try:
+                        results.put((segment, row), timeout=0.5)
+                        return
+                    except queue.Full:
+                        pass
+            try:
+                self._fetch(segment, put)
+            finally:
+                put(_DONE)
+        for segment in self.urls:
+            executor.submit(worker, segment)
+        remaining = len(self.urls)
+        while remaining:
+            segment, row = results.get()
+            if row is _DONE:
+                remaining -= 1
+            else:
+                yield row
+
+    def _ordered_rows(self, executor):
+        queues = {
+            segment: _SpillingQueue(int(settings['FANOUT_QUEUE_SIZE']))
+            for segment in self.urls}
+        def worker(segment):
+            try:
+                self._fetch(segment, queues[segment].put)
+            finally:
+                queues[segment].finish()
+        for segment in self.urls:
+            executor.submit(worker, segment)
+        def segment_rows(segment):
+            try:
+                while True:
+                    row = queues[segment].get()
+                    if row is _DONE:
+                        return
+                    yield row
+            finally:
+                queues[segment].close()
+        keys = []
+        def key(values):
+            if not keys:
+                for term in self.order_terms:
+                    keys.append((term, term.index(self.columns)))
+            return tuple(
+                    Descending(term.key(values[i])) if term.descending
+                    else term.key(values[i]) for term, i in keys)
+        return heapq.merge(
+                *(segment_rows(segment) for segment in self.urls), key=key)
+
+    def rows(self):
+        '''Yields the merged rows, as lists in `self.columns` order.'''
+        executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(self.concurrency, max(len(self.urls), 1)))
+        try:
+            if self.order_terms:
+                rows = self._ordered_rows(executor)
+            else:
+                rows = self._unordered_rows(executor)
+            if self.limit is not None:
+                rows = itertools.islice(
+                        rows, self.offset, self.offset + self.limit)
+            yield from rows
+        finally:
+            # limit reached or client went away
+            self._cancel.set()
+            executor.shutdown(wait=False)
+
+    def stream(self):
+        '''Yields the response body. Nothing is yielded until the first
+        row (or the end of the result) is in, so `FanoutError`s from
+        merging are raised by the first `next()`.'''
+        rows = self.rows()
+        first = next(rows, None)
+        yield ('{"columns":%s,"rows":[\n' % ujson.dumps(
+            list(self.columns or ()), escape_forward_slashes=False)).encode('utf-8')
+        batch_size = int(settings['READ_FETCH_BATCH_SIZE'])
+        if first is not None:
+            separator = b""
+            for batch in _batches(itertools.chain([first], rows), batch_size):
+                yield separator + ",\n".join(
+                        ujson.dumps(row, escape_forward_slashes=False)
+                        for row in batch).encode('utf-8')
+                separator = b",\n"
+        with self._lock:
+            failed = len(self.errors)
+            succeeded = len(self.succeeded)
+            errors = dict(self.errors)
+        summary = {
+            'queried': len(self.urls),
+            'succeeded': succeeded,
+            'failed': failed,
+            'cancelled': len(self.urls) - succeeded - failed,
+        }
+        yield ('\n],"segments":%s,"errors":%s}\n' % (
+            ujson.dumps(summary), ujson.dumps(
+                errors, escape_forward_slashes=False))).encode('utf-8')
+
+def decode(body):
+    '''Decodes a complete fan-out response body. Returns a dict like the
+    response, with `rows` as a list of dicts.'''
+    result = ujson.loads(body)
+    result['rows'] = [dict(zip(result['columns'], row)) for row in result['rows']]
+    return result
@@ -0,0 +1,370 @@
+'''
+trough/formats.py - wire formats for query results
+
+The read server streams results in one of these formats, chosen with the
+`?format=` query parameter or the `Accept` header:
+
+- json     - array of objects, one per row (the default)
+- ndjson   - one json object per line
+- csv      - header line with the column names, then one line per row
+- compact  - json object {"columns": [...], "rows": [[...], ...]}
+- msgpack  - stream of msgpack objects: the list of column names, then one
+             array per row (requires the `msgpack` module)
+- arrow    - apache arrow IPC stream of record batches (requires `pyarrow`)
+
+Encoders turn batches of rows into bytes; `decode()` turns a complete
+response body back into a list of dicts, whatever the format.
+
+The write server takes rows to insert in the ndjson, csv and msgpack
+formats, decoded as they arrive by `decode_stream()`.
+'''
+import csv
+import io
+import json
+import logging
+import ujson
+from trough.settings import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+class UnsupportedFormat(Exception):
+    pass
+
+class ResultFormat:
+    '''
+    Encodes a result set, one batch of rows at a time. A new instance is
+    used for each response, since some formats are stateful.
+    '''
+    name = None
+    content_type = None
+
+    def header(self, columns):
+        return b''
+
+    def batch(self, columns, rows, first):
+        raise NotImplementedError
+
+    def footer(self, columns, empty):
+        return b''
+
+class JsonFormat(ResultFormat):
+    name = 'json'
+    content_type = 'application/json'
+
+    def batch(self, columns, rows, first):
+        chunk = ",\n".join(
+                ujson.dumps(dict(zip(columns, row)), escape_forward_slashes=False)
+                for row in rows)
+        return (b"[" if first else b",\n") + chunk.encode('utf-8')
+
+    def footer(self, columns, empty):
+        return b"[]\n" if empty else b"]\n"
+
+class NdjsonFormat(ResultFormat):
+    name = 'ndjson'
+    content_type = 'application/x-ndjson'
+
+    def batch(self, columns, rows, first):
+        return "".join(
+                ujson.dumps(dict(zip(columns, row)), escape_forward_slashes=False) + "\n"
+                for row in rows).encode('utf-8')
+
+class CompactFormat(ResultFormat):
+    name = 'compact'
+    content_type = 'application/vnd.trough.compact+json'
+
+    def header(self, columns):
+        return ('{"columns":%s,"rows":[' % ujson.dumps(
+            columns, escape_forward_slashes=False)).encode('utf-8')
+
+    def batch(self, columns, rows, first):
+        chunk = ",\n".join(
+                ujson.dumps(row, escape_forward_slashes=False) for row in rows)
+        return (b"" if first else b",\n") + chunk.encode('utf-8')
+
+    def footer(self, columns, empty):
+        return b"]}\n"
+
+class CsvFormat(ResultFormat):
+    name = 'csv'
+    content_type = 'text/csv; charset=utf-8'
+
+    def _lines(self, rows):
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerows(rows)
+        return buf.getvalue().encode('utf-8')
+
+    def header(self, columns):
+        return self._lines([columns])
+
+    def batch(self, columns, rows, first):
+        return self._lines(
+                [[v.decode('utf-8', 'replace') if isinstance(v, bytes) else v
+                  for v in row] for row in rows])
+
+class MsgpackFormat(ResultFormat):
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def header(self, columns):
+        return msgpack.packb(list(columns), use_bin_type=True)
+
+    def batch(self, columns, rows, first):
+        packer = msgpack.Packer(use_bin_type=True)
+        return b''.join(packer.pack(list(row)) for row in rows)
+
+def _arrow_type(values):
+    '''The narrowest arrow type that holds all of `values`: int64, then
+    float64, then string; binary if they are all bytes.'''
+    types = {type(v) for v in values if v is not None}
+    if types == {int}:
+        return pyarrow.int64()
+    elif types and types <= {int, float}:
+        return pyarrow.float64()
+    elif types == {bytes}:
+        return pyarrow.binary()
+    else:
+        # all null, text, or a mix of types
+        return pyarrow.string()
+
+# a value that doesn't fit the type of its column
+_MISFIT = object()
+
+def _coerce(value, type_):
+    '''Returns `value` converted, without loss, to arrow type `type_`, or
+    `_MISFIT` if that can't be done.'''
+    if value is None:
+        return None
+    if type_ == pyarrow.string():
+        if isinstance(value, str):
+            return value
+        if isinstance(value, bytes):
+            return value.decode('utf-8', 'replace')
+        return str(value)
+    if type_ == pyarrow.int64():
+        if type(value) is int:
+            return value
+        if type(value) is float and value.is_integer():
+            return int(value)
+    elif type_ == pyarrow.float64():
+        if type(value) in (int, float):
+            return float(value)
+    elif type_ == pyarrow.binary():
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode('utf-8')
+    return _MISFIT
+
+class ArrowFormat(ResultFormat):
+    '''
+    Arrow IPC stream. sqlite columns are not typed, and the schema of an
+    arrow stream can't change once it is sent, so the first
+    READ_ARROW_SCHEMA_ROWS rows are held back, and column types are the
+    narrowest that hold all of them (int64, float64, string, or binary).
+    Values of later rows are converted to the type of their column where
+    that loses nothing (an int to a float, say, or anything to a string);
+    those that can't be (text in an int64 column) are sent as nulls, and
+    logged.
+    '''
+    name = 'arrow'
+    content_type = 'application/vnd.apache.arrow.stream'
+
+    def __init__(self):
+        self.sink = None
+        self.writer = None
+        self.schema = None
+        # batches of rows held back until the schema is settled
+        self.pending = []
+        self.pending_rows = 0
+        # { column: number of values sent as nulls }
+        self.misfits = {}
+
+    def _drain(self):
+        data = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return data
+
+    def _open(self, columns):
+        rows = [row for batch in self.pending for row in batch]
+        columns_values = list(zip(*rows)) if rows else [()] * len(columns)
+        self.schema = pyarrow.schema([
+            (name, _arrow_type(values))
+            for name, values in zip(columns, columns_values)])
+        self.sink = io.BytesIO()
+        self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+        pending, self.pending = self.pending, []
+        for batch in pending:
+            self._write(batch)
+
+    def _array(self, values, field):
+        coerced = [_coerce(v, field.type) for v in values]
+        misfits = sum(1 for v in coerced if v is _MISFIT)
+        if misfits:
+            self.misfits[field.name] = self.misfits.get(field.name, 0) + misfits
+            coerced = [None if v is _MISFIT else v for v in coerced]
+        return pyarrow.array(coerced, type=field.type)
+
+    def _write(self, rows):
+        arrays = [self._array(values, field)
+                  for values, field in zip(zip(*rows), self.schema)]
+        self.writer.write_batch(
+                pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def batch(self, columns, rows, first):
+        if self.schema is None:
+            self.pending.append(rows)
+            self.pending_rows += len(rows)
+            if self.pending_rows < int(settings['READ_ARROW_SCHEMA_ROWS']):
+                return b''
+            self._open(columns)
+        else:
+            self._write(rows)
+        return self._drain()
+
+    def footer(self, columns, empty):
+        if self.schema is None:
+            self._open(columns)
+        self.writer.close()
+        if self.misfits:
+            logging.warning(
+                    'arrow result values that did not fit the type of their '
+                    'column were sent as nulls: %s (schema %s)',
+                    self.misfits, self.schema)
+        return self._drain()
+
+FORMATS = {f.name: f for f in (
+    JsonFormat, NdjsonFormat, CsvFormat, CompactFormat, MsgpackFormat,
+    ArrowFormat)}
+
+MEDIA_TYPES = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'text/csv': 'csv',
+    'application/vnd.trough.compact+json': 'compact',
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+    'application/vnd.apache.arrow.stream': 'arrow',
+}
+
+def available(name):
+    if name == 'msgpack':
+        return msgpack is not None
+    elif name == 'arrow':
+        return pyarrow is not None
+    return name in FORMATS
+
+def negotiate(format_param=None, accept=None):
+    '''
+    Picks a format name from the `?format=` query parameter, which wins if
+    present, or else the `Accept` header. Falls back to json when nothing in
+    the `Accept` header matches. Raises `UnsupportedFormat` if the requested
+    format is unknown or its module is not installed.
+    '''
+    if format_param:
+        name = format_param.strip().lower()
+        if name not in FORMATS:
+            raise UnsupportedFormat('unknown result format %r (supported: %s)' % (
+                format_param, ', '.join(sorted(FORMATS))))
+    else:
+        name = 'json'
+        candidates = []
+        for i, item in enumerate((accept or '').split(',')):
+            parts = item.split(';')
+            media_type = parts[0].strip().lower()
+            q = 1.0
+            for param in parts[1:]:
+                key, _, value = param.partition('=')
+                if key.strip() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            if q > 0 and media_type in MEDIA_TYPES:
+                candidates.append((-q, i, MEDIA_TYPES[media_type]))
+        for _, _, candidate in sorted(candidates):
+            if available(candidate):
+                name = candidate
+                break
+    if not available(name):
+        raise UnsupportedFormat(
+                'result format %r is not available on this server' % name)
+    return name
+
+def get_format(name):
+    '''Returns a new encoder for format `name`.'''
+    return FORMATS[name]()
+
+def decode(name, body):
+    '''Decodes a complete response body in format `name` into a list of
+    dicts. Values in csv results come back as strings.'''
+    if name == 'json':
+        return json.loads(body.decode('utf-8'))
+    elif name == 'ndjson':
+        return [json.loads(line) for line in body.decode('utf-8').splitlines() if line]
+    elif name == 'compact':
+        result = json.loads(body.decode('utf-8'))
+        return [dict(zip(result['columns'], row)) for row in result['rows']]
+    elif name == 'csv':
+        return list(csv.DictReader(io.StringIO(body.decode('utf-8'))))
+    elif name == 'msgpack':
+        unpacker = msgpack.Unpacker(io.BytesIO(body), raw=False)
+        columns = next(unpacker, [])
+        return [dict(zip(columns, row)) for row in unpacker]
+    elif name == 'arrow':
+        return pyarrow.ipc.open_stream(body).read_all().to_pylist()
+    raise UnsupportedFormat('unknown result format %r' % name)
+
+# formats that `decode_stream()` decodes
+STREAM_FORMATS = ('ndjson', 'csv', 'msgpack')
+
+def _lines(chunks):
+    '''Splits a stream of byte chunks into lines, newlines included.'''
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        lines = buffer.split(b'\n')
+        buffer = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if buffer:
+        yield buffer
+
+def decode_stream(name, chunks):
+    '''
+    Decodes a body in format `name`, one of `STREAM_FORMATS`, arriving as an
+    iterable of byte chunks, and yields its rows as dicts as soon as they are
+    complete. Values in csv bodies come back as strings.
+    '''
+    if name == 'ndjson':
+        for line in _lines(chunks):
+            if line.strip():
+                yield ujson.loads(line)
+    elif name == 'csv':
+        yield from csv.DictReader(line.decode('utf-8') for line in _lines(chunks))
+    elif name == 'msgpack':
+        if msgpack is None:
+            raise UnsupportedFormat('format \'msgpack\' is not available on this server')
+        unpacker = msgpack.Unpacker(raw=False)
+        columns = None
+        for chunk in chunks:
+            unpacker.feed(chunk)
+            for item in unpacker:
+                if columns is None:
+                    columns = item
+                else:
+                    yield dict(zip(columns, item))
+    else:
+        raise UnsupportedFormat('format %r can not be streamed (supported: %s)' % (
+            name, ', '.join(STREAM_FORMATS)))
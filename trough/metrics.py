@@ -0,0 +1,262 @@
+'''
+trough/metrics.py - in-process metrics
+
+A minimal registry of counters, gauges and histograms, rendered in the
+prometheus text exposition format. Values are either updated in place
+(`inc()`, `set()`, `observe()`) or, for metrics registered with `fn`, read
+from a callback at render time.
+
+Under uwsgi every worker process has a registry of its own. With
+`enable_multiprocess()`, each worker writes a snapshot of its registry to a
+shared directory (at most every METRICS_SNAPSHOT_INTERVAL seconds, see
+`maybe_snapshot()`), and `render()` merges the snapshots of all workers, so
+that whichever worker answers the scrape reports totals for the server:
+counters and histograms are summed, including those of workers that have
+exited (so that totals don't go backwards when uwsgi respawns a worker),
+gauges of running workers are combined as registered (`merge`).
+'''
+import bisect
+import collections
+import json
+import os
+import re
+import threading
+import time
+from trough.settings import settings
+
+# seconds, for request latencies
+DEFAULT_BUCKETS = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+        5.0, 10.0, 30.0, 60.0, 300.0)
+
+# value of a histogram: the upper bounds of its buckets, the number of
+# observations in each bucket (not cumulative, the last one is +Inf), and the
+# sum and count of all observations
+HistogramValue = collections.namedtuple(
+        'HistogramValue', ('buckets', 'counts', 'sum', 'count'))
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in labels)
+
+def _format_value(value):
+    if isinstance(value, float) and value == int(value):
+        return repr(float(value))
+    return str(value)
+
+def _format_bound(bound):
+    return '+Inf' if bound is None else _format_value(float(bound))
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # { name: {'type': ..., 'help': ..., 'fn': ..., 'merge': ...,
+        #          'buckets': ..., 'values': {labels: value}} }
+        self._metrics = collections.OrderedDict()
+        self.multiprocess_dir = None
+        self._last_snapshot = None
+
+    def _register(self, name, type_, help, fn, merge='sum', buckets=None):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = {
+                    'type': type_, 'help': help, 'fn': fn, 'merge': merge,
+                    'buckets': buckets, 'values': {}}
+            elif fn is not None:
+                self._metrics[name]['fn'] = fn
+
+    def counter(self, name, help, fn=None):
+        self._register(name, 'counter', help, fn)
+
+    def gauge(self, name, help, fn=None, merge='sum'):
+        '''`merge` is how the values of the worker processes are combined:
+        'sum', 'max' or 'min'.'''
+        self._register(name, 'gauge', help, fn, merge)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self._register(name, 'histogram', help, None, buckets=tuple(sorted(buckets)))
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._metrics[name]['values']
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._metrics[name]['values'][key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metrics[name]
+            buckets = metric['buckets']
+            entry = metric['values'].get(key)
+            if entry is None:
+                entry = metric['values'][key] = [[0] * (len(buckets) + 1), 0, 0]
+            entry[0][bisect.bisect_left(buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        '''Returns a list of `(name, type, help, {labels: value})`, where the
+        values of histograms are `HistogramValue`s.'''
+        with self._lock:
+            metrics = []
+            for name, m in self._metrics.items():
+                if m['type'] == 'histogram':
+                    values = {
+                        labels: HistogramValue(m['buckets'], list(counts), total, count)
+                        for labels, (counts, total, count) in m['values'].items()}
+                else:
+                    values = dict(m['values'])
+                metrics.append((name, m['type'], m['help'], m['fn'], values))
+        result = []
+        for name, type_, help, fn, values in metrics:
+            if fn is not None:
+                values[()] = fn()
+            result.append((name, type_, help, values))
+        return result
+
+    def render(self):
+        if self.multiprocess_dir:
+            samples = self.merged_samples()
+        else:
+            samples = self.samples()
+        lines = []
+        for name, type_, help, values in samples:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type_))
+            for labels, value in sorted(values.items()):
+                if type_ != 'histogram':
+                    lines.append('%s%s %s' % (
+                        name, _format_labels(labels), _format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets + (None,), value.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (
+                        name, _format_labels(labels + (('le', _format_bound(bound)),)),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (
+                    name, _format_labels(labels), _format_value(value.sum)))
+                lines.append('%s_count%s %s' % (
+                    name, _format_labels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+    def enable_multiprocess(self, directory):
+        '''
+        Aggregates the metrics of all the processes that share `directory`
+        (the uwsgi workers of one server). Call it once, before the workers
+        start: it removes the snapshots left by the previous run.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        for filename in os.listdir(directory):
+            if filename.endswith('.json'):
+                os.unlink(os.path.join(directory, filename))
+        self.multiprocess_dir = directory
+
+    def snapshot(self):
+        '''Writes this process's metrics to the multiprocess directory.'''
+        metrics = []
+        for name, type_, help, values in self.samples():
+            with self._lock:
+                merge = self._metrics[name]['merge']
+            metrics.append([name, type_, help, merge, [
+                [list(labels), list(value) if type_ == 'histogram' else value]
+                for labels, value in values.items()]])
+        path = os.path.join(self.multiprocess_dir, '%s.json' % os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'pid': os.getpid(), 'metrics': metrics}, f)
+        os.rename(path + '.tmp', path)
+        self._last_snapshot = time.monotonic()
+
+    def maybe_snapshot(self):
+        '''Writes a snapshot if it has been METRICS_SNAPSHOT_INTERVAL seconds
+        since the last one. Servers call this after each request.'''
+        if self.multiprocess_dir and (
+                self._last_snapshot is None
+                or time.monotonic() - self._last_snapshot
+                >= float(settings['METRICS_SNAPSHOT_INTERVAL'])):
+            self.snapshot()
+
+    def merged_samples(self):
+        '''Like `samples()`, but for all the processes that write snapshots
+        to the multiprocess directory, this one included.'''
+        self.snapshot()
+        merged = collections.OrderedDict()
+        for filename in sorted(os.listdir(self.multiprocess_dir)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.multiprocess_dir, filename)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                # the worker is gone, or it is a partial write
+                continue
+            alive = _pid_alive(snapshot['pid'])
+            for name, type_, help, merge, values in snapshot['metrics']:
+                entry = merged.setdefault(name, (type_, help, merge, {}))
+                if type_ == 'gauge' and not alive:
+                    continue
+                combined = entry[3]
+                for labels, value in values:
+                    labels = tuple(tuple(label) for label in labels)
+                    if type_ == 'histogram':
+                        value = HistogramValue(tuple(value[0]), value[1], value[2], value[3])
+                        previous = combined.get(labels)
+                        if previous is not None and previous.buckets == value.buckets:
+                            value = HistogramValue(
+                                    value.buckets,
+                                    [a + b for a, b in zip(previous.counts, value.counts)],
+                                    previous.sum + value.sum,
+                                    previous.count + value.count)
+                    elif labels in combined:
+                        previous = combined[labels]
+                        if type_ == 'gauge' and merge == 'max':
+                            value = max(previous, value)
+                        elif type_ == 'gauge' and merge == 'min':
+                            value = min(previous, value)
+                        else:
+                            value = previous + value
+                    combined[labels] = value
+        return [
+            (name, type_, help, values)
+            for name, (type_, help, merge, values) in merged.items()]
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+_segment_classes = set()
+_segment_classes_lock = threading.Lock()
+
+def segment_class(segment_id):
+    '''
+    The class of segment `segment_id` that per segment metrics are labeled
+    with, since a label per segment would be far too many: the first group
+    of the match of the METRICS_SEGMENT_CLASS_REGEX setting, by default what
+    comes before the first digit. Once METRICS_MAX_SEGMENT_CLASSES classes
+    have been seen, new ones are all 'other'.
+    '''
+    match = re.match(settings['METRICS_SEGMENT_CLASS_REGEX'], str(segment_id or ''))
+    name = match.group(1) if match else None
+    if not name:
+        return 'other'
+    if name not in _segment_classes:
+        with _segment_classes_lock:
+            if len(_segment_classes) >= int(settings['METRICS_MAX_SEGMENT_CLASSES']):
+                return 'other'
+            _segment_classes.add(name)
+    return name
+
+registry = MetricsRegistry()
@@ -2,13 +2,19 @@
 import trough
 from trough.settings import settings
 import sqlite3
-import ujson
 import os
-import sqlparse
 import logging
 import requests
+import requests.adapters
 import urllib
 import doublethink
+import threading
+import collections
+import itertools
+import time
+import base64
+import hashlib
+import json
 
 if settings['SENTRY_DSN']:
     try:
@@ -17,88 +23,1092 @@ if settings['SENTRY_DSN']:
     except ImportError:
         logging.warning("'SENTRY_DSN' setting is configured but 'sentry_sdk' module not available. Install to use sentry.")
 
+try:
+    import uwsgi
+except ImportError:
+    # not running under uwsgi
+    uwsgi = None
+
+def file_identity(path):
+    '''
+    Returns a tuple that changes whenever the file at `path` is replaced (new
+    inode, e.g. `os.rename()` by the sync loop) or modified (new mtime).
+    Raises `FileNotFoundError` if there is no such file.
+    '''
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+# introspection pragmas, which sqlite only lets through as table-valued
+# functions, e.g. `SELECT * FROM pragma_table_info('foo')`, or as a plain
+# `PRAGMA table_info(foo)`; neither has side effects
+READ_ONLY_PRAGMAS = frozenset((
+    'table_info', 'table_xinfo', 'table_list', 'index_list', 'index_info',
+    'index_xinfo', 'foreign_key_list', 'collation_list', 'function_list',
+    'module_list', 'pragma_list', 'database_list', 'compile_options'))
+
+READ_ONLY_ACTIONS = frozenset((
+    sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION,
+    getattr(sqlite3, 'SQLITE_RECURSIVE', 33)))
+
+def read_only_authorizer(action, arg1, arg2, db_name, trigger_name):
+    '''
+    sqlite authorizer that only lets through statements that read. It is
+    consulted when a statement is prepared, so an INSERT, ATTACH, PRAGMA
+    journal_mode=... and so on fail before anything runs, and statements
+    served from the connection's statement cache are not checked again.
+    '''
+    if action in READ_ONLY_ACTIONS:
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_PRAGMA and arg1 and arg1.lower() in READ_ONLY_PRAGMAS:
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_UPDATE and arg1 == 'sqlite_master':
+        # sqlite asks for this when a table-valued pragma function loads the
+        # schema; user statements can't modify sqlite_master anyway
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+class NotASelectQuery(Exception):
+    def __init__(self):
+        super().__init__('Exactly one SELECT query per request, please.')
+
+class QueryBudgetExceeded(Exception):
+    def __init__(self, budget):
+        self.reason = budget.exceeded
+        if self.reason == 'time':
+            message = 'Query exceeded its time budget of %ss.' % budget.timeout
+        elif self.reason == 'steps':
+            message = 'Query exceeded its budget of %s sqlite steps.' % budget.max_steps
+        else:
+            message = 'Query cancelled, the client went away.'
+        super().__init__(message)
+
+class QueryBudget:
+    '''
+    Time and sqlite virtual machine step budget of one read query, enforced
+    by installing the budget as the connection's progress handler, which
+    sqlite calls every `interval` steps for as long as the query runs,
+    including while its result is streamed. The query is interrupted
+    (`sqlite3.OperationalError: interrupted`) once it runs out of time or
+    steps, or if `disconnected()` says the client has gone away; `exceeded`
+    then says which.
+    '''
+    # how often to check the client connection, in seconds
+    DISCONNECT_CHECK_INTERVAL = 0.5
+
+    def __init__(self, timeout=None, max_steps=None, disconnected=None, interval=None):
+        self.timeout = timeout or None
+        self.max_steps = max_steps or None
+        self.disconnected = disconnected
+        self.interval = int(interval or settings['READ_PROGRESS_INTERVAL'])
+        self.start = time.monotonic()
+        self.steps = 0
+        self.exceeded = None
+        self._next_disconnect_check = self.start + self.DISCONNECT_CHECK_INTERVAL
+
+    @classmethod
+    def from_request(cls, env, query_dict):
+        '''
+        Budget requested with the X-Trough-Timeout and X-Trough-Max-Steps
+        headers or the `timeout` and `max_steps` query parameters, capped by
+        the READ_QUERY_MAX_TIMEOUT and READ_QUERY_MAX_STEPS settings. Raises
+        `ValueError` if a requested value is not a positive number.
+        '''
+        def requested(param, header, convert):
+            value = query_dict.get(param, [env.get(header)])[0]
+            if value is None:
+                return None
+            value = convert(value)
+            if not value > 0:
+                raise ValueError('%s must be positive' % param)
+            return value
+        def capped(value, maximum):
+            if value is None:
+                return maximum or None
+            return min(value, maximum) if maximum else value
+        timeout = requested('timeout', 'HTTP_X_TROUGH_TIMEOUT', float)
+        if timeout is None:
+            timeout = float(settings['READ_QUERY_TIMEOUT']) or None
+        timeout = capped(timeout, float(settings['READ_QUERY_MAX_TIMEOUT']))
+        max_steps = capped(
+                requested('max_steps', 'HTTP_X_TROUGH_MAX_STEPS', int),
+                int(settings['READ_QUERY_MAX_STEPS']))
+        return cls(timeout, max_steps, client_disconnected_check())
+
+    def remaining(self):
+        '''Seconds left, or None if there is no time limit.'''
+        if self.timeout is None:
+            return None
+        return max(self.timeout - (time.monotonic() - self.start), 0.0)
+
+    def install(self, connection):
+        connection.set_progress_handler(self, self.interval)
+
+    def __call__(self):
+        self.steps += self.interval
+        if self.max_steps and self.steps > self.max_steps:
+            self.exceeded = 'steps'
+        elif self.timeout or self.disconnected:
+            now = time.monotonic()
+            if self.timeout and now - self.start > self.timeout:
+                self.exceeded = 'time'
+            elif self.disconnected and now >= self._next_disconnect_check:
+                self._next_disconnect_check = now + self.DISCONNECT_CHECK_INTERVAL
+                if self.disconnected():
+                    self.exceeded = 'disconnect'
+        # nonzero interrupts the query
+        return 1 if self.exceeded else 0
+
+def client_disconnected_check():
+    '''Returns a function that says whether the client of the current uwsgi
+    request has disconnected, or None when not running under uwsgi.'''
+    if uwsgi is None:
+        return None
+    fd = uwsgi.connection_fd()
+    return lambda: not uwsgi.is_connected(fd)
+
+class PageConflict(Exception):
+    pass
+
+# result formats that encode a result as a json value, which batch reads
+# need to be able to nest results in their response
+BATCH_FORMATS = ('json', 'compact')
+
+class BadReadRequest(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class ReadRequest:
+    '''A parsed read request, see `ReadServer.parse_request()`.'''
+    segment_id = None
+    segment = None
+    # the request body, and the sql to run, which differ for bound queries
+    body = None
+    query = None
+    content_type = None
+    params = None
+    budget = None
+    result_format = None
+    # content encoding to compress the response with, None for none, see
+    # `trough.compression`
+    encoding = None
+    # pagination parameters, see `ReadServer.read_page()`
+    page = None
+    # `[(label, sql, params), ...]` for a batch read, see
+    # `ReadServer.batch_result_iter()`
+    queries = None
+
+def quote_identifier(name):
+    return '"%s"' % name.replace('"', '""')
+
+def page_check(sql, key, params):
+    '''Fingerprint of a paginated query, so that a continuation token can't
+    be used with a different one.'''
+    h = hashlib.sha1()
+    for part in (trough.cache.normalize_sql(sql), repr(list(key)), repr(params)):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()[:16]
+
+def encode_continuation(key_values, identity, check):
+    '''
+    Returns the opaque continuation token of a page of a paginated read: the
+    key of the last row, the identity of the segment file the page was read
+    from (None if the file is being written to), and the `page_check()` of
+    the query.
+    '''
+    token = {
+        'key': trough.sync.encode_params(list(key_values)),
+        'identity': list(identity) if identity is not None else None,
+        'check': check,
+    }
+    return base64.urlsafe_b64encode(
+            json.dumps(token, separators=(',', ':')).encode('utf-8')
+            ).decode('ascii').rstrip('=')
+
+def decode_continuation(token):
+    '''Inverse of `encode_continuation()`. Returns `(key_values, identity,
+    check)`. Raises `ValueError` if `token` is malformed.'''
+    try:
+        token = json.loads(base64.urlsafe_b64decode(
+            token + '=' * (-len(token) % 4)).decode('utf-8'))
+        key_values = trough.sync.decode_params(token['key'])
+        identity = token['identity']
+        return key_values, tuple(identity) if identity is not None else None, token['check']
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError('bad continuation token: %s' % e)
+
+class PooledConnection(sqlite3.Connection):
+    '''sqlite3 connection that remembers which file, and which version of the
+    file, it was opened against, and how, and the budget of the query
+    running on it, if any.'''
+    path = None
+    identity = None
+    immutable = False
+    budget = None
+
+class ConnectionPool:
+    '''
+    Bounded, thread-safe pool of open read-only sqlite connections, keyed by
+    segment path and open mode.
+
+    Connections are opened `immutable` for segments nobody writes to locally:
+    sqlite then skips file locking and change detection entirely. That is
+    safe because the sync loop never modifies those files in place, it
+    renames a fresh copy over them, and renaming changes the identity
+    checked below. Segments that are write locked on this node are opened
+    plain `mode=ro`.
+
+    Idle connections are kept per (path, mode), most recently used last. When
+    more than `max_size` connections are idle, all idle connections of the
+    least recently used key are closed. Every checkout stats the file, and if
+    its inode or mtime changed since the idle connections were opened (for
+    example because `LocalSyncController.copy_segment_from_hdfs` swapped in a
+    new copy), those connections are discarded instead of reused.
+    '''
+    def __init__(self, max_size=None, max_per_segment=None):
+        self.max_size = int(max_size or settings['READ_CONNECTION_POOL_SIZE'])
+        self.max_per_segment = int(
+                max_per_segment or settings['READ_CONNECTION_POOL_PER_SEGMENT'])
+        self._lock = threading.Lock()
+        # { (path, immutable): (identity, [idle connections]) }
+        self._idle = collections.OrderedDict()
+        self._idle_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def connect(self, path, immutable=False):
+        if immutable and any(os.path.exists(path + suffix)
+                             for suffix in ('-journal', '-wal')):
+            # somebody is writing to it after all
+            logging.warning(
+                    'not opening %s immutable, it has a journal or wal file',
+                    path)
+            immutable = False
+        uri = 'file:%s?mode=ro%s' % (
+                urllib.parse.quote(path), '&immutable=1' if immutable else '')
+        connection = sqlite3.connect(
+                uri, uri=True, check_same_thread=False,
+                factory=PooledConnection,
+                cached_statements=int(settings['READ_STATEMENT_CACHE_SIZE']))
+        trough.sync.setup_connection(connection)
+        connection.execute('PRAGMA mmap_size = %d' % int(settings['READ_MMAP_SIZE']))
+        connection.execute('PRAGMA cache_size = %d' % int(settings['READ_CACHE_SIZE']))
+        connection.execute('PRAGMA temp_store = %s' % settings['READ_TEMP_STORE'])
+        connection.set_authorizer(read_only_authorizer)
+        return connection
+
+    def checkout(self, path, immutable=False):
+        '''Returns an open connection to `path`, reusing an idle one if the
+        file has not changed since it was opened.'''
+        identity = file_identity(path)
+        key = (path, immutable)
+        stale = []
+        with self._lock:
+            entry = self._idle.get(key)
+            if entry and entry[0] != identity:
+                stale = entry[1]
+                self._idle_count -= len(stale)
+                del self._idle[key]
+                self.invalidations += 1
+            elif entry and entry[1]:
+                self._idle_count -= 1
+                self._idle.move_to_end(key)
+                self.hits += 1
+                return entry[1].pop()
+            self.misses += 1
+        for connection in stale:
+            connection.close()
+        if stale:
+            logging.debug(
+                    'discarded %s pooled connections to %s (file changed)',
+                    len(stale), path)
+        connection = self.connect(path, immutable)
+        connection.path = path
+        connection.identity = identity
+        # file under the requested mode, even if `connect()` fell back
+        connection.immutable = immutable
+        return connection
+
+    def checkin(self, connection, discard=False):
+        '''Returns `connection` to the pool, or closes it if `discard` is
+        true, the pool is full, or the file changed while it was in use.'''
+        to_close = []
+        key = (connection.path, connection.immutable)
+        if connection.budget is not None and not discard:
+            connection.set_progress_handler(None, 0)
+        connection.budget = None
+        with self._lock:
+            entry = self._idle.get(key)
+            if discard or (entry and (
+                    entry[0] != connection.identity
+                    or len(entry[1]) >= self.max_per_segment)):
+                to_close.append(connection)
+            else:
+                if entry is None:
+                    entry = (connection.identity, [])
+                    self._idle[key] = entry
+                entry[1].append(connection)
+                self._idle.move_to_end(key)
+                self._idle_count += 1
+            while self._idle_count > self.max_size:
+                _, (_, connections) = self._idle.popitem(last=False)
+                self._idle_count -= len(connections)
+                self.evictions += len(connections)
+                to_close.extend(connections)
+        for connection in to_close:
+            connection.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'idle_connections': self._idle_count,
+                'segments': len(self._idle),
+            }
+
 class ReadServer:
     def __init__(self):
         self.rethinker = doublethink.Rethinker(db="trough_configuration", servers=settings['RETHINKDB_HOSTS'])
         self.services = doublethink.ServiceRegistry(self.rethinker)
         self.registry = trough.sync.HostRegistry(rethinker=self.rethinker, services=self.services)
+        self.pool = ConnectionPool()
+        self.write_locks = trough.sync.WriteLockView(self.rethinker)
+        metrics = trough.metrics.registry
+        metrics.gauge(
+                'trough_write_lock_feed_up',
+                'whether the write lock changefeed is live',
+                fn=lambda: int(self.write_locks.ready), merge='min')
+        metrics.gauge(
+                'trough_write_lock_staleness_seconds',
+                'seconds since the local write lock view was last known current',
+                fn=self.write_locks.staleness, merge='max')
+        metrics.counter(
+                'trough_write_lock_feed_reconnects_total',
+                'write lock changefeed reconnects',
+                fn=lambda: self.write_locks.reconnects)
+        metrics.counter(
+                'trough_write_lock_lookups_total',
+                'write lock lookups',
+                fn=lambda: self.write_locks.lookups)
+        metrics.counter(
+                'trough_write_lock_fallback_lookups_total',
+                'write lock lookups that went to rethinkdb',
+                fn=lambda: self.write_locks.fallback_lookups)
+        # keep-alive connections to write hosts, for proxied reads
+        self.proxy_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+                pool_connections=int(settings['READ_PROXY_POOL_HOSTS']),
+                pool_maxsize=int(settings['READ_PROXY_POOL_SIZE']))
+        self.proxy_session.mount('http://', adapter)
+        metrics.counter(
+                'trough_proxy_requests_total',
+                'reads proxied to the write host of a segment')
+        metrics.counter(
+                'trough_proxy_errors_total',
+                'proxied reads that failed before the response was relayed')
+        metrics.counter(
+                'trough_proxy_request_bytes_total',
+                'query bytes sent to write hosts')
+        metrics.counter(
+                'trough_proxy_response_bytes_total',
+                'response bytes relayed from write hosts')
+        metrics.counter(
+                'trough_proxy_headers_seconds_total',
+                'time spent waiting for write hosts to start responding')
+        metrics.counter(
+                'trough_proxy_seconds_total',
+                'time spent on proxied reads, including relaying the response')
+        metrics.counter(
+                'trough_read_compressed_responses_total',
+                'read responses sent compressed')
+        metrics.counter(
+                'trough_read_compression_input_bytes_total',
+                'bytes of read responses before compression')
+        metrics.counter(
+                'trough_read_compression_output_bytes_total',
+                'bytes of read responses after compression')
+        metrics.counter(
+                'trough_read_interrupted_total',
+                'read queries interrupted because they ran out of time or '
+                'sqlite steps, or because the client disconnected')
+        metrics.histogram(
+                'trough_read_request_seconds',
+                'read request latency, until the whole response is sent, by '
+                'segment class, route (local or proxy) and outcome')
+        metrics.counter(
+                'trough_read_response_bytes_total',
+                'read response bytes sent, by segment class')
+        metrics.counter(
+                'trough_read_rows_total',
+                'result rows read from sqlite')
+        metrics.counter(
+                'trough_read_sqlite_seconds_total',
+                'time spent in sqlite running read queries and fetching rows')
+        metrics.counter(
+                'trough_read_serialize_seconds_total',
+                'time spent encoding result rows')
+        for name, help in (
+                ('hits', 'checkouts that reused an idle connection'),
+                ('misses', 'checkouts that opened a new connection'),
+                ('evictions', 'idle connections closed because the pool was full'),
+                ('invalidations', 'times idle connections were discarded because their file changed')):
+            metrics.counter(
+                    'trough_read_pool_%s_total' % name, 'read connection pool %s' % help,
+                    fn=lambda name=name: self.pool.stats()[name])
+        metrics.gauge(
+                'trough_read_pool_idle_connections',
+                'idle connections in the read connection pool',
+                fn=lambda: self.pool.stats()['idle_connections'])
+        self.result_cache = None
+        if int(settings['READ_RESULT_CACHE_BYTES']) > 0:
+            self.result_cache = trough.cache.ResultCache()
+            for name in ('hits', 'misses', 'stores', 'evictions'):
+                metrics.counter(
+                        'trough_result_cache_%s_total' % name,
+                        'result cache %s' % name,
+                        fn=lambda name=name: self.result_cache.stats()[name])
+        # segments whose cached results were dropped because they have a
+        # write lock on this node; shared by the threads serving requests
+        self._write_locked_segments = set()
+        self._write_locked_segments_lock = threading.Lock()
         trough.sync.init(self.rethinker)
 
-    def proxy_for_write_host(self, node, segment, query, start_response):
+    def proxy_request(self, node, segment, result_format='json', content_type=None, budget=None, page=None, encoding=None):
+        '''Returns the `(url, headers)` to send a read of `segment` to its
+        write host `node` with. The write host is asked to compress the
+        response with `encoding`, if any, so that it can be relayed as is.'''
         # enforce that we are querying the correct database, send an explicit hostname.
         write_url = "http://{node}:{port}/?segment={segment}".format(node=node, segment=segment.id, port=settings['READ_PORT'])
-        with requests.post(write_url, stream=True, data=query) as r:
-            status_line = '{status_code} {reason}'.format(status_code=r.status_code, reason=r.reason)
-            # headers [('Content-Type','application/json')]
-            headers = [("Content-Type", r.headers['Content-Type'],)]
-            start_response(status_line, headers)
-            for chunk in r.iter_content():
+        if result_format != 'json':
+            write_url += '&format=%s' % result_format
+        if page:
+            # pagination parameters, `{'page_size': ..., 'key': ..., 'cursor': ...}`
+            write_url += '&' + urllib.parse.urlencode(page)
+        headers = {'Content-Type': content_type} if content_type else {}
+        headers['Accept-Encoding'] = encoding or 'identity'
+        if budget is not None:
+            # the write host enforces what is left of the budget
+            if budget.timeout:
+                headers['X-Trough-Timeout'] = '%.3f' % max(budget.remaining(), 0.001)
+            if budget.max_steps:
+                headers['X-Trough-Max-Steps'] = str(budget.max_steps)
+        return write_url, headers
+
+    def proxy_for_write_host(self, node, segment, query, start_response, result_format='json', content_type=None, budget=None, page=None, encoding=None):
+        write_url, headers = self.proxy_request(node, segment, result_format, content_type, budget, page, encoding)
+        metrics = trough.metrics.registry
+        start = time.time()
+        size = 0
+        completed = False
+        try:
+            with self.proxy_session.post(write_url, stream=True, data=query, headers=headers) as r:
+                metrics.inc('trough_proxy_headers_seconds_total', time.time() - start, node=node)
+                metrics.inc('trough_proxy_requests_total', node=node, status=r.status_code)
+                status_line = '{status_code} {reason}'.format(status_code=r.status_code, reason=r.reason)
+                # headers [('Content-Type','application/json')]
+                headers = [("Content-Type", r.headers['Content-Type'],)]
+                for name in ('X-Trough-Continuation', 'Content-Encoding', 'Vary'):
+                    if name in r.headers:
+                        headers.append((name, r.headers[name]))
+                start_response(status_line, headers)
+                # relay compressed responses without decompressing them
+                for chunk in r.raw.stream(int(settings['READ_PROXY_CHUNK_SIZE']), decode_content=False):
+                    size += len(chunk)
+                    yield chunk
+                completed = True
+        finally:
+            if not completed:
+                metrics.inc('trough_proxy_errors_total', node=node)
+            metrics.inc('trough_proxy_request_bytes_total', len(query), node=node)
+            metrics.inc('trough_proxy_response_bytes_total', size, node=node)
+            metrics.inc('trough_proxy_seconds_total', time.time() - start, node=node)
+
+    def cached_result_iter(self, cursor, segment, identity, query, result_format, params=None):
+        '''Streams the result like `sql_result_iter`, storing the whole
+        result in the result cache if it streamed successfully and fits the
+        per-entry size cap.'''
+        completed = []
+        body = []
+        size = 0
+        for chunk in self.sql_result_iter(
+                cursor, result_format,
+                on_complete=lambda: completed.append(True)):
+            yield chunk
+            if body is not None:
+                size += len(chunk)
+                if size > self.result_cache.max_entry_bytes:
+                    body = None
+                else:
+                    body.append(chunk)
+        if body is not None and completed:
+            self.result_cache.put(
+                    segment.id, identity, query.decode('utf-8'),
+                    b''.join(body), variant=result_format.name, params=params)
+
+    def sql_result_iter(self, cursor, result_format, on_complete=None, batch_size=None):
+        '''
+        Streams the rows of `cursor`, encoded with `result_format` (see
+        `trough.formats`). Rows are fetched `batch_size` at a time and each
+        batch is encoded into a single chunk, which keeps the number of
+        (tiny) writes down for big results.
+        '''
+        budget = cursor.connection.budget
+        failed = False
+        try:
+            for chunk in self.encode_rows(cursor, result_format, batch_size):
                 yield chunk
+            if on_complete:
+                on_complete()
+        except GeneratorExit:
+            # the server stopped iterating, most likely the client went away
+            if budget is not None:
+                budget.exceeded = 'disconnect'
+                self.count_interrupted(budget.exceeded)
+            raise
+        except Exception as e:
+            failed = True
+            if budget is not None and budget.exceeded:
+                # the response is cut short, it is too late for an error status
+                logging.warning(
+                        'stopped streaming response: %s',
+                        QueryBudgetExceeded(budget))
+                self.count_interrupted(budget.exceeded)
+            else:
+                logging.error('exception in middle of streaming response', exc_info=1)
+        finally:
+            # close the cursor 'finally', in case there is an Exception.
+            cursor.close()
+            self.pool.checkin(cursor.connection, discard=failed)
 
-    def sql_result_json_iter(self, cursor):
-        first = True
-        yield b"["
+    def encode_rows(self, cursor, result_format, batch_size=None):
+        '''Yields the rows of `cursor` encoded with `result_format`, a batch
+        of `batch_size` rows per chunk, from header to footer.'''
+        batch_size = int(batch_size or settings['READ_FETCH_BATCH_SIZE'])
+        columns = [column[0] for column in cursor.description]
+        row_count = 0
+        sqlite_seconds = serialize_seconds = 0.0
         try:
+            prefix = result_format.header(columns)
+            first = True
             while True:
-                row = cursor.fetchone()
-                if not row:
+                start = time.perf_counter()
+                rows = cursor.fetchmany(batch_size)
+                fetched = time.perf_counter()
+                sqlite_seconds += fetched - start
+                if not rows:
                     break
-                if not first:
-                    yield b",\n"
-                output = dict((cursor.description[i][0], value) for i, value in enumerate(row))
-                yield ujson.dumps(output, escape_forward_slashes=False).encode('utf-8')
+                row_count += len(rows)
+                chunk = prefix + result_format.batch(columns, rows, first)
+                serialize_seconds += time.perf_counter() - fetched
+                yield chunk
+                prefix = b""
                 first = False
-            yield b"]\n"
+            yield prefix + result_format.footer(columns, first)
+        finally:
+            self.count_rows(row_count, sqlite_seconds, serialize_seconds)
+
+    def count_rows(self, rows, sqlite_seconds, serialize_seconds=0.0):
+        metrics = trough.metrics.registry
+        metrics.inc('trough_read_rows_total', rows)
+        metrics.inc('trough_read_sqlite_seconds_total', sqlite_seconds)
+        metrics.inc('trough_read_serialize_seconds_total', serialize_seconds)
+
+    def batch_result_iter(self, connection, queries, result_format, batch_size=None):
+        '''
+        Runs `queries`, a list of `(label, sql, params)`, one after the other
+        on `connection` (see `checkout()`), inside one read transaction, so
+        that they all see the same snapshot of the segment. Streams their
+        results as a json array, in order, of
+
+            {"label": label, "result": <result encoded with result_format>}
+
+        or, for a query that could not be run,
+
+            {"label": label, "error": "message"}
+
+        The queries share one budget; once it runs out the remaining
+        queries are not run. `result_format` must encode a result as a json
+        value, see `BATCH_FORMATS`.
+        '''
+        budget = connection.budget
+        failed = False
+        try:
+            self.set_transaction(connection, 'BEGIN')
+            for i, (label, sql, params) in enumerate(queries):
+                head = '%s{"label":%s,' % ('[' if i == 0 else ',\n', json.dumps(label))
+                error = None
+                if budget is not None and budget.exceeded:
+                    error = 'not run: %s' % QueryBudgetExceeded(budget)
+                else:
+                    try:
+                        cursor = self.run_query(connection, sql.encode('utf-8'), params)
+                    except QueryBudgetExceeded as e:
+                        self.count_interrupted(e.reason)
+                        error = str(e)
+                    except (NotASelectQuery, sqlite3.Error) as e:
+                        error = str(e)
+                if error is not None:
+                    yield ('%s"error":%s}' % (head, json.dumps(error))).encode('utf-8')
+                    continue
+                try:
+                    yield ('%s"result":' % head).encode('utf-8')
+                    for chunk in self.encode_rows(cursor, result_format, batch_size):
+                        yield chunk
+                    yield b'}'
+                finally:
+                    cursor.close()
+            yield b']\n'
+            self.set_transaction(connection, 'ROLLBACK')
+        except GeneratorExit:
+            failed = True
+            if budget is not None:
+                budget.exceeded = 'disconnect'
+                self.count_interrupted(budget.exceeded)
+            raise
         except Exception as e:
-            logging.error('exception in middle of streaming response', exc_info=1)
+            failed = True
+            if budget is not None and budget.exceeded:
+                # the response is cut short, it is too late for an error status
+                logging.warning(
+                        'stopped streaming response: %s',
+                        QueryBudgetExceeded(budget))
+                self.count_interrupted(budget.exceeded)
+            else:
+                logging.error('exception in middle of streaming response', exc_info=1)
         finally:
-            # close the cursor 'finally', in case there is an Exception.
+            # a connection left in a transaction is not reused
+            self.pool.checkin(connection, discard=failed)
+
+    def set_transaction(self, connection, statement):
+        '''Runs BEGIN or ROLLBACK on `connection`, which
+        `read_only_authorizer` otherwise refuses.'''
+        connection.set_authorizer(None)
+        try:
+            connection.execute(statement)
+        finally:
+            connection.set_authorizer(read_only_authorizer)
+
+    def sql_result_json_iter(self, cursor, on_complete=None, batch_size=None):
+        '''Streams the rows of `cursor` as a json array of objects.'''
+        return self.sql_result_iter(
+                cursor, trough.formats.JsonFormat(), on_complete=on_complete,
+                batch_size=batch_size)
+
+    def read_page(self, segment, query, result_format, key, page_size, continuation=None, immutable=False, params=None, budget=None):
+        '''
+        Reads one page of a keyset paginated read: at most `page_size` rows of
+        the result of `query`, ordered by the result columns named in `key`,
+        which must be unique and not null (a primary key, say), starting
+        after the row the `continuation` token points at. Because pages
+        start from a key rather than an offset, each page is an index seek
+        no matter how deep into the result it is.
+
+        Returns `(body, token)`, where `body` is the page encoded in
+        `result_format` and `token` is the continuation token of the next
+        page, or None if this is the last one. Raises `PageConflict` if the
+        segment file has been replaced since the token was issued, and
+        `ValueError` if the token is bad or was issued for another query.
+        '''
+        sql = trough.cache.normalize_sql(query.decode('utf-8'))
+        check = page_check(sql, key, params)
+        after = identity = None
+        if continuation:
+            after, identity, token_check = decode_continuation(continuation)
+            if token_check != check:
+                raise ValueError('continuation token is for a different query')
+            if len(after) != len(key):
+                raise ValueError('continuation token does not match the key')
+        key_list = ', '.join(quote_identifier(k) for k in key)
+        paged = 'SELECT * FROM (%s)' % sql
+        if after is not None:
+            if isinstance(params, dict):
+                placeholders = [':_trough_after%d' % i for i in range(len(key))]
+                params = dict(params)
+                params.update(('_trough_after%d' % i, v) for i, v in enumerate(after))
+            else:
+                placeholders = ['?'] * len(key)
+                params = tuple(params or ()) + tuple(after)
+            paged += ' WHERE (%s) > (%s)' % (key_list, ', '.join(placeholders))
+        paged += ' ORDER BY %s LIMIT %d' % (key_list, page_size + 1)
+
+        cursor = self.execute_query(segment, paged.encode('utf-8'), immutable, params, budget)
+        failed = True
+        try:
+            if identity is not None and immutable and cursor.connection.identity != identity:
+                raise PageConflict(
+                        'segment %s has changed since the pagination started'
+                        % segment.id)
+            columns = [column[0] for column in cursor.description]
+            lowered = [column.lower() for column in columns]
+            try:
+                key_indexes = [lowered.index(k.lower()) for k in key]
+            except ValueError:
+                raise ValueError('key columns %r must all be in the result' % (key,))
+            start = time.perf_counter()
+            try:
+                rows = cursor.fetchall()
+            except sqlite3.OperationalError as e:
+                if budget is not None and budget.exceeded:
+                    raise QueryBudgetExceeded(budget) from e
+                raise
+            finally:
+                sqlite_seconds = time.perf_counter() - start
+            failed = False
+        finally:
+            page_identity = cursor.connection.identity
             cursor.close()
-            cursor.connection.close()
-
-    def execute_query(self, segment, query):
-        '''Returns a cursor.'''
-        logging.info('Servicing request: {query}'.format(query=query))
-        # if the user sent more than one query, or the query is not a SELECT, raise an exception.
-        if len(sqlparse.split(query)) != 1 or sqlparse.parse(query)[0].get_type() != 'SELECT':
-            raise Exception('Exactly one SELECT query per request, please.')
+            self.pool.checkin(cursor.connection, discard=failed)
+        token = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            token = encode_continuation(
+                    [rows[-1][i] for i in key_indexes],
+                    page_identity if immutable else None, check)
+        start = time.perf_counter()
+        body = result_format.header(columns)
+        if rows:
+            body += result_format.batch(columns, rows, True)
+        body += result_format.footer(columns, not rows)
+        self.count_rows(len(rows), sqlite_seconds, time.perf_counter() - start)
+        return body, token
+
+    def count_interrupted(self, reason):
+        trough.metrics.registry.inc('trough_read_interrupted_total', reason=reason)
+
+    def execute_query(self, segment, query, immutable=False, params=None, budget=None):
+        '''Returns a cursor. `immutable` opens the segment in the read
+        optimized mode, see `ConnectionPool`; only pass it for segments that
+        are not being written to. `params`, if not None, are bound to the
+        query's placeholders. `budget`, a `QueryBudget`, limits the query for
+        as long as it and the streaming of its result run; raises
+        `QueryBudgetExceeded` if it runs out before the first row.'''
+        logging.debug('Servicing request: %r', query)
+        connection = self.checkout(segment, immutable, budget)
+        try:
+            return self.run_query(connection, query, params)
+        except:
+            self.pool.checkin(connection, discard=True)
+            raise
+
+    def checkout(self, segment, immutable=False, budget=None):
+        '''Returns a pooled connection to `segment`, limited by `budget`
+        until it is checked back in; see `execute_query()`.'''
         assert os.path.isfile(segment.local_path())
+        logging.debug("Connecting to sqlite database: {segment}".format(segment=segment.local_path()))
+        connection = self.pool.checkout(segment.local_path(), immutable)
+        if budget is not None:
+            budget.install(connection)
+            connection.budget = budget
+        return connection
 
-        logging.info("Connecting to sqlite database: {segment}".format(segment=segment.local_path()))
-        connection = sqlite3.connect(segment.local_path())
-        trough.sync.setup_connection(connection)
+    def run_query(self, connection, query, params=None):
+        '''Runs `query` on `connection` and returns the cursor, or raises
+        `NotASelectQuery` or `QueryBudgetExceeded`.'''
+        budget = connection.budget
         cursor = connection.cursor()
-        cursor.execute(query.decode('utf-8'))
+        # sqlite itself enforces one statement per request (the sqlite3
+        # module refuses to execute more than one) and that it is a
+        # SELECT (see `read_only_authorizer`)
+        start = time.perf_counter()
+        try:
+            try:
+                if params is None:
+                    cursor.execute(query.decode('utf-8'))
+                else:
+                    cursor.execute(query.decode('utf-8'), params)
+            except (sqlite3.Warning, sqlite3.ProgrammingError) as e:
+                if 'one statement at a time' in str(e):
+                    raise NotASelectQuery() from e
+                raise
+            except sqlite3.DatabaseError as e:
+                if str(e) == 'not authorized':
+                    raise NotASelectQuery() from e
+                if budget is not None and budget.exceeded:
+                    raise QueryBudgetExceeded(budget) from e
+                raise
+            if cursor.description is None:
+                # empty or comment-only query
+                raise NotASelectQuery()
+        except:
+            cursor.close()
+            raise
+        finally:
+            trough.metrics.registry.inc(
+                    'trough_read_sqlite_seconds_total', time.perf_counter() - start)
         return cursor
 
+    def page_response(self, segment, query, result_format, page, immutable, params, budget, start_response):
+        '''Serves a page of a paginated read, see `read_page()`.'''
+        try:
+            page_size = int(page.get('page_size', settings['READ_PAGE_MAX_SIZE']))
+            if page_size < 1:
+                raise ValueError('page_size must be positive')
+            page_size = min(page_size, int(settings['READ_PAGE_MAX_SIZE']))
+            if not page.get('key'):
+                raise ValueError('paginated reads need ?key=column[,column...]')
+            key = [k.strip() for k in page['key'].split(',')]
+            body, token = self.read_page(
+                    segment, query, result_format, key, page_size,
+                    page.get('cursor'), immutable, params, budget)
+        except PageConflict as e:
+            start_response('409 Conflict', [('Content-Type', 'text/plain')])
+            return [('409 Conflict: %s\n' % e).encode('utf-8')]
+        except ValueError as e:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return [('400 Bad Request: %s\n' % e).encode('utf-8')]
+        headers = [('Content-Type', result_format.content_type)]
+        if token:
+            headers.append(('X-Trough-Continuation', token))
+        start_response('200 OK', headers)
+        return [body]
+
+    def metrics(self, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [trough.metrics.registry.render().encode('utf-8')]
+
+    def parse_request(self, env):
+        '''
+        Parses the WSGI environ of a read request. Returns a `ReadRequest`,
+        or raises `BadReadRequest` with the error status to answer with.
+        '''
+        request = ReadRequest()
+        query_dict = urllib.parse.parse_qs(env['QUERY_STRING'])
+        # use the ?segment= query string variable or the host string to figure out which sqlite database to talk to.
+        request.segment_id = query_dict.get('segment', env.get('HTTP_HOST', "").split("."))[0]
+        request.segment = trough.sync.Segment(segment_id=request.segment_id, size=0, rethinker=self.rethinker, services=self.services, registry=self.registry)
+        content_length = int(env.get('CONTENT_LENGTH', 0))
+        request.query = request.body = env.get('wsgi.input').read(content_length)
+        request.content_type = env.get('CONTENT_TYPE')
+        if request.content_type and request.content_type.split(';')[0].strip() == trough.sync.BOUND_QUERY_CONTENT_TYPE:
+            try:
+                sql, request.params, request.queries = trough.sync.parse_bound_read(request.body)
+            except ValueError as e:
+                raise BadReadRequest('400 Bad Request', str(e))
+            if request.queries is None:
+                request.query = sql.encode('utf-8')
+            elif len(request.queries) > int(settings['READ_BATCH_MAX_QUERIES']):
+                raise BadReadRequest(
+                        '400 Bad Request', 'too many queries in batch, the '
+                        'limit is %s' % settings['READ_BATCH_MAX_QUERIES'])
+
+        try:
+            request.budget = QueryBudget.from_request(env, query_dict)
+        except ValueError as e:
+            raise BadReadRequest('400 Bad Request', 'bad query budget: %s' % e)
+
+        try:
+            request.result_format = trough.formats.get_format(trough.formats.negotiate(
+                query_dict.get('format', [None])[0], env.get('HTTP_ACCEPT')))
+        except trough.formats.UnsupportedFormat as e:
+            raise BadReadRequest('406 Not Acceptable', str(e))
+
+        request.encoding = trough.compression.negotiate(env.get('HTTP_ACCEPT_ENCODING'))
+
+        request.page = {
+            name: query_dict[name][0] for name in ('page_size', 'key', 'cursor')
+            if name in query_dict}
+        if request.queries is not None:
+            if request.page:
+                raise BadReadRequest('400 Bad Request', 'batch reads can not be paginated')
+            if request.result_format.name not in BATCH_FORMATS:
+                raise BadReadRequest(
+                        '406 Not Acceptable', 'batch reads support formats %s'
+                        % ', '.join(BATCH_FORMATS))
+        return request
+
+    def serve_local(self, request, write_lock, start_response):
+        '''Answers `request` from the local copy of the segment, compressed
+        if the client accepts it (see `compress_response()`). Returns the
+        WSGI response iterable.'''
+        response = []
+        def capture(status, headers):
+            response.append((status, headers))
+        iterable = self.local_response(request, write_lock, capture)
+        status, headers = response[0]
+        if request.encoding and status.startswith('200'):
+            headers, iterable = self.compress_response(iterable, headers, request.encoding)
+        start_response(status, headers)
+        return iterable
+
+    def compress_response(self, iterable, headers, encoding):
+        '''
+        Returns `(headers, iterable)` for a response compressed with
+        `encoding`, or the response as it is if the whole of it is smaller
+        than READ_COMPRESSION_MIN_SIZE. Decides by reading ahead up to that
+        many bytes of `iterable`, which runs the query, before the status
+        line goes out.
+        '''
+        iterator = iter(iterable)
+        buffered = []
+        size = 0
+        min_size = int(settings['READ_COMPRESSION_MIN_SIZE'])
+        for chunk in iterator:
+            buffered.append(chunk)
+            size += len(chunk)
+            if size >= min_size:
+                break
+        else:
+            # all of it, and small
+            return headers, buffered
+        headers = headers + [('Content-Encoding', encoding), ('Vary', 'Accept-Encoding')]
+        return headers, self.compressed_iter(
+                itertools.chain(buffered, iterator), encoding,
+                close=getattr(iterable, 'close', None))
+
+    def compressed_iter(self, chunks, encoding, close=None):
+        '''Streams `chunks` compressed with `encoding`, a compressed chunk
+        per chunk. Calls `close` when done, or when closed itself.'''
+        encoder = trough.compression.get_encoder(encoding)
+        size_in = size_out = 0
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                size_in += len(chunk)
+                chunk = encoder.compress(chunk)
+                size_out += len(chunk)
+                yield chunk
+            chunk = encoder.finish()
+            size_out += len(chunk)
+            yield chunk
+        finally:
+            # lets the result iterator account for a disconnect and check
+            # its connection back in
+            if close:
+                close()
+            metrics = trough.metrics.registry
+            metrics.inc('trough_read_compressed_responses_total', encoding=encoding)
+            metrics.inc('trough_read_compression_input_bytes_total', size_in, encoding=encoding)
+            metrics.inc('trough_read_compression_output_bytes_total', size_out, encoding=encoding)
+
+    def local_response(self, request, write_lock, start_response):
+        '''Answers `request` from the local copy of the segment,
+        uncompressed; see `serve_local()`.'''
+        segment, query, params, budget = request.segment, request.query, request.params, request.budget
+        result_format = request.result_format
+        headers = [('Content-Type', result_format.content_type)]
+        immutable = bool(settings['READ_IMMUTABLE']) and not write_lock
+        if request.queries is not None:
+            logging.debug('Servicing batch of %s queries', len(request.queries))
+            connection = self.checkout(segment, immutable, budget)
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return self.batch_result_iter(connection, request.queries, result_format)
+        if request.page:
+            return self.page_response(
+                    segment, query, result_format, request.page, immutable,
+                    params, budget, start_response)
+        if self.result_cache:
+            if write_lock:
+                # results go stale as writes land, don't use the cache
+                with self._write_locked_segments_lock:
+                    if segment.id not in self._write_locked_segments:
+                        self.result_cache.invalidate(segment.id)
+                        self._write_locked_segments.add(segment.id)
+            elif self.result_cache.cacheable(query.decode('utf-8')):
+                with self._write_locked_segments_lock:
+                    self._write_locked_segments.discard(segment.id)
+                identity = file_identity(segment.local_path())
+                body = self.result_cache.get(
+                        segment.id, identity, query.decode('utf-8'),
+                        variant=result_format.name, params=params)
+                if body is not None:
+                    start_response('200 OK', headers)
+                    return [body]
+                cursor = self.execute_query(segment, query, immutable, params, budget)
+                start_response('200 OK', headers)
+                # key the stored result on the file the query actually ran against
+                return self.cached_result_iter(
+                        cursor, segment, cursor.connection.identity, query,
+                        result_format, params)
+        cursor = self.execute_query(segment, query, immutable, params, budget)
+        start_response('200 OK', headers)
+        return self.sql_result_iter(cursor, result_format)
+
+    def error_response(self, e, request, start_response):
+        '''Answers a request that failed with exception `e`.'''
+        if isinstance(e, BadReadRequest):
+            status, message = e.status, e.message
+        elif isinstance(e, QueryBudgetExceeded):
+            logging.warning('segment %s: %s query: %r', request.segment_id, e, request.query)
+            self.count_interrupted(e.reason)
+            status, message = '504 Gateway Timeout', str(e)
+        else:
+            logging.error('500 Server Error due to exception', exc_info=e)
+            status, message = '500 Server Error', str(e)
+        start_response(status, [('Content-Type', 'text/plain')])
+        return [('%s: %s\n' % (status, message)).encode('utf-8')]
+
+    def outcome(self, status, request):
+        '''The outcome label of a request answered with `status`.'''
+        code = int(status.split(' ', 1)[0]) if status else 500
+        if code == 200:
+            if request is not None and request.budget is not None and request.budget.exceeded:
+                # cut short while streaming
+                return 'disconnect' if request.budget.exceeded == 'disconnect' else 'interrupted'
+            return 'ok'
+        elif code == 504:
+            return 'interrupted'
+        elif 400 <= code < 500:
+            return 'client_error'
+        return 'error'
+
+    def observe_request(self, request, route, outcome, start, size):
+        '''Records the latency and response size of a read request.'''
+        metrics = trough.metrics.registry
+        segment_class = trough.metrics.segment_class(request.segment_id if request else None)
+        metrics.observe(
+                'trough_read_request_seconds', time.monotonic() - start,
+                segment_class=segment_class, route=route, outcome=outcome)
+        metrics.inc('trough_read_response_bytes_total', size, segment_class=segment_class)
+        metrics.maybe_snapshot()
+
+    def observed_iter(self, iterable, request, route, start, status):
+        '''Streams `iterable`, then records the request, see
+        `observe_request()`. `status` is a list the status line is
+        appended to once the response starts.'''
+        size = 0
+        outcome = 'error'
+        try:
+            for chunk in iterable:
+                size += len(chunk)
+                yield chunk
+            outcome = self.outcome(status[0] if status else None, request)
+        except GeneratorExit:
+            outcome = 'disconnect'
+            raise
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close:
+                close()
+            self.observe_request(request, route, outcome, start, size)
+
     # uwsgi endpoint
     def __call__(self, env, start_response):
+        if env.get('PATH_INFO') == '/metrics':
+            return self.metrics(start_response)
+        start = time.monotonic()
+        status = []
+        def observed_start_response(status_line, headers):
+            status.append(status_line)
+            return start_response(status_line, headers)
+        request = None
+        route = 'local'
         try:
-            query_dict = urllib.parse.parse_qs(env['QUERY_STRING'])
-            # use the ?segment= query string variable or the host string to figure out which sqlite database to talk to.
-            segment_id = query_dict.get('segment', env.get('HTTP_HOST', "").split("."))[0]
-            logging.info('Connecting to Rethinkdb on: %s' % settings['RETHINKDB_HOSTS'])
-            segment = trough.sync.Segment(segment_id=segment_id, size=0, rethinker=self.rethinker, services=self.services, registry=self.registry)
-            content_length = int(env.get('CONTENT_LENGTH', 0))
-            query = env.get('wsgi.input').read(content_length)
-
-            write_lock = segment.retrieve_write_lock()
+            request = self.parse_request(env)
+            write_lock = self.write_locks.get(request.segment.id)
             if write_lock and write_lock['node'] != settings['HOSTNAME']:
-                logging.info('Found write lock for {segment}. Proxying {query} to {host}'.format(segment=segment.id, query=query, host=write_lock['node']))
-                return self.proxy_for_write_host(write_lock['node'], segment, query, start_response)
-
-                ## # enforce that we are querying the correct database, send an explicit hostname.
-                ## write_url = "http://{node}:{port}/?segment={segment}".format(node=node, segment=segment.id, port=settings['READ_PORT'])
-                ## with requests.post(write_url, stream=True, data=query) as r:
-                ##     status_line = '{status_code} {reason}'.format(status_code=r.status_code, reason=r.reason)
-                ##     headers = [("Content-Type", r.headers['Content-Type'],)]
-                ##     start_response(status_line, headers)
-                ##     return r.iter_content()
-            cursor = self.execute_query(segment, query)
-            start_response('200 OK', [('Content-Type','application/json')])
-            return self.sql_result_json_iter(cursor)
+                logging.debug('Found write lock for %s. Proxying %r to %s', request.segment.id, request.query, write_lock['node'])
+                route = 'proxy'
+                iterable = self.proxy_for_write_host(write_lock['node'], request.segment, request.body, observed_start_response, request.result_format.name, request.content_type, request.budget, request.page, request.encoding)
+            else:
+                iterable = self.serve_local(request, write_lock, observed_start_response)
         except Exception as e:
-            logging.error('500 Server Error due to exception', exc_info=True)
-            start_response('500 Server Error', [('Content-Type', 'text/plain')])
-            return [('500 Server Error: %s\n' % str(e)).encode('utf-8')]
-
+            iterable = self.error_response(e, request, observed_start_response)
+        return self.observed_iter(iterable, request, route, start, status)
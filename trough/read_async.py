@@ -0,0 +1,269 @@
+'''
+trough/read_async.py - asyncio read server
+
+Serves the same protocol as `trough.read.ReadServer` (which it wraps), on
+aiohttp instead of a pool of uWSGI threads, so that slow clients and slow
+proxied reads only cost an open socket, not a thread:
+
+- sqlite work (running queries, fetching and encoding batches of rows) runs
+  on a bounded thread pool, `READ_ASYNC_THREADS` threads
+- the next batch of a streamed result is only fetched once the client has
+  taken the previous one, so a slow client holds back its own query rather
+  than piling up buffered output
+- at most `READ_ASYNC_SEGMENT_CONCURRENCY` queries run against any one
+  segment at once, the rest wait (counted against their time budget)
+- reads of segments that are write locked on another node are proxied with
+  a non-blocking http client, which relays compressed responses as they are
+
+Run it with `scripts/reader_async.py`.
+'''
+import trough
+from trough.settings import settings
+import asyncio
+import concurrent.futures
+import io
+import logging
+import time
+import aiohttp
+from aiohttp import web
+
+class AsyncReadServer:
+    def __init__(self, read_server=None, threads=None, segment_concurrency=None):
+        self.server = read_server or trough.read.ReadServer()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=int(threads or settings['READ_ASYNC_THREADS']))
+        self.segment_concurrency = int(
+                segment_concurrency or settings['READ_ASYNC_SEGMENT_CONCURRENCY'])
+        # { segment_id: [semaphore, number of requests holding or waiting for it] }
+        self._segments = {}
+        self.session = None
+        self.in_flight = 0
+        metrics = trough.metrics.registry
+        metrics.gauge(
+                'trough_async_read_requests_in_flight',
+                'requests being served by the asyncio read server',
+                fn=lambda: self.in_flight)
+        metrics.gauge(
+                'trough_async_read_segment_waiters',
+                'requests waiting for their turn at a busy segment',
+                fn=self.waiters)
+        metrics.counter(
+                'trough_async_read_segment_waits_total',
+                'requests that had to wait for their turn at a busy segment')
+
+    def waiters(self):
+        return sum(
+                max(count - self.segment_concurrency, 0)
+                for _, count in self._segments.values())
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route('GET', '/metrics', self.metrics)
+        app.router.add_route('*', '/', self.handle)
+        app.on_startup.append(self.start_session)
+        app.on_cleanup.append(self.close_session)
+        return app
+
+    async def start_session(self, app):
+        connector = aiohttp.TCPConnector(
+                limit=int(settings['READ_PROXY_POOL_HOSTS']) * int(settings['READ_PROXY_POOL_SIZE']),
+                limit_per_host=int(settings['READ_PROXY_POOL_SIZE']))
+        # no overall timeout, proxied results stream for as long as they
+        # take; compressed results are relayed as they are
+        self.session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=None),
+                auto_decompress=False)
+
+    async def close_session(self, app):
+        await self.session.close()
+        self.executor.shutdown(wait=False)
+
+    async def run_sync(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+
+    async def metrics(self, request):
+        return web.Response(
+                body=trough.metrics.registry.render().encode('utf-8'),
+                headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+    def environ(self, request, body):
+        '''The parts of a WSGI environ `ReadServer.parse_request()` looks at.'''
+        env = {
+            'QUERY_STRING': request.query_string,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+        }
+        for name, value in request.headers.items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            env[key] = value
+        return env
+
+    def error_response(self, e, read_request):
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = headers
+        body = b''.join(self.server.error_response(e, read_request, start_response))
+        code, reason = response['status'].split(' ', 1)
+        return web.Response(
+                status=int(code), reason=reason, body=body,
+                headers=response['headers'])
+
+    async def handle(self, request):
+        self.in_flight += 1
+        start = time.monotonic()
+        route = 'local'
+        outcome = 'error'
+        response = None
+        read_request = None
+        try:
+            body = await request.read()
+            read_request = self.server.parse_request(self.environ(request, body))
+            # ReadServer knows about uwsgi connections only
+            read_request.budget.disconnected = lambda: (
+                    request.transport is None or request.transport.is_closing())
+            write_locks = self.server.write_locks
+            if write_locks.ready:
+                write_lock = write_locks.get(read_request.segment.id)
+            else:
+                # the lookup goes to rethinkdb
+                write_lock = await self.run_sync(write_locks.get, read_request.segment.id)
+            if write_lock and write_lock['node'] != settings['HOSTNAME']:
+                logging.debug(
+                        'Found write lock for %s. Proxying %r to %s',
+                        read_request.segment.id, read_request.query,
+                        write_lock['node'])
+                route = 'proxy'
+                response = await self.proxy(request, read_request, write_lock['node'])
+            else:
+                response = await self.serve_local(request, read_request, write_lock)
+        except (asyncio.CancelledError, ConnectionResetError):
+            outcome = 'disconnect'
+            raise
+        except Exception as e:
+            response = self.error_response(e, read_request)
+        finally:
+            self.in_flight -= 1
+            if response is not None:
+                outcome = self.server.outcome(
+                        '%s %s' % (response.status, response.reason), read_request)
+            self.server.observe_request(
+                    read_request, route, outcome, start,
+                    response.body_length if response is not None else 0)
+        return response
+
+    async def acquire_segment(self, read_request):
+        '''Waits for a turn at the segment, for as long as the query's time
+        budget allows. Returns the entry to pass to `release_segment()`.'''
+        segment_id = read_request.segment.id
+        entry = self._segments.get(segment_id)
+        if entry is None:
+            entry = self._segments[segment_id] = [
+                    asyncio.Semaphore(self.segment_concurrency), 0]
+        entry[1] += 1
+        try:
+            if not entry[0].locked():
+                # there's a free slot, this does not wait
+                await entry[0].acquire()
+            else:
+                trough.metrics.registry.inc('trough_async_read_segment_waits_total')
+                budget = read_request.budget
+                try:
+                    await asyncio.wait_for(entry[0].acquire(), budget.remaining())
+                except asyncio.TimeoutError:
+                    budget.exceeded = 'time'
+                    raise trough.read.QueryBudgetExceeded(budget)
+        except:
+            self.release_segment(segment_id, entry, acquired=False)
+            raise
+        return entry
+
+    def release_segment(self, segment_id, entry, acquired=True):
+        if acquired:
+            entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._segments[segment_id]
+
+    async def serve_local(self, request, read_request, write_lock):
+        segment_id = read_request.segment.id
+        entry = await self.acquire_segment(read_request)
+        try:
+            started = {}
+            def start_response(status, headers):
+                started['status'] = status
+                started['headers'] = headers
+            iterable = await self.run_sync(
+                    self.server.serve_local, read_request, write_lock,
+                    start_response)
+            iterator = iter(iterable)
+            pending = None
+            try:
+                code, reason = started['status'].split(' ', 1)
+                response = web.StreamResponse(
+                        status=int(code), reason=reason,
+                        headers=started['headers'])
+                await response.prepare(request)
+                while True:
+                    # the next batch is fetched and encoded only after the
+                    # client has taken the last one
+                    pending = asyncio.ensure_future(
+                            self.run_sync(next, iterator, None))
+                    chunk = await pending
+                    pending = None
+                    if chunk is None:
+                        break
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+            finally:
+                if pending is not None and not pending.done():
+                    # cancelled mid-batch: the budget's disconnect check
+                    # interrupts the query, wait for the batch to give up
+                    await asyncio.wait([pending])
+                close = getattr(iterable, 'close', None)
+                if close:
+                    await self.run_sync(close)
+        finally:
+            self.release_segment(segment_id, entry)
+
+    async def proxy(self, request, read_request, node):
+        url, headers = self.server.proxy_request(
+                node, read_request.segment, read_request.result_format.name,
+                read_request.content_type, read_request.budget,
+                read_request.page, read_request.encoding)
+        metrics = trough.metrics.registry
+        start = time.time()
+        size = 0
+        completed = False
+        try:
+            async with self.session.post(
+                    url, data=read_request.body, headers=headers) as r:
+                metrics.inc('trough_proxy_headers_seconds_total', time.time() - start, node=node)
+                metrics.inc('trough_proxy_requests_total', node=node, status=r.status)
+                response_headers = {'Content-Type': r.headers['Content-Type']}
+                for name in ('X-Trough-Continuation', 'Content-Encoding', 'Vary'):
+                    if name in r.headers:
+                        response_headers[name] = r.headers[name]
+                response = web.StreamResponse(
+                        status=r.status, reason=r.reason, headers=response_headers)
+                await response.prepare(request)
+                async for chunk in r.content.iter_chunked(int(settings['READ_PROXY_CHUNK_SIZE'])):
+                    size += len(chunk)
+                    await response.write(chunk)
+                await response.write_eof()
+                completed = True
+                return response
+        finally:
+            if not completed:
+                metrics.inc('trough_proxy_errors_total', node=node)
+            metrics.inc('trough_proxy_request_bytes_total', len(read_request.body), node=node)
+            metrics.inc('trough_proxy_response_bytes_total', size, node=node)
+            metrics.inc('trough_proxy_seconds_total', time.time() - start, node=node)
+
+def run(port=None):
+    web.run_app(
+            AsyncReadServer().app(), port=int(port or settings['READ_PORT']),
+            print=None)
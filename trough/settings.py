@@ -48,6 +48,69 @@ settings = {
     'LOCAL_DATA': '/var/tmp/trough',
     'READ_THREADS': '10',
     'WRITE_THREADS': '5',
+    'WRITE_STATEMENT_CACHE_SIZE': 128, # prepared statements kept per write connection, for bound (parameterized) writes
+    'WRITE_JOURNAL_MODE': 'WAL', # journal mode of segments while they are written to (readers don't block on writers in WAL mode); they are switched back to DELETE when the writer connection closes
+    'WRITE_SYNCHRONOUS': 'NORMAL', # PRAGMA synchronous of writer connections: NORMAL, in WAL mode, only fsyncs at checkpoints, so a power loss can lose the last commits but never corrupts the segment; FULL fsyncs every commit
+    'WRITE_WAL_AUTOCHECKPOINT': 1000, # pages the WAL may grow to before a commit checkpoints it into the segment file
+    'WRITE_JOURNAL_SIZE_LIMIT': 64 * 1024 * 1024, # bytes the WAL is truncated to after a checkpoint
+    'WRITE_CONNECTION_IDLE_TIMEOUT': 300, # seconds a writer connection to a segment is kept open without writes
+    'WRITE_BUSY_TIMEOUT': 30, # seconds a write waits for another process writing to the same segment
+    'WRITE_GROUP_COMMIT_WINDOW': 0, # seconds a write waits for more writes to the same segment to commit together with (0: it only commits together with writes that queued up during the previous commit)
+    'WRITE_GROUP_COMMIT_MAX_STATEMENTS': 10000, # most statements (or rows of a batch write) per group commit
+    'WRITE_GROUP_COMMIT_MAX_BYTES': 16 * 1024 * 1024, # most bytes of sql per group commit
+    'WRITE_BULK_CHUNK_ROWS': 10000, # rows per transaction of a bulk insert (a write with ?table=)
+    'WRITE_STREAM_BUFFER_BYTES': 16 * 1024 * 1024, # sql of a write read ahead before running it; a longer script runs while the rest of it is read
+    'WRITE_STREAM_COMMIT_CHUNKS': False, # commit scripts longer than WRITE_STREAM_BUFFER_BYTES in chunks of that size, rather than in one transaction
+    'WRITE_BATCH_ID_TTL': 24 * 60 * 60, # seconds the ids of applied writes (the X-Trough-Batch-Id header) are remembered, so that retries are not applied twice
+    'WRITE_SPOOL_DIR': None, # directory of the spool of writes acknowledged before they are applied (None: no async writes), see trough/spool.py; needs uwsgi --enable-threads
+    'WRITE_ASYNC': False, # acknowledge writes once spooled, unless the request says otherwise with the X-Trough-Async header
+    'WRITE_SPOOL_MAX_BYTES': 64 * 1024 * 1024, # bytes of writes to a segment a write server process spools before it answers 429 (larger writes are applied before the response)
+    'WRITE_SPOOL_FSYNC_INTERVAL': 1, # seconds between fsyncs of the spool files, the writes a machine crash may lose
+    'WRITE_SPOOL_FLUSH_TIMEOUT': 600, # seconds a promotion waits for the spooled writes to the segment to be applied
+    'PROMOTION_BACKUP_PAGES': 1024, # pages of a segment copied per step of its online backup when it is promoted; writers get their turn between steps
+    'PROMOTION_BACKUP_SLEEP': 0.01, # seconds between steps of the backup of a segment being promoted
+    'PROMOTION_BACKUP_MAX_RESTARTS': 10, # times the backup of a segment being promoted may start over because the segment was written to, before the rest is copied in one step
+    'PROMOTION_COMPACT': False, # promote a compacted copy of segments, without their free pages (VACUUM INTO); schemas and /promote requests can override it
+    'PROMOTION_ANALYZE': False, # gather query planner statistics (ANALYZE) in the promoted copy of segments; schemas and /promote requests can override it
+    'PROMOTION_ANALYSIS_LIMIT': 1000, # PRAGMA analysis_limit of that ANALYZE, rows of each index looked at (0: all)
+    'PROMOTION_PAGE_SIZE': None, # page size of compacted copies (None: that of the segment); schemas and /promote requests can override it
+    'PROMOTION_PROGRESS_INTERVAL': 5, # seconds between updates of the progress of a promotion in the segment's write lock (see GET /promote/<segment>)
+    'READ_CONNECTION_POOL_SIZE': 100, # maximum number of idle read-only sqlite connections kept open per read server process
+    'READ_CONNECTION_POOL_PER_SEGMENT': 10, # maximum number of idle connections kept open for any one segment
+    'READ_IMMUTABLE': True, # open segments that are not write locked with immutable=1: no file locking or change detection, the sync loop replaces them by rename
+    'READ_MMAP_SIZE': 256 * 1024 * 1024, # PRAGMA mmap_size for read connections (0 disables memory mapped i/o)
+    'READ_CACHE_SIZE': -16384, # PRAGMA cache_size for read connections (negative means KiB)
+    'READ_TEMP_STORE': 'MEMORY', # PRAGMA temp_store for read connections (sorts, distinct, etc)
+    'READ_STATEMENT_CACHE_SIZE': 256, # prepared (and already authorized) statements kept per pooled read connection
+    'READ_FETCH_BATCH_SIZE': 1000, # rows fetched from sqlite and serialized per chunk of a streamed read response
+    'READ_ARROW_SCHEMA_ROWS': 10000, # rows of an arrow result held back to infer its column types from, see trough/formats.py
+    'READ_QUERY_TIMEOUT': 300, # seconds a read query may run (including streaming its result) unless the request asks for less (0 means no limit)
+    'READ_QUERY_MAX_TIMEOUT': 600, # most seconds a request may ask for with the X-Trough-Timeout header or ?timeout= (0 means no limit)
+    'READ_QUERY_MAX_STEPS': 0, # most sqlite virtual machine steps a read query may take, and the cap on X-Trough-Max-Steps or ?max_steps= (0 means no limit)
+    'READ_PROGRESS_INTERVAL': 10000, # sqlite virtual machine steps between checks of a read query's budget and of the client connection
+    'READ_PAGE_MAX_SIZE': 100000, # most rows returned per page of a paginated read (?page_size=), bigger requests get pages of this size
+    'READ_BATCH_MAX_QUERIES': 100, # most queries in one batch read request
+    'READ_RESULT_CACHE_BYTES': 0, # size budget of the query result cache shared by read server processes (0 disables the cache)
+    'READ_RESULT_CACHE_MAX_ENTRY_BYTES': 1024 * 1024, # results bigger than this are never cached
+    'READ_RESULT_CACHE_PATH': '/var/tmp/trough-result-cache.sqlite', # must not be under LOCAL_DATA
+    'READ_PROXY_POOL_HOSTS': 10, # write hosts to keep a pool of keep-alive connections to, for proxied reads
+    'READ_PROXY_POOL_SIZE': 10, # keep-alive connections kept open to each write host
+    'READ_PROXY_CHUNK_SIZE': 64 * 1024, # read size when relaying a proxied response
+    'READ_COMPRESSION_ENCODINGS': 'zstd,gzip', # content encodings read responses may be compressed with, most preferred first, if the client accepts them (empty disables compression)
+    'READ_COMPRESSION_MIN_SIZE': 4096, # read responses smaller than this many bytes are sent uncompressed
+    'READ_COMPRESSION_GZIP_LEVEL': 6, # zlib compression level of gzip encoded read responses
+    'READ_COMPRESSION_ZSTD_LEVEL': 3, # compression level of zstd encoded read responses
+    'READ_ASYNC_THREADS': 32, # threads running sqlite work for the asyncio read server (scripts/reader_async.py)
+    'READ_ASYNC_SEGMENT_CONCURRENCY': 8, # queries the asyncio read server runs at once against any one segment, more wait their turn
+    'METRICS_DIR': None, # directory where the uwsgi worker processes of the read and write servers share metrics snapshots, so that /metrics reports totals for all workers (None: each worker reports its own)
+    'METRICS_SNAPSHOT_INTERVAL': 5, # seconds between a worker's metrics snapshots, written after a request
+    'METRICS_SEGMENT_CLASS_REGEX': r'^(.*?)[-_.]*(?:[0-9]|$)', # the first group is the "class" of a segment id that per segment metrics are labeled with
+    'METRICS_MAX_SEGMENT_CLASSES': 100, # segment classes beyond this many are all labeled 'other'
+    'FANOUT_CONCURRENCY': 16, # default number of segments queried at once by a fan-out query
+    'FANOUT_MAX_CONCURRENCY': 64, # upper bound on the concurrency a fan-out request can ask for
+    'FANOUT_QUEUE_SIZE': 10000, # rows buffered between segment queries and the merged response, per segment for ordered queries (the rest spill to a temporary file)
+    'FANOUT_TIMEOUT': 600, # seconds to wait for a read server to respond to a fan-out segment query
+    'WRITE_LOCK_CACHE_TTL': 2, # read servers cache write lock lookups this many seconds while the rethinkdb changefeed on the lock table is down
     'ELECTION_CYCLE': 10, # how frequently should I hold an election for sync master server? In seconds
     # 'ROLE': 'READ', # READ, WRITE, SYNCHRONIZE, CONSUL # commented: might not need this, handle via ansible/docker?
     'HDFS_PATH': '/tmp/trough', # /ait/prod/trough/
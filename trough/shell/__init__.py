@@ -1,4 +1,6 @@
 import trough.client
+import trough.formats
+import trough.aggregate
 import sys
 import argparse
 import os
@@ -39,13 +41,14 @@ class TroughShell(cmd.Cmd):
 
     def __init__(
             self, trough_client, segments, writable=False,
-            schema_id='default'):
+            schema_id='default', transfer_format='json'):
         super().__init__()
         self.cli = trough_client
         self.segments = segments
         self.writable = writable
         self.schema_id = schema_id
         self.format = 'table'
+        self.transfer_format = transfer_format
         self.pager_pipe = None
         self.update_prompt()
 
@@ -230,8 +233,31 @@ class TroughShell(cmd.Cmd):
         else:
             self.do_help('format')
 
+    def do_transfer(self, raw_arg):
+        '''
+        Set the wire format used to fetch results from the read servers.
+        Options: JSON (the default), NDJSON, CSV, COMPACT, MSGPACK, ARROW.
+        Results are displayed the same way whatever the transfer format,
+        except that values fetched as CSV are all strings.
+
+        With no argument, displays current transfer format.
+        '''
+        arg = raw_arg.strip().lower()
+        if not arg:
+            print('Transfer format is %r' % self.transfer_format)
+        elif arg in trough.formats.FORMATS:
+            if not trough.formats.available(arg):
+                print('Transfer format %r needs a python module that is not '
+                      'installed' % arg)
+                return
+            self.transfer_format = arg
+            print('Transfer format is now %r' % self.transfer_format)
+        else:
+            self.do_help('transfer')
+
     async def async_select(self, segment, query):
-        result = await self.cli.async_read(segment, query)
+        result = await self.cli.async_read(
+                segment, query, format=self.transfer_format)
         try:
             print('+++++ results from segment %s +++++' % segment,
                   file=self.pager_pipe or sys.stdout)
@@ -261,6 +287,25 @@ class TroughShell(cmd.Cmd):
             elif result:
                 self.n_rows += result
 
+    def aggregatable(self, query):
+        try:
+            trough.aggregate.AggregateQuery(query)
+            return True
+        except trough.aggregate.Unsupported as e:
+            self.logger.debug('not pushing down aggregates: %s', e)
+            return False
+
+    async def async_aggregate(self, query):
+        result, stats = await self.cli.async_aggregate(self.segments, query)
+        self.n_rows = self.display(result) or 0
+        try:
+            print('aggregated %(rows_aggregated)s rows on %(segments)s '
+                  'segments, received %(rows_received)s partial rows '
+                  '(%(bytes_received)s bytes), held %(groups_held)s '
+                  'groups' % stats, file=self.pager_pipe or sys.stdout)
+        except BrokenPipeError:
+            pass
+
     def do_select(self, line):
         '''Send a query to the currently-connected trough segment.
 
@@ -278,7 +323,10 @@ class TroughShell(cmd.Cmd):
             try:
                 self.n_rows = 0
                 loop = asyncio.get_event_loop()
-                future = asyncio.ensure_future(self.async_fanout(query))
+                if len(self.segments) > 1 and self.aggregatable(query):
+                    future = asyncio.ensure_future(self.async_aggregate(query))
+                else:
+                    future = asyncio.ensure_future(self.async_fanout(query))
                 loop.run_until_complete(future)
                 # XXX not sure how to measure time not including user time
                 # scrolling around in `less`
@@ -442,6 +490,10 @@ def trough_shell(argv=None):
     arg_parser.add_argument(
             '-s', '--schema', default='default',
             help='schema id for new segment')
+    arg_parser.add_argument(
+            '-t', '--transfer-format', default='json',
+            choices=sorted(trough.formats.FORMATS),
+            help='wire format for fetching query results')
     arg_parser.add_argument('segment', nargs='*')
     args = arg_parser.parse_args(args=argv[1:])
 
@@ -456,7 +508,9 @@ def trough_shell(argv=None):
     logging.getLogger('asyncio').setLevel(logging.WARNING)
 
     cli = trough.client.TroughClient(args.rethinkdb_trough_db_url)
-    shell = TroughShell(cli, args.segment, args.writable, args.schema)
+    shell = TroughShell(
+            cli, args.segment, args.writable, args.schema,
+            args.transfer_format)
 
     if os.path.exists(HISTORY_FILE):
         readline.read_history_file(HISTORY_FILE)
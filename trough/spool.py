@@ -0,0 +1,331 @@
+'''
+trough/spool.py - spool of writes acknowledged before they are applied
+
+With the WRITE_SPOOL_DIR setting, the write server can acknowledge a write
+as soon as it is appended to a spool file, rather than once it is committed
+to the segment (see `WriteServer.__call__()`). A thread per segment applies
+the spooled writes in the background, in order. Spool files are fsynced
+every WRITE_SPOOL_FSYNC_INTERVAL seconds, so a crash of the machine may lose
+the writes of the last interval, like the crash of a process before the
+response.
+
+Each worker process spools to files of its own,
+
+    WRITE_SPOOL_DIR/<segment id>/<pid>-<n>.spool
+
+which it holds an exclusive `flock()` on. Files that nobody holds a lock on
+were left by a process that died: they are replayed by the next process
+that looks (at start up, on the next write to the segment, or on a flush).
+Writes are applied with a batch id (see `trough.write.WriteBatch`), so that
+writes that were applied before the crash, but not yet removed from the
+spool, are not applied twice. Writes that fail to apply are logged, and
+appended to WRITE_SPOOL_DIR/<segment id>.rejected.
+
+A segment's spool holds at most WRITE_SPOOL_MAX_BYTES per process. Beyond
+that, `SpoolFull` is raised, which the write server answers with 429.
+
+Applying runs in threads, so under uwsgi, async writes need the
+--enable-threads option.
+'''
+import collections
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+import ujson
+from trough.settings import settings
+import trough.metrics
+
+# header length, body length, crc32 of header and body
+RECORD_HEADER = struct.Struct('>III')
+
+class SpoolFull(Exception):
+    pass
+
+class SpoolRecord:
+    '''A spooled write: a json-able dict `header`, which describes the
+    write (see `WriteServer.apply_spooled()`), and the request `body`.'''
+    def __init__(self, header, body):
+        self.header = header
+        self.body = body
+        self.size = RECORD_HEADER.size + len(body) + 256
+
+    def encode(self):
+        header = ujson.dumps(self.header).encode('utf-8')
+        return RECORD_HEADER.pack(
+                len(header), len(self.body),
+                zlib.crc32(self.body, zlib.crc32(header))) + header + self.body
+
+def read_records(path):
+    '''Yields the records of the spool file at `path`. Stops at a torn or
+    corrupt record, the last one written before a crash.'''
+    with open(path, 'rb') as f:
+        while True:
+            prefix = f.read(RECORD_HEADER.size)
+            if not prefix:
+                return
+            if len(prefix) < RECORD_HEADER.size:
+                logging.warning('%s ends with a partial record', path)
+                return
+            header_length, body_length, crc = RECORD_HEADER.unpack(prefix)
+            header = f.read(header_length)
+            body = f.read(body_length)
+            if (len(header) < header_length or len(body) < body_length
+                    or zlib.crc32(body, zlib.crc32(header)) != crc):
+                logging.warning('%s ends with a partial or corrupt record', path)
+                return
+            yield SpoolRecord(ujson.loads(header.decode('utf-8')), body)
+
+class SegmentSpool:
+    '''The spool of one segment in this process, and the thread that
+    applies it.'''
+    def __init__(self, spooler, segment_id):
+        self.spooler = spooler
+        self.segment_id = segment_id
+        self.directory = os.path.join(spooler.directory, segment_id)
+        self.cond = threading.Condition()
+        # records not applied yet, oldest first
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        # the file records are appended to, opened on the first append
+        self.fd = None
+        self.path = None
+        self.seq = 0
+        # whether `fd` was written to, or created, since it was last synced
+        self.dirty = False
+        self.created = False
+        self.thread = None
+
+    def append(self, record):
+        with self.cond:
+            if self.pending and self.pending_bytes + record.size > int(settings['WRITE_SPOOL_MAX_BYTES']):
+                raise SpoolFull(
+                        'the spool of segment %r is full (%s bytes of writes '
+                        'waiting to be applied), try again later' % (
+                            self.segment_id, self.pending_bytes))
+            if self.fd is None:
+                self._open()
+            data = record.encode()
+            while data:
+                data = data[os.write(self.fd, data):]
+            self.dirty = True
+            self.pending.append(record)
+            self.pending_bytes += record.size
+            if self.thread is None:
+                self.thread = threading.Thread(
+                        target=self._run, daemon=True,
+                        name='spool-%s' % self.segment_id)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.seq += 1
+        self.path = os.path.join(self.directory, '%s-%s.spool' % (os.getpid(), self.seq))
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.created = True
+
+    def sync(self):
+        '''fsyncs the spool file, if it was written to.'''
+        with self.cond:
+            if self.fd is None or not self.dirty:
+                return
+            fd = os.dup(self.fd)
+            created = self.created
+            self.dirty = self.created = False
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if created:
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _run(self):
+        # writes left by a process that died come first
+        self.spooler.recover(self.segment_id)
+        idle_timeout = float(settings['WRITE_CONNECTION_IDLE_TIMEOUT'])
+        while True:
+            with self.cond:
+                if not self.pending:
+                    self.cond.wait(idle_timeout)
+                if not self.pending:
+                    self.thread = None
+                    return
+                records = list(self.pending)
+                # later writes go to a new file, and this one is removed
+                # once its writes are applied
+                done_fds = []
+                if self.fd is not None:
+                    done_fds.append((self.fd, self.path))
+                    self.fd = self.path = None
+                    self.dirty = False
+            for record in records:
+                self.spooler.apply(self.segment_id, record)
+            with self.cond:
+                for record in records:
+                    self.pending.popleft()
+                    self.pending_bytes -= record.size
+                for fd, path in done_fds:
+                    os.unlink(path)
+                    os.close(fd)
+                self.cond.notify_all()
+
+class Spooler:
+    '''The spools of this process. `apply(segment_id, record)` applies a
+    spooled write.'''
+    def __init__(self, directory, apply):
+        self.directory = directory
+        self._apply = apply
+        self._lock = threading.Lock()
+        # { segment_id: SegmentSpool }
+        self._spools = {}
+        self._started = False
+        metrics = trough.metrics.registry
+        metrics.counter(
+                'trough_write_spooled_total',
+                'writes acknowledged once spooled, to be applied in the background')
+        metrics.counter(
+                'trough_write_spool_throttled_total',
+                'writes turned away (429) because the spool of their segment was full')
+        metrics.counter(
+                'trough_write_spool_replayed_total',
+                'spooled writes replayed from spool files left by a process that died')
+        metrics.counter(
+                'trough_write_spool_failures_total',
+                'spooled writes that failed to apply, see the .rejected files')
+        metrics.gauge(
+                'trough_write_spool_bytes',
+                'size of the writes spooled and not applied yet',
+                fn=lambda: sum(s.pending_bytes for s in list(self._spools.values())))
+
+    def start(self):
+        '''Starts the threads that sync the spool files, and that replay
+        spool files left by processes that died. Called on the first
+        request, since under uwsgi the application is loaded before the
+        worker processes are forked.'''
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._sync_loop, daemon=True, name='spool-sync').start()
+        threading.Thread(target=self.recover, daemon=True, name='spool-recover').start()
+
+    def spool(self, segment_id):
+        with self._lock:
+            spool = self._spools.get(segment_id)
+            if spool is None:
+                spool = self._spools[segment_id] = SegmentSpool(self, segment_id)
+            return spool
+
+    def append(self, segment_id, header, body):
+        '''Spools a write. Raises `SpoolFull` if the segment's spool is
+        full.'''
+        self.start()
+        try:
+            self.spool(segment_id).append(SpoolRecord(header, body))
+        except SpoolFull:
+            trough.metrics.registry.inc('trough_write_spool_throttled_total')
+            raise
+        trough.metrics.registry.inc('trough_write_spooled_total')
+
+    def apply(self, segment_id, record):
+        try:
+            self._apply(segment_id, record)
+        except Exception:
+            logging.error(
+                    'spooled write to segment %r failed, appending it to %s.rejected: %r',
+                    segment_id, segment_id, record.header, exc_info=True)
+            trough.metrics.registry.inc('trough_write_spool_failures_total')
+            path = os.path.join(self.directory, '%s.rejected' % segment_id)
+            with open(path, 'ab') as f:
+                f.write(record.encode())
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(float(settings['WRITE_SPOOL_FSYNC_INTERVAL']))
+            for spool in list(self._spools.values()):
+                try:
+                    spool.sync()
+                except OSError:
+                    logging.error('failed to sync spool of segment %r', spool.segment_id, exc_info=True)
+
+    def recover(self, segment_id=None):
+        '''Replays the spool files of `segment_id`, or of all segments, left
+        by processes that died.'''
+        if segment_id is None:
+            try:
+                segment_ids = [
+                    name for name in os.listdir(self.directory)
+                    if os.path.isdir(os.path.join(self.directory, name))]
+            except FileNotFoundError:
+                return
+        else:
+            segment_ids = [segment_id]
+        for segment_id in segment_ids:
+            directory = os.path.join(self.directory, segment_id)
+            try:
+                filenames = sorted(
+                        (name for name in os.listdir(directory) if name.endswith('.spool')),
+                        key=lambda name: os.stat(os.path.join(directory, name)).st_mtime)
+            except FileNotFoundError:
+                continue
+            for filename in filenames:
+                try:
+                    self._replay(segment_id, os.path.join(directory, filename))
+                except FileNotFoundError:
+                    # replayed by another process
+                    pass
+
+    def _replay(self, segment_id, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # its process is alive, or another one is replaying it
+                return
+            if not os.path.exists(path):
+                # replayed and removed before we got the lock
+                return
+            logging.info('replaying spooled writes to segment %r from %s', segment_id, path)
+            for record in read_records(path):
+                self.apply(segment_id, record)
+                trough.metrics.registry.inc('trough_write_spool_replayed_total')
+            os.unlink(path)
+        finally:
+            os.close(fd)
+
+    def flush(self, segment_id, timeout):
+        '''
+        Waits until the writes to `segment_id` spooled so far, by any
+        process, are applied, replaying those of processes that died.
+        Returns False if that takes longer than `timeout` seconds.
+        '''
+        directory = os.path.join(self.directory, segment_id)
+        try:
+            waiting = set(name for name in os.listdir(directory) if name.endswith('.spool'))
+        except FileNotFoundError:
+            return True
+        self.recover(segment_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                waiting &= set(os.listdir(directory))
+            except FileNotFoundError:
+                return True
+            if not waiting:
+                return True
+            if time.monotonic() >= deadline:
+                logging.warning(
+                        'spooled writes to segment %r still not applied after '
+                        '%s seconds: %s', segment_id, timeout, sorted(waiting))
+                return False
+            time.sleep(0.05)
@@ -19,6 +19,7 @@ import re
 import contextlib
 from uhashring import HashRing
 import ujson
+import base64
 from hdfs3 import HDFileSystem
 import threading
 import tempfile
@@ -88,6 +89,261 @@ def setup_connection(conn):
     conn.create_function('SEEDCRAWLEDSTATUS', 1, seed_crawled_status_filter)
     conn.create_function('BUILDREDIRECTARRAY', 4, build_redirect_array)
 
+# files next to a segment that is or was written to in WAL mode
+WAL_SUFFIXES = ('-wal', '-shm')
+
+def remove_wal_files(path):
+    '''Removes the WAL files of the segment file at `path`. They must not
+    outlive the file they belong to: sqlite would apply a stale WAL to
+    whatever file later takes its place.'''
+    for suffix in WAL_SUFFIXES:
+        try:
+            os.unlink(path + suffix)
+            logging.info('removed %s%s', path, suffix)
+        except FileNotFoundError:
+            pass
+
+class _TooManyRestarts(Exception):
+    pass
+
+def backup_segment(source_path, dest_path, progress=None):
+    '''
+    Copies the segment at `source_path`, while it is written to, to
+    `dest_path` with sqlite's online backup (see
+    https://www.sqlite.org/backup.html), PROMOTION_BACKUP_PAGES pages at a
+    time, sleeping PROMOTION_BACKUP_SLEEP seconds between steps, so that
+    writers get their turn. A write by another connection makes the backup
+    start over; after PROMOTION_BACKUP_MAX_RESTARTS restarts, the rest is
+    copied in one step (which, in WAL mode, still doesn't block writers).
+
+    `progress(stats)` is called after each step. Returns the stats, a dict
+    with 'pages_total', 'pages_remaining', 'steps', 'restarts' and
+    'seconds'.
+    '''
+    max_restarts = int(settings['PROMOTION_BACKUP_MAX_RESTARTS'])
+    stats = {
+        'pages_total': None, 'pages_remaining': None, 'steps': 0,
+        'restarts': 0, 'seconds': 0.0}
+    start = time.monotonic()
+    copied = [-1]
+    def step(status, remaining, total):
+        stats['steps'] += 1
+        stats['pages_total'] = total
+        stats['pages_remaining'] = remaining
+        stats['seconds'] = time.monotonic() - start
+        # each step copies more pages, unless it started over
+        if remaining and total - remaining <= copied[0]:
+            stats['restarts'] += 1
+            logging.info(
+                    'backup of %s started over because it was written to '
+                    '(%s restarts)', source_path, stats['restarts'])
+        copied[0] = total - remaining
+        if progress:
+            progress(stats)
+        if remaining and stats['restarts'] >= max_restarts:
+            raise _TooManyRestarts()
+
+    source = sqlite3.connect(source_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+        try:
+            source.backup(
+                    dest, pages=max(int(settings['PROMOTION_BACKUP_PAGES']), 1),
+                    progress=step,
+                    sleep=float(settings['PROMOTION_BACKUP_SLEEP']))
+        except _TooManyRestarts:
+            logging.info(
+                    'backup of %s started over %s times, copying the rest '
+                    'in one step', source_path, stats['restarts'])
+            source.backup(dest, progress=step)
+        # the copy comes out in the journal mode of the source, and
+        # read-only copies are kept in rollback journal mode
+        dest.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        source.close()
+        dest.close()
+    stats['seconds'] = time.monotonic() - start
+    return stats
+
+# options of a promotion, and their types
+PROMOTION_OPTIONS = {'compact': bool, 'analyze': bool, 'page_size': int}
+
+def promotion_options(*overrides):
+    '''
+    Returns the options of a promotion: the PROMOTION_COMPACT,
+    PROMOTION_ANALYZE and PROMOTION_PAGE_SIZE settings, as 'compact',
+    'analyze' and 'page_size', overridden by the dicts `overrides` in turn
+    (the promotion options of the segment's schema, then those of the
+    request). Raises `ClientError` if an override is not valid.
+    '''
+    options = {
+        'compact': bool(settings['PROMOTION_COMPACT']),
+        'analyze': bool(settings['PROMOTION_ANALYZE']),
+        'page_size': settings['PROMOTION_PAGE_SIZE'],
+    }
+    for override in overrides:
+        if not override:
+            continue
+        if not isinstance(override, dict):
+            raise ClientError('promotion options must be an object, not %r' % (override,))
+        for key, value in override.items():
+            if key not in PROMOTION_OPTIONS:
+                raise ClientError('unknown promotion option %r (should be one of %s)' % (
+                    key, ', '.join(sorted(PROMOTION_OPTIONS))))
+            if value is not None and type(value) is not PROMOTION_OPTIONS[key]:
+                raise ClientError('promotion option %r must be a %s, not %r' % (
+                    key, PROMOTION_OPTIONS[key].__name__, value))
+            if key == 'page_size' and value is not None and (
+                    value < 512 or value > 65536 or value & (value - 1)):
+                raise ClientError(
+                        'promotion option page_size must be a power of two '
+                        'from 512 to 65536, not %r' % value)
+            options[key] = value
+    return options
+
+def analyze_segment(path):
+    '''Gathers the statistics of the query planner (in sqlite_stat1) of the
+    segment at `path`, looking at up to PROMOTION_ANALYSIS_LIMIT rows of each
+    index (see https://www.sqlite.org/lang_analyze.html).'''
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute('PRAGMA analysis_limit = %d' % int(settings['PROMOTION_ANALYSIS_LIMIT']))
+        connection.execute('ANALYZE')
+    finally:
+        connection.close()
+
+def compact_segment(source_path, dest_path, page_size=None):
+    '''Writes a copy of the segment at `source_path`, without its free pages
+    and with its tables and indexes defragmented, to `dest_path`, which must
+    not exist, with `VACUUM INTO`. The copy has pages of `page_size` bytes,
+    if given, else those of the source.'''
+    connection = sqlite3.connect(source_path, isolation_level=None)
+    try:
+        if page_size:
+            # VACUUM INTO writes pages of the size set on the connection
+            connection.execute('PRAGMA page_size = %d' % page_size)
+        connection.execute('VACUUM INTO ?', (dest_path,))
+    finally:
+        connection.close()
+
+BOUND_QUERY_CONTENT_TYPE = 'application/json'
+
+def _encode_param(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'blob': base64.b64encode(bytes(value)).decode('ascii')}
+    return value
+
+def _decode_param(value):
+    if isinstance(value, dict):
+        if set(value) != {'blob'}:
+            raise ValueError('unsupported parameter %r' % value)
+        return base64.b64decode(value['blob'])
+    if isinstance(value, list):
+        raise ValueError('unsupported parameter %r' % value)
+    return value
+
+def decode_params(params):
+    '''Inverse of `encode_params()`. Raises `ValueError` if `params` is
+    malformed.'''
+    if isinstance(params, dict):
+        return {k: _decode_param(v) for k, v in params.items()}
+    elif isinstance(params, list):
+        return tuple(_decode_param(v) for v in params)
+    raise ValueError('params must be a list or an object, not %r' % params)
+
+def encode_params(params):
+    '''Returns a list or dict of parameters in their json form.'''
+    if isinstance(params, dict):
+        return {k: _encode_param(v) for k, v in params.items()}
+    return [_encode_param(v) for v in params]
+
+def encode_bound_query(sql, params=None, batch=None):
+    '''
+    Encodes a query with parameters for sqlite3 to bind, as the json request
+    body understood by the read and write servers when the content type is
+    `BOUND_QUERY_CONTENT_TYPE`:
+
+        {"sql": "SELECT * FROM foo WHERE id = ?", "params": [1]}
+        {"sql": "INSERT INTO foo VALUES (:a, :b)", "batch": [{"a": 1, "b": 2}, ...]}
+
+    Parameters are sequences (for `?` placeholders) or dicts (for `:name`
+    placeholders). Values are None, numbers, strings, or bytes, which are
+    sent base64 encoded as `{"blob": "..."}`.
+    '''
+    request = {'sql': sql}
+    if params is not None:
+        request['params'] = encode_params(params)
+    if batch is not None:
+        request['batch'] = [encode_params(row) for row in batch]
+    return ujson.dumps(request, escape_forward_slashes=False).encode('utf-8')
+
+def parse_bound_query(body):
+    '''
+    Parses a request body made by `encode_bound_query()`. Returns `(sql,
+    params, batch)`, with `params` and `batch` None if absent. Raises
+    `ValueError` if the body is malformed.
+    '''
+    return _parse_bound_query(json.loads(body.decode('utf-8')))
+
+def _parse_bound_query(request):
+    if not isinstance(request, dict) or not isinstance(request.get('sql'), str):
+        raise ValueError('bound query must be a json object with an "sql" string')
+    params = batch = None
+    if request.get('params') is not None:
+        params = decode_params(request['params'])
+    if request.get('batch') is not None:
+        if params is not None:
+            raise ValueError('bound query has both "params" and "batch"')
+        if not isinstance(request['batch'], list):
+            raise ValueError('"batch" must be a list of parameter lists or objects')
+        batch = [decode_params(row) for row in request['batch']]
+    return request['sql'], params, batch
+
+def encode_read_batch(queries):
+    '''
+    Encodes a batch of independent queries for the read server to run
+    together on one snapshot of a segment (see `ReadServer.batch_result_iter`),
+    as a json request body with content type `BOUND_QUERY_CONTENT_TYPE`:
+
+        {"queries": [{"label": "hosts", "sql": "SELECT ...", "params": [1]}, ...]}
+
+    `queries` is a list of `(label, sql, params)`; `params` may be None.
+    '''
+    request = {'queries': []}
+    for label, sql, params in queries:
+        query = {'label': label, 'sql': sql}
+        if params is not None:
+            query['params'] = encode_params(params)
+        request['queries'].append(query)
+    return ujson.dumps(request, escape_forward_slashes=False).encode('utf-8')
+
+def parse_bound_read(body):
+    '''
+    Parses the json body of a read request, either a single bound query (see
+    `encode_bound_query()`, "batch" is not allowed) or a batch of queries
+    (see `encode_read_batch()`). Returns `(sql, params, queries)`: `queries`
+    is None for a single query, otherwise a list of `(label, sql, params)`
+    and `sql` and `params` are None. Raises `ValueError` if the body is
+    malformed.
+    '''
+    request = json.loads(body.decode('utf-8'))
+    if not isinstance(request, dict) or 'queries' not in request:
+        sql, params, batch = _parse_bound_query(request)
+        if batch is not None:
+            raise ValueError('"batch" is not supported for reads, send one query per request.')
+        return sql, params, None
+    if not isinstance(request['queries'], list) or not request['queries']:
+        raise ValueError('"queries" must be a non-empty list')
+    queries = []
+    for i, query in enumerate(request['queries']):
+        if not isinstance(query, dict) or not isinstance(query.get('sql'), str):
+            raise ValueError('each of "queries" must be an object with an "sql" string')
+        params = query.get('params')
+        queries.append((
+            query.get('label', i), query['sql'],
+            None if params is None else decode_params(params)))
+    return None, None, queries
+
 class AssignmentQueue:
     def __init__(self, rethinker):
         self._queue = []
@@ -152,6 +408,103 @@ class Lock(doublethink.Document):
     def host_locks(cls, rr, host):
         return (Lock(rr, d=asmt) for asmt in rr.table(cls.table, read_mode='outdated').get_all(host, index="node").run())
 
+class WriteLockView(object):
+    '''
+    Local, in-memory view of the write locks in the rethinkdb 'lock' table,
+    kept current by a changefeed followed in a background thread, so that
+    looking up a segment's write lock does not cost a rethinkdb round trip.
+
+    Until the changefeed is ready, and whenever it drops, lookups fall back
+    to `Lock.load()`, with each result cached for `ttl` seconds.
+    '''
+    RECONNECT_DELAY = 1.0
+
+    def __init__(self, rethinker, ttl=None):
+        self.rethinker = rethinker
+        self.ttl = settings['WRITE_LOCK_CACHE_TTL'] if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._locks = {}     # { lock id: lock dict }
+        self._fallback = {}  # { lock id: (expires, lock dict or None) }
+        self._thread = None
+        self._pid = None
+        self.ready = False
+        self.down_since = time.time()
+        self.reconnects = 0
+        self.lookups = 0
+        self.fallback_lookups = 0
+
+    def start(self):
+        '''Starts following the changefeed, unless already doing so in this
+        process. Safe to call on every lookup (e.g. after a uWSGI fork).'''
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                    target=self._follow_forever, name='WriteLockView',
+                    daemon=True)
+            self._thread.start()
+
+    def _follow_forever(self):
+        while True:
+            try:
+                self._follow()
+                logging.warning('write lock changefeed ended')
+            except Exception as e:
+                logging.warning('write lock changefeed failed: %s', e)
+            with self._lock:
+                if self.ready:
+                    self.ready = False
+                    self.down_since = time.time()
+                self.reconnects += 1
+            time.sleep(self.RECONNECT_DELAY)
+
+    def _follow(self):
+        feed = self.rethinker.table(Lock.table).changes(
+                include_initial=True, include_states=True).run()
+        initial = {}
+        for change in feed:
+            if change.get('state') == 'ready':
+                with self._lock:
+                    self._locks = initial
+                    self._fallback.clear()
+                    self.ready = True
+                    self.down_since = None
+                logging.info(
+                        'write lock changefeed ready with %s locks',
+                        len(initial))
+            elif 'state' not in change:
+                locks = self._locks if self.ready else initial
+                old_val = change.get('old_val')
+                new_val = change.get('new_val')
+                with self._lock:
+                    if old_val:
+                        locks.pop(old_val['id'], None)
+                    if new_val:
+                        locks[new_val['id']] = new_val
+
+    def staleness(self):
+        '''Seconds since the view stopped being kept current (0 if it is).'''
+        down_since = self.down_since
+        return 0.0 if down_since is None else time.time() - down_since
+
+    def get(self, segment_id):
+        '''Returns None or dict, like `Segment.retrieve_write_lock()`.'''
+        self.start()
+        self.lookups += 1
+        lock_id = 'write:lock:%s' % segment_id
+        if self.ready:
+            return self._locks.get(lock_id)
+        entry = self._fallback.get(lock_id)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        self.fallback_lookups += 1
+        lock = Lock.load(self.rethinker, lock_id)
+        self._fallback[lock_id] = (time.time() + self.ttl, lock)
+        return lock
+
 class Schema(doublethink.Document):
     pass
 
@@ -225,9 +578,13 @@ class Segment(object):
             return settings['COLD_STORE_SEGMENT']
     def cold_storage_path(self):
         return settings['COLD_STORAGE_PATH'].format(prefix=str(self.id)[0:-3], segment_id=self.id)
-    def new_write_lock(self):
+    def new_write_lock(self, schema_id=None):
         '''Raises exception if lock exists.'''
-        return Lock.acquire(self.rethinker, pk='write:lock:%s' % self.id, document={ "segment": self.id })
+        document = { "segment": self.id }
+        if schema_id is not None:
+            # the schema's promotion options apply to the segment
+            document["schema"] = schema_id
+        return Lock.acquire(self.rethinker, pk='write:lock:%s' % self.id, document=document)
     def retrieve_write_lock(self):
         '''Returns None or dict. Can be used to evaluate whether a lock exists and, if so, which host holds it.'''
         return Lock.load(self.rethinker, 'write:lock:%s' % self.id)
@@ -377,8 +734,12 @@ class SyncController:
     def get_schema(self, id):
         schema = Schema.load(self.rethinker, id)
         return schema
-    def set_schema(self, id, sql):
+    def set_schema(self, id, sql, promotion=None):
+        '''`promotion`, if not None, replaces the options of the promotion of
+        segments of this schema (see `promotion_options()`).'''
         validate_schema_sql(sql)
+        if promotion is not None:
+            promotion_options(promotion)
         # create a document, insert/update it, overwriting document with id 'id'.
         created = False
         output = Schema.load(self.rethinker, id)
@@ -387,9 +748,36 @@ class SyncController:
             created = True
         output.id = id
         output.sql = sql
+        if promotion is not None:
+            output.promotion = promotion
         output.save()
         return (output, created)
 
+    def promotion_status(self, segment_id):
+        '''
+        The progress of the promotion of writable segment `segment_id`, as
+        recorded in its write lock: 'under_promotion', and 'promotion', a
+        dict with the 'stage' of the promotion ('flush', 'backup', 'analyze',
+        'compact', 'upload', then 'done' or 'failed'), when it 'started' and
+        was last 'updated', the progress of its backup (see
+        `backup_segment()`), and the 'bytes_saved' by compacting it. Returns
+        None if the segment is not writable.
+        '''
+        write_lock = self.rethinker.table('lock').get('write:lock:%s' % segment_id).run()
+        if not write_lock:
+            return None
+        promotion = write_lock.get('promotion')
+        if promotion:
+            promotion = {
+                k: v.isoformat() if isinstance(v, datetime.datetime) else v
+                for k, v in promotion.items()}
+        return {
+            'segment': segment_id,
+            'node': write_lock['node'],
+            'under_promotion': bool(write_lock.get('under_promotion')),
+            'promotion': promotion,
+        }
+
     @abc.abstractmethod
     def delete_segment(self, segment_id):
         raise NotImplementedError
@@ -724,16 +1112,18 @@ class MasterSyncController(SyncController):
         result_dict = ujson.loads(response.text)
         return result_dict
 
-    def promote_writable_segment_upstream(self, segment_id):
+    def promote_writable_segment_upstream(self, segment_id, options=None):
         # this function calls the downstream server that holds the write lock
         # if a lock exists, insert a flag representing the promotion into it, otherwise raise exception
 
         # forward the request downstream to actually perform the promotion
+        promotion_options(options)
         write_lock = self.rethinker.table('lock').get('write:lock:%s' % segment_id).run()
         if not write_lock:
             raise Exception("Segment %s is not currently writable" % segment_id)
         post_url = 'http://%s:%s/promote' % (write_lock['node'], self.sync_local_port)
         json_data = {'segment': segment_id}
+        json_data.update(options or {})
         logging.info('posting %s to %s', json.dumps(json_data), post_url)
         response = requests.post(post_url, json=json_data)
         if response.status_code != 200:
@@ -809,6 +1199,7 @@ class LocalSyncController(SyncController):
                 if f.get('error'):
                     raise Exception('Copying HDFS file %r to %r produced an error: %r' % (source, tmp_dest, f['error']))
                 logging.debug('copying from hdfs succeeded, moving %s to %s', tmp_dest, segment.local_path())
+                remove_wal_files(segment.local_path())
                 # clobbers segment.local_path if it already exists, which is what we want
                 os.rename(tmp_dest, segment.local_path())
                 return True
@@ -864,6 +1255,7 @@ class LocalSyncController(SyncController):
                 path = os.path.join(
                         settings['LOCAL_DATA'], '%s.sqlite' % segment_id)
                 os.unlink(path)
+                remove_wal_files(path)
                 deleted_file = True
             except FileNotFoundError:
                 deleted_file = False
@@ -963,8 +1355,10 @@ class LocalSyncController(SyncController):
             logging.warning('PROCEEDING WITHOUT DATA FROM HDFS')
             hdfs_up = False
         logging.info('found %r segments in hdfs', len(remote_mtimes))
-        # list of filenames
-        local_listing = os.listdir(self.local_data)
+        # list of segment filenames (not their -wal and -shm files)
+        local_listing = [
+                filename for filename in os.listdir(self.local_data)
+                if filename.endswith('.sqlite')]
         # { segment_id: mtime }
         local_mtimes = {}
         for path in local_listing:
@@ -1068,7 +1462,7 @@ class LocalSyncController(SyncController):
         if lock_data:
             logging.info('retrieved existing write lock for segment %r', segment_id)
         else:
-            lock_data = segment.new_write_lock()
+            lock_data = segment.new_write_lock(schema_id)
             logging.info('acquired new write lock for segment %r', segment_id)
 
         # TODO: spawn a thread for these?
@@ -1106,26 +1500,63 @@ class LocalSyncController(SyncController):
         logging.info('finished provisioning writable segment %r', result_dict)
         return result_dict
 
-    def do_segment_promotion(self, segment):
-        import sqlitebck
+    def do_segment_promotion(self, segment, options=None):
+        '''Copies `segment` to hdfs, compacted and analyzed according to
+        `options` (see `promotion_options()`). Returns a dict describing the
+        copy: the stats of the 'backup' (see `backup_segment()`), the 'size'
+        of the backup, the 'promoted_size' uploaded, and the 'bytes_saved'
+        by compacting it.'''
+        options = options or promotion_options()
         hdfs = HDFileSystem(host=self.hdfs_host, port=self.hdfs_port)
-        with tempfile.NamedTemporaryFile() as temp_file:
-            # "online backup" see https://www.sqlite.org/backup.html
+        with tempfile.TemporaryDirectory() as temp_dir:
+            backup_path = os.path.join(temp_dir, 'backup.sqlite')
+            logging.info(
+                    'backing up %s to %s', segment.local_path(), backup_path)
+            last_report = [time.monotonic()]
+            def progress(stats):
+                if time.monotonic() - last_report[0] >= float(settings['PROMOTION_PROGRESS_INTERVAL']):
+                    last_report[0] = time.monotonic()
+                    self.report_promotion_progress(segment.id, stage='backup', **stats)
+            stats = backup_segment(segment.local_path(), backup_path, progress)
             logging.info(
-                    'backing up %s to %s', segment.local_path(),
-                    temp_file.name)
-            source = sqlite3.connect(segment.local_path())
-            dest = sqlite3.connect(temp_file.name)
-            sqlitebck.copy(source, dest)
-            source.close()
-            dest.close()
+                    'backed up %s in %.1fs, %s steps, %s restarts',
+                    segment.local_path(), stats['seconds'], stats['steps'],
+                    stats['restarts'])
+            size = os.path.getsize(backup_path)
+            upload_path = backup_path
+            # the backup is a private copy, so these don't hold up writers
+            if options['analyze']:
+                self.report_promotion_progress(segment.id, stage='analyze', **stats)
+                logging.info('analyzing %s', backup_path)
+                analyze_segment(backup_path)
+            if options['compact']:
+                self.report_promotion_progress(segment.id, stage='compact', **stats)
+                upload_path = os.path.join(temp_dir, 'compact.sqlite')
+                logging.info(
+                        'compacting %s to %s (page_size=%s)', backup_path,
+                        upload_path, options['page_size'])
+                compact_segment(backup_path, upload_path, options['page_size'])
+                os.unlink(backup_path)
+            promoted = {
+                'backup': stats,
+                'size': size,
+                'promoted_size': os.path.getsize(upload_path),
+                'options': options,
+            }
+            promoted['bytes_saved'] = size - promoted['promoted_size']
+            if options['compact']:
+                logging.info(
+                        'compacted %s from %s to %s bytes', segment.id,
+                        size, promoted['promoted_size'])
+            self.report_promotion_progress(
+                    segment.id, stage='upload', bytes_saved=promoted['bytes_saved'], **stats)
             logging.info(
-                    'uploading %s to hdfs %s', temp_file.name,
+                    'uploading %s to hdfs %s', upload_path,
                     segment.remote_path)
             hdfs.mkdir(os.path.dirname(segment.remote_path))
             # java hdfs convention, upload to foo._COPYING_
             tmp_name = '%s._COPYING_' % segment.remote_path
-            hdfs.put(temp_file.name, tmp_name)
+            hdfs.put(upload_path, tmp_name)
 
             # update mtime of local segment so that sync local doesn't think the
             # segment we just pushed to hdfs is newer (if it did, it would pull it
@@ -1143,8 +1574,39 @@ class LocalSyncController(SyncController):
             assert result is True
 
             logging.info('Promoted writable segment %s upstream to %s', segment.id, segment.remote_path)
+            return promoted
+
+    def report_promotion_progress(self, segment_id, **progress):
+        '''Records the progress of the promotion of `segment_id` in its write
+        lock, where `promotion_status()` finds it.'''
+        progress['updated'] = doublethink.utcnow()
+        try:
+            self.rethinker.table('lock')\
+                    .get('write:lock:%s' % segment_id)\
+                    .update({'promotion': progress}).run()
+        except Exception:
+            logging.warning(
+                    'failed to record progress of promotion of segment %r',
+                    segment_id, exc_info=True)
+
+    def flush_spooled_writes(self, segment_id):
+        '''Waits until the write server has applied the writes to
+        `segment_id` it acknowledged before applying them (see
+        trough/spool.py), so that the promoted copy has them.'''
+        if not settings['WRITE_SPOOL_DIR']:
+            return
+        url = 'http://%s:%s/flush?segment=%s' % (self.hostname, self.write_port, segment_id)
+        logging.info('flushing spooled writes to segment %r', segment_id)
+        response = requests.post(
+                url, timeout=float(settings['WRITE_SPOOL_FLUSH_TIMEOUT']) + 60)
+        if response.status_code != 200:
+            raise Exception('failed to flush spooled writes to segment %s: %s %s' % (
+                segment_id, response.status_code, response.text))
 
-    def promote_writable_segment_upstream(self, segment_id):
+    def promote_writable_segment_upstream(self, segment_id, options=None):
+        '''`options` of the promotion override those of the segment's schema
+        (see `promotion_options()`).'''
+        promotion_options(options)
         # load write lock, check segment is writable and not under promotion
         # update write lock to mark segment as being under promotion
         # get hdfs path from rethinkdb, use default if not set
@@ -1176,13 +1638,32 @@ class LocalSyncController(SyncController):
                     segment_id, size=-1, rethinker=self.rethinker,
                     services=self.services, registry=self.registry,
                     remote_path=remote_path)
+            schema = None
+            if write_lock.get('schema'):
+                schema = self.get_schema(write_lock['schema'])
+            options = promotion_options(
+                    schema.get('promotion') if schema else None, options)
 
-            self.do_segment_promotion(segment)
+            self.rethinker.table('lock')\
+                    .get('write:lock:%s' % segment_id)\
+                    .update({'promotion': r.literal({
+                        'stage': 'flush', 'started': doublethink.utcnow(),
+                        'updated': doublethink.utcnow()})}).run()
+            self.flush_spooled_writes(segment_id)
+            promoted = self.do_segment_promotion(segment, options)
+            stage = 'done'
+        except:
+            stage = 'failed'
+            raise
         finally:
             self.rethinker.table('lock')\
                     .get('write:lock:%s' % segment_id)\
-                    .update({'under_promotion': False}).run()
-        return {'remote_path': remote_path}
+                    .update({
+                        'under_promotion': False,
+                        'promotion': {'stage': stage, 'updated': doublethink.utcnow()},
+                    }).run()
+        promoted['remote_path'] = remote_path
+        return promoted
 
     def collect_garbage(self):
         # for each segment file on local disk
@@ -1231,6 +1712,7 @@ class LocalSyncController(SyncController):
                             segment.minimum_assignments(), self.hostname,
                             path)
                     os.remove(path)
+                    remove_wal_files(path)
 
 def get_controller(server_mode):
     logging.info('Connecting to Rethinkdb on: %s' % settings['RETHINKDB_HOSTS'])
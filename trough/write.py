@@ -8,6 +8,16 @@ import sqlparse
 import logging
 import urllib
 import doublethink
+import time
+import threading
+import contextlib
+import collections
+import codecs
+import re
+import itertools
+import uuid
+import tempfile
+import struct
 
 if settings['SENTRY_DSN']:
     try:
@@ -16,52 +26,873 @@ if settings['SENTRY_DSN']:
     except ImportError:
         logging.warning("'SENTRY_DSN' setting is configured but 'sentry_sdk' module not available. Install to use sentry.")
 
+class StatementSplitter:
+    '''
+    Splits sql text fed to it a piece at a time into statements, keeping
+    only the statement in progress in memory. Semicolons in string literals,
+    quoted identifiers and comments don't end a statement; neither do those
+    of trigger bodies, checked with `sqlite3.complete_statement()`.
+    '''
+    # what starts a literal, identifier or comment, and what ends it
+    CLOSERS = {"'": "'", '"': '"', '`': '`', '[': ']', '--': '\n', '/*': '*/'}
+    TOKENS = re.compile(r"[;'\"`\[]|--|/\*")
+
+    def __init__(self):
+        # the statement in progress, scanned up to its end
+        self.parts = []
+        # the end of the literal, identifier or comment being scanned, if any
+        self.closer = None
+        # last character of the previous piece, which may start a two
+        # character token with the next piece
+        self.carry = ''
+
+    def feed(self, text, final=False):
+        '''Scans `text`, and returns the list of statements it completed.
+        With `final`, the end of the script, returns the rest as a last
+        statement, unless it is blank.'''
+        text = self.carry + text
+        self.carry = ''
+        statements = []
+        start = pos = 0
+        while True:
+            if self.closer is None:
+                m = self.TOKENS.search(text, pos)
+                if m is None:
+                    if not final and text.endswith(('-', '/')):
+                        self.carry = text[-1]
+                    break
+                pos = m.end()
+                if m.group() != ';':
+                    self.closer = self.CLOSERS[m.group()]
+                    continue
+                self.parts.append(text[start:pos])
+                start = pos
+                statement = ''.join(self.parts)
+                if sqlite3.complete_statement(statement):
+                    statements.append(statement)
+                    self.parts = []
+                else:
+                    self.parts = [statement]
+            else:
+                i = text.find(self.closer, pos)
+                if i < 0:
+                    if not final and self.closer == '*/' and text.endswith('*'):
+                        self.carry = '*'
+                    break
+                pos = i + len(self.closer)
+                self.closer = None
+        self.parts.append(text[start:len(text) - len(self.carry)])
+        if final:
+            rest = ''.join(self.parts)
+            self.parts = []
+            if rest.strip():
+                statements.append(rest)
+        return statements
+
+def iter_statements(chunks):
+    '''Yields the statements of an utf-8 sql script arriving as an
+    iterable of byte chunks, as they are complete.'''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    splitter = StatementSplitter()
+    for chunk in chunks:
+        yield from splitter.feed(decoder.decode(chunk))
+    yield from splitter.feed(decoder.decode(b'', final=True), final=True)
+
+def split_statements(script):
+    '''Splits an sql script into its statements, see `StatementSplitter`.
+    Trailing text that is not a complete statement (say, a last statement
+    with no semicolon) is returned as the last statement.'''
+    return StatementSplitter().feed(script, final=True)
+
+def spill_statements(statements):
+    '''Reads `statements` into a temporary file, each one utf-8 encoded
+    after its length. Returns the file, rewound, the size of the
+    statements and their count, see `iter_spilled`.'''
+    spill = tempfile.TemporaryFile()
+    size = count = 0
+    try:
+        for statement in statements:
+            encoded = statement.encode('utf-8')
+            spill.write(struct.pack('>I', len(encoded)))
+            spill.write(encoded)
+            size += len(statement)
+            count += 1
+        spill.seek(0)
+    except BaseException:
+        spill.close()
+        raise
+    return spill, size, count
+
+def iter_spilled(spill):
+    '''Yields the statements written by `spill_statements`.'''
+    while True:
+        header = spill.read(4)
+        if not header:
+            return
+        length, = struct.unpack('>I', header)
+        yield spill.read(length).decode('utf-8')
+
+# the statements that wrap group commits; the trailing comments keep them
+# apart from identical statements of writes in the connection's statement
+# cache, since the authorizer only looks at a statement when it is prepared.
+# The transaction takes the write lock up front (IMMEDIATE), waiting up to
+# WRITE_BUSY_TIMEOUT for other processes writing to the segment: in a
+# deferred one, a write that reads first would read a snapshot that another
+# process's commit can make stale, and then fail at once (SQLITE_BUSY_SNAPSHOT)
+# rather than wait
+BEGIN = 'BEGIN IMMEDIATE -- trough'
+COMMIT = 'COMMIT -- trough'
+SAVEPOINT = 'SAVEPOINT trough_write -- trough'
+RELEASE = 'RELEASE trough_write -- trough'
+ROLLBACK_TO = 'ROLLBACK TO trough_write -- trough'
+
+class RequestBody:
+    '''Iterable of the chunks of a request body, read as they are
+    needed.'''
+    def __init__(self, input, length=None, chunk_size=65536):
+        self.input = input
+        self.length = length
+        self.chunk_size = chunk_size
+        # bytes read so far
+        self.size = 0
+        # the first of them, for logging
+        self.head = b''
+
+    def __iter__(self):
+        while self.length is None or self.size < self.length:
+            n = self.chunk_size
+            if self.length is not None:
+                n = min(n, self.length - self.size)
+            chunk = self.input.read(n)
+            if not chunk:
+                break
+            self.size += len(chunk)
+            if len(self.head) < 1024:
+                self.head += chunk[:1024 - len(self.head)]
+            yield chunk
+
+def request_body(env):
+    length = env.get('CONTENT_LENGTH')
+    return RequestBody(env['wsgi.input'], int(length) if length else None)
+
+class WriteBatch:
+    '''
+    A write with a client supplied id, the X-Trough-Batch-Id request header.
+    The id is recorded in the segment's `_trough_batches` table in the
+    transaction of the write, so that a retry of a write that was applied
+    (whose response was lost to a timeout, say) is skipped instead of being
+    applied twice. Ids are forgotten after WRITE_BATCH_ID_TTL seconds.
+
+    Writes committed in several transactions record each part, so that a
+    retry skips the parts that were committed and resumes with the rest,
+    provided that the parts are the same, that is, that the write servers
+    have the same WRITE_BULK_CHUNK_ROWS and WRITE_STREAM_BUFFER_BYTES
+    settings.
+    '''
+    CREATE_TABLE = 'CREATE TABLE IF NOT EXISTS _trough_batches (id TEXT PRIMARY KEY, applied REAL NOT NULL)'
+    CREATE_INDEX = 'CREATE INDEX IF NOT EXISTS _trough_batches_applied ON _trough_batches (applied)'
+
+    def __init__(self, batch_id):
+        self.id = batch_id
+        # parts of the write that had already been applied
+        self.duplicates = 0
+
+    def wrap(self, job, part=None):
+        '''Returns a job (see `SegmentWriters.run()`) that runs `job`
+        unless the batch, or its `part`, was applied already.'''
+        key = self.id if part is None else '%s#%s' % (self.id, part)
+        def batch_job(connection):
+            connection.execute(self.CREATE_TABLE)
+            connection.execute(self.CREATE_INDEX)
+            if connection.execute(
+                    'SELECT 1 FROM _trough_batches WHERE id = ?', (key,)).fetchone():
+                logging.info('skipping batch %r, it was applied already', key)
+                self.duplicates += 1
+                return 0
+            changes = connection.total_changes
+            job(connection)
+            changes = connection.total_changes - changes
+            now = time.time()
+            connection.execute(
+                    'DELETE FROM _trough_batches WHERE applied < ?',
+                    (now - float(settings['WRITE_BATCH_ID_TTL']),))
+            connection.execute(
+                    'INSERT INTO _trough_batches (id, applied) VALUES (?, ?)',
+                    (key, now))
+            return changes
+        return batch_job
+
+class PendingWrite:
+    '''A write waiting to be committed, see `SegmentWriters.run()`.'''
+    def __init__(self, job, size, statements):
+        self.job = job
+        self.size = size
+        self.statements = statements
+        self.queued = time.monotonic()
+        self.done = False
+        self.result = None
+        self.error = None
+
+class SegmentWriter:
+    '''Long-lived writer connection to one segment file, and the writes
+    queued up for it.'''
+    def __init__(self, path):
+        self.path = path
+        # held while the connection is in use
+        self.lock = threading.Lock()
+        # guards `queue` and `leading`
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        # whether one of the queued writes' threads is committing for all
+        self.leading = False
+        self.connection = None
+        self.file = None
+        self.last_used = time.monotonic()
+        # set while the statements of a write run, see `authorizer()`
+        self.restricted = False
+
+    def authorizer(self, action, arg1, arg2, db_name, trigger_name):
+        '''sqlite authorizer of the writer connection. The statements of a
+        write run inside a transaction shared with other writes: they may not
+        end it, nor mess with its savepoints.'''
+        if self.restricted and action in (
+                sqlite3.SQLITE_TRANSACTION, sqlite3.SQLITE_SAVEPOINT):
+            return sqlite3.SQLITE_DENY
+        return sqlite3.SQLITE_OK
+
+    def open(self):
+        '''Returns the open connection, (re)opening it if it is closed or
+        the file was replaced.'''
+        if self.connection is not None and self.replaced():
+            logging.info('%s was replaced, reopening its writer connection', self.path)
+            self.close()
+        if self.connection is None:
+            connection = sqlite3.connect(
+                    self.path, check_same_thread=False, isolation_level=None,
+                    timeout=float(settings['WRITE_BUSY_TIMEOUT']),
+                    cached_statements=int(settings['WRITE_STATEMENT_CACHE_SIZE']))
+            trough.sync.setup_connection(connection)
+            # installed for good, since (re)setting an authorizer expires the
+            # connection's cached statements
+            connection.set_authorizer(self.authorizer)
+            if settings['WRITE_JOURNAL_MODE']:
+                connection.execute('PRAGMA journal_mode = %s' % settings['WRITE_JOURNAL_MODE'])
+            connection.execute('PRAGMA synchronous = %s' % settings['WRITE_SYNCHRONOUS'])
+            connection.execute('PRAGMA wal_autocheckpoint = %d' % int(settings['WRITE_WAL_AUTOCHECKPOINT']))
+            connection.execute('PRAGMA journal_size_limit = %d' % int(settings['WRITE_JOURNAL_SIZE_LIMIT']))
+            # the file the connection has open, which the sync loop may replace
+            st = os.stat(self.path)
+            self.file = (st.st_dev, st.st_ino)
+            self.connection = connection
+        return self.connection
+
+    def replaced(self):
+        '''Whether the file at `path` is no longer the one the connection
+        has open.'''
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        return (st.st_dev, st.st_ino) != self.file
+
+    def close(self):
+        '''Checkpoints and closes the connection, leaving the file in
+        rollback journal mode, the mode segments are kept in at rest, unless
+        somebody else (another worker process, a reader) has it open.'''
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+            if settings['WRITE_JOURNAL_MODE'] and not self.replaced():
+                connection.execute('PRAGMA busy_timeout = 0')
+                connection.execute('PRAGMA journal_mode = DELETE')
+        except sqlite3.Error as e:
+            logging.debug('leaving %s in %s mode: %s', self.path, settings['WRITE_JOURNAL_MODE'], e)
+        finally:
+            connection.close()
+
+class SegmentWriters:
+    '''
+    Writer connections of this process, one per segment, kept open between
+    requests so that a write doesn't pay for opening the file and loading the
+    schema. Segments being written to are switched to the WRITE_JOURNAL_MODE
+    journal mode (WAL), so that readers don't block while a write is in
+    progress, with the WRITE_SYNCHRONOUS durability level.
+
+    Concurrent writes to a segment are group committed, see `run()`.
+
+    A connection is closed when it has been idle for
+    WRITE_CONNECTION_IDLE_TIMEOUT seconds, when the segment's write lock is
+    released or under promotion (see `WriteServer.__call__()`), and when the
+    sync loop replaces the file.
+    '''
+    def __init__(self, idle_timeout=None):
+        self.idle_timeout = float(idle_timeout or settings['WRITE_CONNECTION_IDLE_TIMEOUT'])
+        self._lock = threading.Lock()
+        # { path: SegmentWriter }
+        self._writers = {}
+
+    def writer(self, path):
+        with self._lock:
+            writer = self._writers.get(path)
+            if writer is None:
+                writer = self._writers[path] = SegmentWriter(path)
+            return writer
+
+    def _done_with(self, path, writer):
+        '''Closes `writer` if it was closed (and forgotten) while in use.'''
+        with self._lock:
+            if self._writers.get(path) is writer:
+                return
+        with writer.cond:
+            if writer.queue or writer.leading:
+                return
+        with writer.lock:
+            writer.close()
+
+    @contextlib.contextmanager
+    def connection(self, path):
+        '''Context manager that holds the writer connection to `path`, in
+        autocommit mode, outside of group commits.'''
+        writer = self.writer(path)
+        try:
+            with writer.lock:
+                try:
+                    yield writer.open()
+                finally:
+                    writer.last_used = time.monotonic()
+        finally:
+            self._done_with(path, writer)
+
+    def run(self, path, job, size=0, statements=1):
+        '''
+        Runs `job(connection)` against the segment file at `path`, inside a
+        savepoint of a transaction shared with the other writes to the file
+        queued up at the same time, and returns the number of rows it
+        changed (or what `job` returned, if not None) once that transaction
+        is committed. If `job` raises, only
+        its own changes are rolled back, and the exception is raised here.
+
+        The first write to arrive commits for everyone: it waits up to
+        WRITE_GROUP_COMMIT_WINDOW seconds for more writes (while a commit is
+        in progress, writes queue up anyway), then takes up to
+        WRITE_GROUP_COMMIT_MAX_STATEMENTS statements or
+        WRITE_GROUP_COMMIT_MAX_BYTES bytes of sql off the queue, and runs
+        them in one transaction; the next write in line commits the rest.
+        `size` and `statements` are what the write counts for against those
+        limits.
+        '''
+        writer = self.writer(path)
+        pending = PendingWrite(job, size, statements)
+        try:
+            with writer.cond:
+                writer.queue.append(pending)
+                writer.cond.notify_all()
+                while not pending.done:
+                    if writer.leading:
+                        writer.cond.wait()
+                        continue
+                    writer.leading = True
+                    try:
+                        group = self._gather(writer)
+                        writer.cond.release()
+                        try:
+                            with writer.lock:
+                                self._commit(writer, group)
+                        finally:
+                            writer.cond.acquire()
+                        for item in group:
+                            item.done = True
+                    finally:
+                        writer.leading = False
+                        writer.cond.notify_all()
+        finally:
+            self._done_with(path, writer)
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _gather(self, writer):
+        '''Waits for the group commit window to pass, or the queue to fill
+        up, and takes a group of writes off the queue. Called with
+        `writer.cond` held.'''
+        max_statements = int(settings['WRITE_GROUP_COMMIT_MAX_STATEMENTS'])
+        max_bytes = int(settings['WRITE_GROUP_COMMIT_MAX_BYTES'])
+        deadline = time.monotonic() + float(settings['WRITE_GROUP_COMMIT_WINDOW'])
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (
+                    sum(item.statements for item in writer.queue) >= max_statements
+                    or sum(item.size for item in writer.queue) >= max_bytes):
+                break
+            writer.cond.wait(remaining)
+        group = []
+        statements = size = 0
+        while writer.queue:
+            item = writer.queue[0]
+            if group and (statements + item.statements > max_statements
+                          or size + item.size > max_bytes):
+                break
+            group.append(writer.queue.popleft())
+            statements += item.statements
+            size += item.size
+        return group
+
+    def _commit(self, writer, group):
+        '''Runs `group` in one transaction. Called with `writer.lock`
+        held.'''
+        metrics = trough.metrics.registry
+        now = time.monotonic()
+        for item in group:
+            metrics.observe('trough_write_queue_seconds', now - item.queued)
+        try:
+            connection = writer.open()
+            connection.execute(BEGIN)
+            for item in group:
+                connection.execute(SAVEPOINT)
+                changes = connection.total_changes
+                writer.restricted = True
+                try:
+                    result = item.job(connection)
+                except Exception as e:
+                    writer.restricted = False
+                    connection.execute(ROLLBACK_TO)
+                    item.error = e
+                else:
+                    writer.restricted = False
+                    if result is None:
+                        result = connection.total_changes - changes
+                    item.result = result
+                connection.execute(RELEASE)
+            connection.execute(COMMIT)
+        except Exception as e:
+            # the transaction failed as a whole, none of it was written
+            logging.error('group commit to %s failed', writer.path, exc_info=True)
+            if writer.connection is not None and writer.connection.in_transaction:
+                writer.connection.rollback()
+            for item in group:
+                if item.error is None:
+                    item.error = e
+                    item.result = None
+            metrics.inc('trough_write_group_commit_failures_total')
+        else:
+            metrics.inc('trough_write_commits_total')
+            metrics.observe('trough_write_group_commit_size', len(group))
+        finally:
+            writer.last_used = time.monotonic()
+
+    def close(self, path):
+        '''Closes the writer connection to `path`, if there is one.'''
+        with self._lock:
+            writer = self._writers.pop(path, None)
+        if writer:
+            with writer.lock:
+                writer.close()
+
+    def close_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                (path, writer) for path, writer in self._writers.items()
+                if now - writer.last_used > self.idle_timeout]
+        for path, writer in idle:
+            if not writer.lock.acquire(blocking=False):
+                # in use after all
+                continue
+            try:
+                logging.debug('closing idle writer connection to %s', path)
+                with self._lock:
+                    if self._writers.get(path) is writer:
+                        del self._writers[path]
+                writer.close()
+            finally:
+                writer.lock.release()
+
+    def close_all(self):
+        with self._lock:
+            paths = list(self._writers)
+        for path in paths:
+            self.close(path)
+
 class WriteServer:
     def __init__(self):
         self.rethinker = doublethink.Rethinker(db="trough_configuration", servers=settings['RETHINKDB_HOSTS'])
         self.services = doublethink.ServiceRegistry(self.rethinker)
         self.registry = trough.sync.HostRegistry(rethinker=self.rethinker, services=self.services)
+        self.writers = SegmentWriters()
+        self.spooler = None
+        if settings['WRITE_SPOOL_DIR']:
+            self.spooler = trough.spool.Spooler(
+                    settings['WRITE_SPOOL_DIR'], self.apply_spooled)
+        metrics = trough.metrics.registry
+        metrics.histogram(
+                'trough_write_request_seconds',
+                'write request latency, by segment class and outcome')
+        metrics.counter(
+                'trough_write_request_bytes_total',
+                'write request bytes, by segment class')
+        metrics.counter(
+                'trough_write_rows_total',
+                'rows inserted, updated or deleted, by segment class')
+        metrics.counter(
+                'trough_write_commits_total',
+                'group commits, each the transaction of one or more writes')
+        metrics.counter(
+                'trough_write_group_commit_failures_total',
+                'group commits that failed as a whole')
+        metrics.histogram(
+                'trough_write_group_commit_size',
+                'writes per group commit',
+                buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+        metrics.histogram(
+                'trough_write_queue_seconds',
+                'time writes wait for their group commit to start')
         trough.sync.init(self.rethinker)
 
-    def write(self, segment, query):
-        logging.info('Servicing request: segment=%r query=%r', segment, query)
-        # if one or more of the query(s) are not a write query, raise an exception.
-        if not query:
-            raise Exception("No query provided.")
+    def count_changes(self, segment, changes):
+        trough.metrics.registry.inc(
+                'trough_write_rows_total', changes,
+                segment_class=trough.metrics.segment_class(segment.id))
+
+    def write(self, segment, query, write_batch=None):
+        '''
+        Runs the sql script `query`, bytes or an iterable of byte chunks
+        (a request body, see `RequestBody`), executing its statements as
+        they are read, so that memory use is bounded whatever the size of
+        the script.
+
+        Up to WRITE_STREAM_BUFFER_BYTES of sql are read ahead; a script that
+        fits is run as one write, group committed with others. The rest of
+        a longer script is read into a temporary file first, so that a slow
+        client never holds up the group commit, and then run as one write,
+        or, with WRITE_STREAM_COMMIT_CHUNKS, committed every
+        WRITE_STREAM_BUFFER_BYTES, in which case the error raised by a
+        failing statement says how many were committed before it.
+
+        With a `WriteBatch`, a write that was applied already is skipped.
+        '''
+        logging.debug('Servicing request: segment=%r query=%r', segment, query)
+        if isinstance(query, bytes):
+            query = [query]
         # no sql parsing, if our chmod has write permission, allow all queries.
-        connection = sqlite3.connect(segment.local_path())
-        trough.sync.setup_connection(connection)
+        statements = iter_statements(query)
+        buffer_bytes = int(settings['WRITE_STREAM_BUFFER_BYTES'])
+        def read_ahead():
+            buffered = []
+            size = 0
+            for statement in statements:
+                buffered.append(statement)
+                size += len(statement)
+                if size >= buffer_bytes:
+                    return buffered, size, False
+            return buffered, size, True
+        buffered, size, done = read_ahead()
+        if not buffered:
+            raise Exception("No query provided.")
+        if done:
+            def job(connection):
+                for statement in buffered:
+                    connection.execute(statement)
+            changes = self.writers.run(
+                    segment.local_path(), self._job(job, write_batch),
+                    size, len(buffered))
+            self.count_changes(segment, changes)
+            return b"OK\n"
+        if not settings['WRITE_STREAM_COMMIT_CHUNKS']:
+            # read in this thread: the job may run in the thread of another
+            # request, leading the group commit, with the segment's writer
+            # locked
+            spill, size, count = spill_statements(
+                    itertools.chain(buffered, statements))
+            with spill:
+                def job(connection):
+                    spill.seek(0)
+                    for statement in iter_spilled(spill):
+                        connection.execute(statement)
+                changes = self.writers.run(
+                        segment.local_path(), self._job(job, write_batch),
+                        size, count)
+            self.count_changes(segment, changes)
+            return b"OK\n"
+        committed = 0
         try:
-            query = query.rstrip();
-            if not query[-1] == b';':
-                query = query + b';'
-            # executescript does not seem to respect isolation_level, so for
-            # performance, we wrap the sql in a transaction manually
-            # see http://bugs.python.org/issue30593
-            query = b"BEGIN TRANSACTION;\n" + query + b"\nCOMMIT;\n"
-            output = connection.executescript(query.decode('utf-8'))
-        finally:
-            connection.commit()
-            connection.close()
+            while buffered:
+                def job(connection, buffered=buffered):
+                    for statement in buffered:
+                        connection.execute(statement)
+                changes = self.writers.run(
+                        segment.local_path(),
+                        self._job(job, write_batch, part=committed),
+                        size, len(buffered))
+                self.count_changes(segment, changes)
+                committed += len(buffered)
+                buffered, size, done = read_ahead()
+        except Exception as e:
+            raise Exception('write stopped after %s statements: %s' % (
+                committed, e)) from e
         return b"OK\n"
 
+    def write_bound(self, segment, sql, params=None, batch=None, write_batch=None):
+        '''
+        Runs one statement with parameters bound by sqlite3, once with
+        `params`, or once for each parameter list in `batch`, in a single
+        transaction. With a `WriteBatch`, a write that was applied already
+        is skipped.
+        '''
+        logging.debug('Servicing request: segment=%r sql=%r', segment, sql)
+        if not sql.strip():
+            raise Exception("No query provided.")
+        def job(connection):
+            if batch is not None:
+                connection.executemany(sql, batch)
+            else:
+                connection.execute(sql, params or ())
+        changes = self.writers.run(
+                segment.local_path(), self._job(job, write_batch), len(sql),
+                len(batch) if batch is not None else 1)
+        self.count_changes(segment, changes)
+        return b"OK\n"
+
+    def bulk_insert(
+            self, segment, table, format, chunks, columns=None,
+            write_batch=None):
+        '''
+        Inserts the rows of a body in `format` (see
+        `trough.formats.decode_stream()`), arriving as an iterable of byte
+        chunks, into `table`, WRITE_BULK_CHUNK_ROWS rows per transaction, so
+        that neither the body nor the rows are ever all in memory. Rows are
+        mapped to the columns named `columns`, by default the keys of the
+        first row; a row without a column inserts NULL, a row with a key that
+        is not a column is an error. Values are as in bound queries (see
+        `trough.sync.encode_bound_query()`).
+
+        Returns the number of rows inserted. Since each chunk of rows is
+        committed on its own, the error raised when a row can't be inserted
+        says how many were. With a `WriteBatch`, chunks that were inserted
+        already are skipped (and counted as inserted).
+        '''
+        logging.debug('Servicing request: segment=%r table=%r format=%r', segment, table, format)
+        records = trough.formats.decode_stream(format, chunks)
+        first = next(records, None)
+        if first is None:
+            return 0
+        if not columns:
+            columns = list(first)
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                trough.read.quote_identifier(table),
+                ', '.join(trough.read.quote_identifier(c) for c in columns),
+                ', '.join('?' * len(columns)))
+        known = set(columns)
+        chunk_rows = int(settings['WRITE_BULK_CHUNK_ROWS'])
+        inserted = 0
+        try:
+            chunk = []
+            for record in itertools.chain((first,), records):
+                if not isinstance(record, dict):
+                    raise ValueError('rows must be objects, not %r' % (record,))
+                if not known.issuperset(record):
+                    raise ValueError('row has columns %r not in %r' % (
+                        sorted(set(record) - known), columns))
+                record = trough.sync.decode_params(record)
+                chunk.append(tuple(record.get(column) for column in columns))
+                if len(chunk) >= chunk_rows:
+                    inserted += self._insert_chunk(
+                            segment, sql, chunk, write_batch, inserted)
+                    chunk = []
+            if chunk:
+                inserted += self._insert_chunk(
+                        segment, sql, chunk, write_batch, inserted)
+        except Exception as e:
+            raise Exception('bulk insert into %r stopped after %s rows: %s' % (
+                table, inserted, e)) from e
+        return inserted
+
+    def _insert_chunk(self, segment, sql, chunk, write_batch, offset):
+        def job(connection):
+            connection.executemany(sql, chunk)
+        changes = self.writers.run(
+                segment.local_path(),
+                self._job(job, write_batch, part=offset), 0, len(chunk))
+        self.count_changes(segment, changes)
+        return len(chunk)
+
+    def _job(self, job, write_batch, part=None):
+        if write_batch is None:
+            return job
+        return write_batch.wrap(job, part)
+
+    def apply_spooled(self, segment_id, record):
+        '''Applies a write spooled by `spool()`.'''
+        header = record.header
+        segment = trough.sync.Segment(
+                segment_id=segment_id, size=0, rethinker=self.rethinker,
+                services=self.services, registry=self.registry)
+        write_batch = WriteBatch(header['batch_id'])
+        if header['kind'] == 'bulk':
+            self.bulk_insert(
+                    segment, header['table'], header['format'],
+                    [record.body], header['columns'], write_batch)
+        elif header['kind'] == 'bound':
+            sql, params, batch = trough.sync.parse_bound_query(record.body)
+            self.write_bound(segment, sql, params, batch, write_batch)
+        else:
+            self.write(segment, record.body, write_batch)
+        if write_batch.duplicates:
+            logging.info('spooled write %r had been applied already', header['batch_id'])
+
+    def spool(self, segment, header, env):
+        '''
+        Appends the write to `segment` described by `header` to the spool,
+        to be applied in the background, if it was asked for, with the
+        X-Trough-Async header (by default, WRITE_ASYNC), and its body is
+        small enough to keep in the spool (see `trough.spool`). Returns
+        whether it did.
+        '''
+        if not self.spooler:
+            return False
+        requested = env.get('HTTP_X_TROUGH_ASYNC')
+        if requested is None:
+            if not settings['WRITE_ASYNC']:
+                return False
+        elif requested.strip().lower() in ('0', 'false', 'no'):
+            return False
+        length = env.get('CONTENT_LENGTH')
+        if not length or int(length) > int(settings['WRITE_SPOOL_MAX_BYTES']):
+            return False
+        body = b''.join(request_body(env))
+        # turn away what would fail to apply for sure now, while the client
+        # can still be told
+        if header['kind'] == 'bulk':
+            if header['format'] not in trough.formats.STREAM_FORMATS or not trough.formats.available(header['format']):
+                raise trough.formats.UnsupportedFormat(
+                        'format %r can not be streamed (supported: %s)' % (
+                            header['format'], ', '.join(trough.formats.STREAM_FORMATS)))
+        elif header['kind'] == 'bound':
+            trough.sync.parse_bound_query(body)
+        elif not body.strip():
+            raise Exception("No query provided.")
+        header = dict(header, batch_id=env.get('HTTP_X_TROUGH_BATCH_ID') or uuid.uuid4().hex)
+        self.spooler.append(segment.id, header, body)
+        return True
+
+    def flush(self, env, start_response):
+        '''Endpoint that waits until the writes to the ?segment= spooled so
+        far are applied, see `trough.spool.Spooler.flush()`. The segment
+        manager calls it before it promotes a segment.'''
+        query_dict = urllib.parse.parse_qs(env.get('QUERY_STRING'))
+        segment_id = query_dict.get('segment', [None])[0]
+        if not segment_id:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return [b'400 Bad Request: ?segment= is required\n']
+        if self.spooler and not self.spooler.flush(
+                segment_id, float(settings['WRITE_SPOOL_FLUSH_TIMEOUT'])):
+            start_response('504 Gateway Timeout', [('Content-Type', 'text/plain')])
+            return [b'504 Gateway Timeout: spooled writes are still being applied\n']
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'OK\n']
+
+    def metrics(self, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [trough.metrics.registry.render().encode('utf-8')]
+
+    def observe_request(self, segment_id, outcome, start, size):
+        metrics = trough.metrics.registry
+        segment_class = trough.metrics.segment_class(segment_id)
+        metrics.observe(
+                'trough_write_request_seconds', time.monotonic() - start,
+                segment_class=segment_class, outcome=outcome)
+        metrics.inc('trough_write_request_bytes_total', size, segment_class=segment_class)
+        metrics.maybe_snapshot()
+
     # uwsgi endpoint
     def __call__(self, env, start_response):
+        if env.get('PATH_INFO') == '/metrics':
+            return self.metrics(start_response)
+        if env.get('PATH_INFO') == '/flush':
+            return self.flush(env, start_response)
+        start = time.monotonic()
+        segment_id = None
+        query = b''
+        body = None
+        outcome = 'error'
         try:
             query_dict = urllib.parse.parse_qs(env.get('QUERY_STRING'))
             # use the ?segment= query string variable or the host string to figure out which sqlite database to talk to.
             segment_id = query_dict.get('segment', env.get('HTTP_HOST', "").split("."))[0]
-            logging.info('Connecting to Rethinkdb on: %s' % settings['RETHINKDB_HOSTS'])
+            logging.debug('Connecting to Rethinkdb on: %s', settings['RETHINKDB_HOSTS'])
             segment = trough.sync.Segment(segment_id=segment_id, size=0, rethinker=self.rethinker, services=self.services, registry=self.registry)
-            query = env.get('wsgi.input').read()
+            bulk_table = query_dict.get('table', [None])[0]
             write_lock = segment.retrieve_write_lock()
             if not write_lock or write_lock['node'] != settings['HOSTNAME']:
+                # the lock was released, or the segment was promoted and
+                # handed over
+                self.writers.close(segment.local_path())
                 raise Exception("This node (settings['HOSTNAME']={!r}) cannot write to segment {!r}. There is no write lock set, or the write lock authorizes another node. Write lock: {!r}".format(settings['HOSTNAME'], segment.id, write_lock))
 
-            output = self.write(segment, query)
-            start_response('200 OK', [('Content-Type', 'text/plain')])
+            content_type = env.get('CONTENT_TYPE')
+            write_batch = None
+            if env.get('HTTP_X_TROUGH_BATCH_ID'):
+                write_batch = WriteBatch(env['HTTP_X_TROUGH_BATCH_ID'])
+            if bulk_table is not None:
+                format = query_dict.get('format', [None])[0] or trough.formats.MEDIA_TYPES.get(
+                        (content_type or '').split(';')[0].strip().lower())
+                columns = [
+                    column for value in query_dict.get('columns', [])
+                    for column in value.split(',') if column]
+                spool_header = {
+                    'kind': 'bulk', 'table': bulk_table, 'format': format,
+                    'columns': columns or None}
+            elif content_type and content_type.split(';')[0].strip() == trough.sync.BOUND_QUERY_CONTENT_TYPE:
+                spool_header = {'kind': 'bound'}
+            else:
+                spool_header = {'kind': 'sql'}
+            if self.spool(segment, spool_header, env):
+                start_response('200 OK', [
+                    ('Content-Type', 'text/plain'), ('X-Trough-Ack', 'spooled')])
+                outcome = 'ok'
+                return [b'OK\n']
+            if bulk_table is not None:
+                body = request_body(env)
+                inserted = self.bulk_insert(
+                        segment, bulk_table, format, body, columns or None,
+                        write_batch)
+                output = [b"OK %d\n" % inserted]
+            elif content_type and content_type.split(';')[0].strip() == trough.sync.BOUND_QUERY_CONTENT_TYPE:
+                body = request_body(env)
+                query = b''.join(body)
+                sql, params, batch = trough.sync.parse_bound_query(query)
+                output = self.write_bound(segment, sql, params, batch, write_batch)
+            else:
+                body = request_body(env)
+                output = self.write(segment, body, write_batch)
+            if write_lock.get('under_promotion'):
+                # checkpoint, so that the copy being promoted is all in the
+                # segment file
+                self.writers.close(segment.local_path())
+            headers = [('Content-Type', 'text/plain')]
+            if write_batch is not None:
+                # 'duplicate' if the write, or some of its parts, had been
+                # applied already
+                headers.append((
+                    'X-Trough-Batch-Status',
+                    'duplicate' if write_batch.duplicates else 'applied'))
+            start_response('200 OK', headers)
+            outcome = 'ok'
             return output
+        except trough.spool.SpoolFull as e:
+            start_response('429 Too Many Requests', [
+                ('Content-Type', 'text/plain'), ('Retry-After', '1')])
+            return [('429 Too Many Requests: %s\n' % str(e)).encode('utf-8')]
         except Exception as e:
-            logging.error('500 Server Error due to exception (segment=%r query=%r)', segment, bytes(query), exc_info=True)
+            if body is not None:
+                query = body.head + (b'...' if body.size > len(body.head) else b'')
+            logging.error('500 Server Error due to exception (segment=%r query=%r)', segment_id, bytes(query), exc_info=True)
             start_response('500 Server Error', [('Content-Type', 'text/plain')])
             return [('500 Server Error: %s\n' % str(e)).encode('utf-8')]
+        finally:
+            self.writers.close_idle()
+            self.observe_request(
+                    segment_id, outcome, start,
+                    body.size if body is not None else len(query))
@@ -1,14 +1,24 @@
+import itertools
 import logging
 import sqlite3
 import trough
 import flask
 import ujson
 import trough.settings
+import trough.fanout
+import requests
+import requests.adapters
 
 def make_app(controller):
     controller.check_config()
     app = flask.Flask(__name__)
 
+    # keep-alive connections to read servers, for fan-out queries
+    fanout_session = requests.Session()
+    fanout_session.mount('http://', requests.adapters.HTTPAdapter(
+        pool_connections=100,
+        pool_maxsize=int(trough.settings.settings['FANOUT_MAX_CONCURRENCY'])))
+
     @app.route('/', methods=['POST'])
     def simple_provision_writable_segment():
         ''' deprecated api '''
@@ -41,16 +51,41 @@ def make_app(controller):
     def promote_writable_segment():
         '''Promotes segments to HDFS, will respond with a JSON object which describes:
         - hdfs path
-        - segment size on disk
-        - whether or not an upstream segment will be overwritten
+        - segment size on disk, size of the promoted copy, and bytes saved by compacting it
+        - the options of the promotion, and stats of the backup of the segment
+
+    The request JSON object may override the promotion options of the segment's schema:
+        - compact: promote a copy without free pages (VACUUM INTO)
+        - analyze: gather query planner statistics in the copy (ANALYZE)
+        - page_size: page size of a compacted copy
 
     This endpoint will toggle a value on the write lock record, which will be consulted so that a segment cannot be promoted while a promotion is in progress. The current journal will be committed, and after promotion completes, this URL will return its JSON document.'''
         post_json = ujson.loads(flask.request.get_data())
         segment_id = post_json['segment']
-        result_dict = controller.promote_writable_segment_upstream(segment_id)
+        options = {
+            k: v for k, v in post_json.items()
+            if k in trough.sync.PROMOTION_OPTIONS}
+        try:
+            result_dict = controller.promote_writable_segment_upstream(segment_id, options)
+        except trough.sync.ClientError as e:
+            response = flask.jsonify({'error': e.args[0]})
+            response.status_code = 400
+            return response
         result_json = ujson.dumps(result_dict)
         return flask.Response(result_json, mimetype='application/json')
 
+    @app.route('/promote/<id>', methods=['GET'])
+    def promotion_status(id):
+        '''Responds with a JSON object which describes the progress of the
+        promotion of writable segment `id`, or 404 if it is not writable:
+        - whether it is under promotion
+        - the stage of the promotion: flush, backup, analyze, compact, upload, done or failed
+        - pages of the backup copied so far, and times it started over'''
+        status = controller.promotion_status(id)
+        if status is None:
+            flask.abort(404)
+        return flask.Response(ujson.dumps(status), mimetype='application/json')
+
     @app.route('/schema', methods=['GET'])
     def list_schemas():
         '''Schema API Endpoint, lists schema names'''
@@ -75,14 +110,16 @@ def make_app(controller):
 
     @app.route('/schema/<id>', methods=['PUT'])
     def put_schema(id):
-        '''Schema API Endpoint, creates or updates schema from json input'''
+        '''Schema API Endpoint, creates or updates schema from json input, which
+        may have the promotion options of segments of the schema, under
+        'promotion' (see /promote)'''
         try:
             schema_dict = ujson.loads(flask.request.get_data(as_text=True))
         except:
             return flask.Response(
                     status=400, mimetype='text/plain',
                     response='input could not be parsed as json')
-        if set(schema_dict.keys()) != {'id','sql'}:
+        if set(schema_dict.keys()) - {'promotion'} != {'id','sql'}:
             return flask.Response(status=400, mimetype='text/plain', response=(
                 "input json has keys %r (should be {'id', 'sql'})" % set(schema_dict.keys())))
         if schema_dict.get('id') != id:
@@ -92,11 +129,16 @@ def make_app(controller):
                         schema_dict.get('id'), id))
 
         try:
-            schema, created = controller.set_schema(id=id, sql=schema_dict['sql'])
+            schema, created = controller.set_schema(
+                    id=id, sql=schema_dict['sql'],
+                    promotion=schema_dict.get('promotion'))
         except sqlite3.OperationalError as e:
             return flask.Response(
                     status=400, mimetype='text/plain',
                     response='schema sql failed validation: %s' % e)
+        except trough.sync.ClientError as e:
+            return flask.Response(
+                    status=400, mimetype='text/plain', response=e.args[0])
 
         return flask.Response(status=201 if created else 204)
 
@@ -113,6 +155,38 @@ def make_app(controller):
 
         return flask.Response(status=201 if created else 204)
 
+    @app.route('/query', methods=['POST'])
+    def fanout_query():
+        '''Runs one SELECT against many segments. Takes a JSON object with:
+        - sql: the query
+        - segments: a list of segment ids, or
+        - regex: a regular expression matching segment ids
+        - params: parameters to bind, optional
+        - concurrency: how many segments to query at once, optional
+    and streams back the merged rows and any per-segment errors, see trough.fanout.'''
+        try:
+            request = ujson.loads(flask.request.get_data(as_text=True))
+            if not isinstance(request.get('sql'), str):
+                raise trough.fanout.FanoutError('"sql" is required')
+            if (request.get('segments') is None) == (request.get('regex') is None):
+                raise trough.fanout.FanoutError('one of "segments" or "regex" is required')
+            urls = trough.fanout.healthy_read_urls(
+                    controller.rethinker, segments=request.get('segments'),
+                    regex=request.get('regex'))
+            logging.info(
+                    'fan-out query to %s segments: %r', len(urls), request['sql'])
+            fanout = trough.fanout.Fanout(
+                    request['sql'], urls, params=request.get('params'),
+                    concurrency=request.get('concurrency'),
+                    session=fanout_session)
+            body = fanout.stream()
+            # runs until the first row is in, raising any merge errors
+            first = next(body)
+        except (ValueError, trough.fanout.FanoutError) as e:
+            return flask.Response(status=400, mimetype='text/plain', response=str(e))
+        return flask.Response(
+                itertools.chain([first], body), mimetype='application/json')
+
     # responds with 204 on successful delete, 404 if segment does not exist
     @app.route('/segment/<id>', methods=['DELETE'])
     def delete_segment(id):